@@ -0,0 +1,147 @@
+import collections
+import threading
+import time
+from logconfig import get_logger
+
+log = get_logger("actors")
+
+# Room logic runs on room actors. Every room has a mailbox of pending calls,
+# and a fixed pool of worker threads takes turns running rooms that have mail.
+# A room's calls run one at a time and in the order they were submitted, while
+# different rooms run in parallel on different workers. The number of threads
+# does not grow with the number of rooms or players.
+
+
+class RoomActor:
+    """Mailbox and queueing statistics for one room."""
+
+    def __init__(self, room_name):
+        self.room_name = room_name
+        self.mailbox = collections.deque()  # (submitted at, callback, args)
+        self.scheduled = False  # In the run queue or being run by a worker
+        self.forgotten = False  # Room was deleted, drop the actor when it goes idle
+        self.processed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            "queued": len(self.mailbox),
+            "processed": self.processed,
+            "mean_delay": self.total_delay / self.processed if self.processed else 0.0,
+            "max_delay": self.max_delay,
+            "errors": self.errors,
+        }
+
+
+class RoomScheduler:
+    """Runs room actors on a fixed pool of worker threads.
+
+    Rooms with mail wait in a single FIFO run queue. A worker takes the room at
+    the head, runs at most `batch` of its calls and, if more are waiting, puts
+    it back at the tail, so a busy room cannot starve the others. The time
+    each call spent waiting in its mailbox is recorded per room, and passed
+    with the time it took to run to observe(delay, seconds) if given.
+    """
+
+    def __init__(self, workers=4, batch=16, observe=None):
+        self.batch = batch
+        self.observe = observe
+        self.actors = {}  # Room name -> RoomActor
+        self.run_queue = collections.deque()
+        self.busy = 0  # Actors in the run queue or being run
+        self.errors = 0  # Calls that raised, over all rooms
+        self.condition = threading.Condition()
+        self.running = True
+        self.threads = [threading.Thread(target=self.work, name=f"room-worker-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, room_name, callback, *args):
+        """Queue callback(*args) on a room's actor."""
+        with self.condition:
+            actor = self.actors.get(room_name)
+            if actor is None:
+                actor = self.actors[room_name] = RoomActor(room_name)
+            actor.forgotten = False
+            actor.mailbox.append((time.monotonic(), callback, args))
+            if not actor.scheduled:
+                actor.scheduled = True
+                self.busy += 1
+                self.run_queue.append(actor)
+                self.condition.notify()
+
+    def work(self):
+        """Worker thread: run rooms from the run queue until shutdown."""
+        while True:
+            with self.condition:
+                while not self.run_queue and self.running:
+                    self.condition.wait()
+                if not self.run_queue:
+                    return
+                actor = self.run_queue.popleft()
+            self.run_batch(actor)
+
+    def run_batch(self, actor):
+        """Run up to batch calls of one actor, then reschedule it or let it go idle."""
+        for _ in range(self.batch):
+            with self.condition:
+                if not actor.mailbox:
+                    break
+                submitted, callback, args = actor.mailbox.popleft()
+            delay = time.monotonic() - submitted
+            actor.processed += 1
+            actor.total_delay += delay
+            if delay > actor.max_delay:
+                actor.max_delay = delay
+            started = time.perf_counter()
+            try:
+                callback(*args)
+            except Exception as e:
+                with self.condition:
+                    actor.errors += 1
+                    self.errors += 1
+                log.exception(f"Error in room actor: {e}", extra={"fields": {"room": actor.room_name}})
+            if self.observe is not None:
+                self.observe(delay, time.perf_counter() - started)
+
+        with self.condition:
+            if actor.mailbox:
+                self.run_queue.append(actor)  # Back of the line, other rooms go first
+                self.condition.notify()
+                return
+            actor.scheduled = False
+            self.busy -= 1
+            if actor.forgotten:
+                del self.actors[actor.room_name]
+            if not self.busy:
+                self.condition.notify_all()
+
+    def forget(self, room_name):
+        """Drop the actor of a deleted room once it has no more mail."""
+        with self.condition:
+            actor = self.actors.get(room_name)
+            if actor is None:
+                return
+            if actor.scheduled:
+                actor.forgotten = True
+            else:
+                del self.actors[room_name]
+
+    def queue_delays(self):
+        """Return {room name: {"queued", "processed", "mean_delay", "max_delay", "errors"}}, delays in seconds."""
+        with self.condition:
+            return {room_name: actor.stats() for room_name, actor in self.actors.items()}
+
+    def join(self, timeout=None):
+        """Wait until every mailbox is empty, returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.busy, timeout)
+
+    def shutdown(self):
+        """Let the workers finish the queued calls and exit."""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
@@ -0,0 +1,222 @@
+import argparse
+import hmac
+import os
+import socket
+import sys
+import threading
+from protocol import MAX_MESSAGE_SIZE, MessageReader, encode_message
+from logconfig import get_logger
+
+log = get_logger("admin")
+
+# Local admin socket. Operators connect to a Unix socket only they can reach
+# and must also present the admin token. It runs profiling sessions on the
+# live server (see profiling.py) and returns metrics and the clients throttled
+# most by the rate limits. Requests and replies are JSON frames of the normal
+# wire protocol.
+#
+#   python admin.py --socket /run/connect4/admin.sock profile cprofile --seconds 10
+#   python admin.py --socket /run/connect4/admin.sock profile stacks --seconds 10 --stacks-file out.folded
+#   python admin.py --socket /run/connect4/admin.sock metrics
+#   python admin.py --socket /run/connect4/admin.sock throttled --top 20
+
+MAX_SECONDS = 300
+MAX_STACKS_BYTES = MAX_MESSAGE_SIZE // 2  # Leaves room for the report in the same frame
+MAX_TOP = 1000
+
+
+class AdminServer:
+    """Serves admin requests on a Unix socket, one thread per connection."""
+
+    def __init__(self, server, path, token):
+        self.server = server
+        self.path = path
+        self.token = token
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a server that did not shut down cleanly
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)  # Owner only, from the moment the socket exists
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(8)
+        self.running = True
+        threading.Thread(target=self.accept_connections, name="admin", daemon=True).start()
+        log.info(f"Admin socket listening on {path}")
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        reader = MessageReader(connection, codecs=["json"])
+        try:
+            while True:
+                messages = reader.read_messages()
+                if messages is None:
+                    break
+                for message in messages:
+                    connection.sendall(encode_message(self.handle_request(message)))
+        except Exception as e:
+            log.warning(f"Error handling admin connection: {e}")
+        finally:
+            connection.close()
+
+    def handle_request(self, message):
+        if not isinstance(message.get("Token"), str) or not hmac.compare_digest(message["Token"], self.token):
+            log.warning("Rejected admin request with a bad token")
+            return {"Command": "Error", "Error": "Bad token"}
+        command = message["Command"]
+        if command == "Profile":
+            return self.profile(message)
+        elif command == "Metrics":
+            return {"Command": "Metrics", "Text": self.server.metrics.render()}
+        elif command == "Throttled":
+            return self.throttled(message)
+        return {"Command": "Error", "Error": f"Unknown admin command {command}"}
+
+    def profile(self, message):
+        try:
+            seconds = float(message.get("Seconds", 10))
+            options = {
+                "top": int(message.get("Top", 25)),
+                "sample": float(message.get("Sample", 0.1)),
+                "interval": float(message.get("Interval", 0.005)),
+                "frames": int(message.get("Frames", 32)),
+                "all_threads": bool(message.get("All_Threads", False)),
+            }
+        except (TypeError, ValueError, OverflowError) as e:
+            return {"Command": "Error", "Error": f"Invalid profile option: {e}"}
+        if not 0 < seconds <= MAX_SECONDS:
+            return {"Command": "Error", "Error": f"Seconds must be between 0 and {MAX_SECONDS}"}
+        if (options["top"] < 1 or options["frames"] < 1 or not 0 < options["sample"] <= 1
+                or not options["interval"] > 0):
+            return {"Command": "Error", "Error": "Top and Frames must be at least 1, Sample in (0, 1] and Interval above 0"}
+        try:
+            result = self.server.profiler.profile(message.get("Mode", "cprofile"), seconds, **options)
+        except (RuntimeError, ValueError) as e:
+            return {"Command": "Error", "Error": str(e)}
+        stacks = result.get("Stacks")
+        if stacks and len(stacks.encode("utf-8")) > MAX_STACKS_BYTES:
+            # Lines are most common first, keep as many as fit in a frame
+            kept, size = [], 0
+            for line in stacks.split("\n"):
+                size += len(line.encode("utf-8")) + 1
+                if size > MAX_STACKS_BYTES:
+                    break
+                kept.append(line)
+            result["Stacks"] = "\n".join(kept)
+            result["Report"] += f"\n(stacks truncated to the {len(kept)} most common)"
+        return {"Command": "Profile_Result", "Mode": message.get("Mode", "cprofile"), **result}
+
+    def throttled(self, message):
+        try:
+            top = int(message.get("Top", 10))
+        except (TypeError, ValueError, OverflowError):
+            top = 0
+        if not 0 < top <= MAX_TOP:
+            return {"Command": "Error", "Error": f"Top must be between 1 and {MAX_TOP}"}
+        snapshot = self.server.rate_limits.snapshot(top)
+        return {
+            "Command": "Throttled",
+            "Throttled": snapshot["throttled"],
+            "By_Command": snapshot["by_command"],
+            "Top_Clients": snapshot["top_clients"],
+            "Disconnected": snapshot["disconnected"]
+        }
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.close()
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def request(path, message, timeout):
+    """Send one admin request and wait for its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(encode_message(message))
+        reader = MessageReader(sock, codecs=["json"])
+        messages = reader.read_messages()
+        if not messages:
+            raise ConnectionError("Server closed the admin connection")
+        return messages[0]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Admin client for a running Connect 4 server")
+    parser.add_argument("--socket", required=True, help="the server's --admin-socket path")
+    parser.add_argument("--token", default=os.environ.get("CONNECT4_ADMIN_TOKEN"),
+                        help="admin token (default: $CONNECT4_ADMIN_TOKEN)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    profile = commands.add_parser("profile", help="profile the server for a while and print the report")
+    profile.add_argument("mode", choices=["cprofile", "tracemalloc", "stacks"])
+    profile.add_argument("--seconds", type=float, default=10)
+    profile.add_argument("--top", type=int, default=25, help="functions, allocation sites or commands to show")
+    profile.add_argument("--sample", type=float, default=0.1, help="cprofile: fraction of commands to profile")
+    profile.add_argument("--interval", type=float, default=0.005, help="stacks: seconds of command time between samples")
+    profile.add_argument("--all-threads", action="store_true", help="stacks: include threads not running a command")
+    profile.add_argument("--frames", type=int, default=32, help="tracemalloc: frames kept per allocation")
+    profile.add_argument("--stacks-file", help="stacks: write collapsed stacks here, for flamegraph.pl or speedscope")
+
+    commands.add_parser("metrics", help="print the server's metrics")
+
+    throttled = commands.add_parser("throttled", help="print the rate-limited messages and the clients sending most")
+    throttled.add_argument("--top", type=int, default=10, help="clients to show")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.token:
+        sys.exit("An admin token is required, pass --token or set CONNECT4_ADMIN_TOKEN")
+    if args.command == "profile":
+        message = {
+            "Command": "Profile",
+            "Token": args.token,
+            "Mode": args.mode,
+            "Seconds": args.seconds,
+            "Top": args.top,
+            "Sample": args.sample,
+            "Interval": args.interval,
+            "All_Threads": args.all_threads,
+            "Frames": args.frames
+        }
+        reply = request(args.socket, message, args.seconds + 60)
+    elif args.command == "throttled":
+        reply = request(args.socket, {"Command": "Throttled", "Token": args.token, "Top": args.top}, 30)
+    else:
+        reply = request(args.socket, {"Command": "Metrics", "Token": args.token}, 30)
+
+    if reply["Command"] == "Error":
+        sys.exit(f"Error: {reply['Error']}")
+    if reply["Command"] == "Metrics":
+        print(reply["Text"], end="")
+        return
+    if reply["Command"] == "Throttled":
+        print(f"{reply['Throttled']} messages throttled, {reply['Disconnected']} clients disconnected for flooding")
+        for command, count in sorted(reply["By_Command"].items(), key=lambda item: -item[1]):
+            print(f"  {command:<20} {count:>8}")
+        print("Clients throttled most (by user, or by host before logging in):")
+        for client, count in reply["Top_Clients"]:
+            print(f"  {client:<20} {count:>8}")
+        return
+    print(reply["Report"])
+    if args.stacks_file and reply.get("Stacks"):
+        with open(args.stacks_file, "w") as stacks_file:
+            stacks_file.write(reply["Stacks"] + "\n")
+        print(f"Collapsed stacks written to {args.stacks_file}")
+
+
+if __name__ == "__main__":
+    main()
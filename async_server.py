@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from protocol import MessageDecoder
+from message_codecs import DEFAULT_CODEC
+from outbound import Backpressure, BackpressureState
+from logconfig import get_logger
+from server import ChatServer, log_received
+
+log = get_logger("async_server")
+
+
+class AsyncConnection:
+    """Socket-like wrapper so ChatServer can send through an asyncio transport.
+
+    The transport's write buffer plays the role of the outbound queue, so the
+    same watermarks apply as for the threaded engine's QueuedConnection.
+    Transports are not thread-safe, so sends from room worker threads are
+    handed to the event loop.
+    """
+
+    def __init__(self, transport, backpressure, server):
+        self.transport = transport
+        self.state = BackpressureState(backpressure)
+        self.server = server
+        self.last_seen = time.monotonic()  # Last time anything was read from the client
+        self.idle_timer = None
+        self.codec = DEFAULT_CODEC  # Codec the client negotiated for what we send it
+
+    @property
+    def active(self):
+        return not self.transport.is_closing()
+
+    @property
+    def queued_bytes(self):
+        return self.transport.get_write_buffer_size()
+
+    def sendall(self, data, droppable=False):
+        """Send or queue a frame, returns False if it was dropped.
+
+        Off the loop thread the frame is only handed to the loop and True is
+        returned; the loop makes the backpressure decision and counts the drop.
+        """
+        if threading.get_ident() != self.server.loop_thread:
+            self.server.loop.call_soon_threadsafe(self.write_later, data, droppable)
+            return True
+        return self.write(data, droppable)
+
+    def write_later(self, data, droppable):
+        """Send a frame handed over from another thread, counting it if dropped like send_frames does."""
+        if not self.write(data, droppable) and droppable:
+            self.server.metrics.frames_dropped.inc()
+
+    def write(self, data, droppable=False):
+        """Send from the loop thread."""
+        # transport.write never blocks, it buffers whatever the kernel won't take yet
+        queued_bytes = self.transport.get_write_buffer_size()
+        self.state.drained(queued_bytes)
+        decision = self.state.admit(queued_bytes, len(data), droppable)
+        if decision == Backpressure.DROP:
+            return False
+        if decision == Backpressure.EVICT:
+            log.warning("Evicting slow client", extra={"fields": {"addr": self.transport.get_extra_info("peername"), "queued_bytes": queued_bytes}})
+            self.transport.abort()
+            return False
+        self.transport.write(data)
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until the transport has written everything, returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.transport.is_closing() and self.transport.get_write_buffer_size():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def evict(self):
+        """Drop the connection; connection_lost() then cleans up the user."""
+        self.server.loop.call_soon_threadsafe(self.transport.abort)
+
+    def close(self):
+        if threading.get_ident() != self.server.loop_thread:
+            self.server.loop.call_soon_threadsafe(self.transport.close)
+        else:
+            self.transport.close()
+
+
+class ClientProtocol(asyncio.Protocol):
+    """Per-connection protocol that feeds decoded messages into the shared ChatServer logic."""
+
+    def __init__(self, server):
+        self.server = server
+        self.limiter = None
+        self.decoder = None
+        self.connection = None
+        self.transport = None
+        self.addr = None
+        self.username = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection = AsyncConnection(transport, self.server.backpressure, self.server)
+        self.addr = transport.get_extra_info("peername")
+        self.limiter = self.server.rate_limits.limiter(self.addr)
+        self.decoder = MessageDecoder(codecs=self.server.codecs, admit=self.limiter.allow)
+        log.info("New connection", extra={"fields": {"addr": self.addr}})
+        self.server.watch(self.connection)
+
+    def data_received(self, data):
+        self.connection.last_seen = time.monotonic()
+        try:
+            for message in self.decoder.feed(data):
+                if not message:
+                    continue
+                log_received(self.addr, message)
+                self.username = self.limiter.user = self.server.handle_message(self.connection, message,
+                                                                               self.username)
+        except Exception as e:
+            log.warning(f"Error handling client: {e}", extra={"fields": {"addr": self.addr, "user": self.username}})
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        log.info("Client disconnected", extra={"fields": {"addr": self.addr, "user": self.username}})
+        self.server.unwatch(self.connection)
+        self.server.client_disconnected(self.username, self.connection)
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer that serves every client from a single asyncio event loop.
+
+    Command handling is inherited unchanged from ChatServer; only the socket
+    I/O differs. Messages are decoded and dispatched on the loop thread, room
+    logic runs on the room actors' worker threads as in the threaded engine.
+    """
+
+    def init_server(self):
+        """Initialize the server socket and start the event loop in its own thread."""
+        self.open_server_socket()
+        self.loop = asyncio.new_event_loop()
+        self.loop_ready = threading.Event()
+        threading.Thread(target=self.run_loop).start()
+        self.loop_ready.wait()
+
+    def run_loop(self):
+        """Run the event loop until shutdown() stops it."""
+        asyncio.set_event_loop(self.loop)
+        self.loop_thread = threading.get_ident()
+        self.listener = self.loop.run_until_complete(
+            self.loop.create_server(lambda: ClientProtocol(self), sock=self.server_socket)
+        )
+        self.loop_ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def call_later(self, delay, callback):
+        """Run callback on the event loop after delay seconds."""
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def stop_accepting(self):
+        """Close the listener on the loop, leaving existing connections open."""
+        self.loop.call_soon_threadsafe(self.listener.close)
+
+    def shutdown(self):
+        """Stop the event loop, then close all connections."""
+        log.info("Shutting down server...")
+        self.stop_services()
+        self.loop.call_soon_threadsafe(self._close_all)
+
+    def _close_all(self):
+        for connection in list(self.connections):
+            connection.close()
+        self.listener.close()
+        self.loop.stop()
@@ -0,0 +1,898 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from protocol import MessageDecoder, encode_message
+
+# Benchmarks for the Connect 4 server. Run `python benchmark.py <name> --help`
+# for the options of each benchmark.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, *server_args):
+    """Start server.py in a subprocess and wait until it accepts connections."""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "server.py"), "--host", "127.0.0.1", "--port", str(port), *server_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+class BenchClient:
+    """Minimal asyncio client that speaks the real protocol and counts replies by command."""
+
+    def __init__(self, name):
+        self.name = name
+        self.decoder = MessageDecoder()
+        self.counts = collections.Counter()
+        self.changed = asyncio.Event()
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            for message in self.decoder.feed(data):
+                self.counts[message["Command"]] += 1
+            self.changed.set()
+
+    async def wait_for(self, command, count):
+        while self.counts[command] < count:
+            self.changed.clear()
+            await self.changed.wait()
+
+    def send(self, message):
+        self.writer.write(encode_message(message))
+
+    def close(self):
+        self.writer.close()
+
+
+async def run_engine_load(port, clients, messages):
+    """Connect clients, pair them into rooms and push Ready_Status traffic through the server."""
+    bots = [BenchClient(f"bot{i}") for i in range(clients)]
+
+    start = time.perf_counter()
+    for bot in bots:
+        await bot.connect(port)
+        bot.send({"Command": "Check_Username", "User_Name": bot.name})
+    await asyncio.gather(*(bot.wait_for("Check_Username", 1) for bot in bots))
+    connect_time = time.perf_counter() - start
+
+    for i, bot in enumerate(bots):
+        bot.send({"Command": "Join_Room", "Room_Name": f"room{i // 2}", "User_Name": bot.name})
+    await asyncio.gather(*(bot.wait_for("Join_Room", 1) for bot in bots))
+
+    # Both players in a room see each other's Ready_Update, so every send is
+    # delivered twice. Ready is always False so no game ever starts.
+    start = time.perf_counter()
+    for _ in range(messages):
+        for i, bot in enumerate(bots):
+            bot.send({"Command": "Ready_Status", "Room_Name": f"room{i // 2}",
+                      "User_Name": bot.name, "Ready": False})
+        await asyncio.sleep(0)
+    room_sizes = [2 if (i // 2) * 2 + 1 < clients else 1 for i in range(clients)]
+    await asyncio.gather(*(bot.wait_for("Ready_Update", messages * size) for bot, size in zip(bots, room_sizes)))
+    message_time = time.perf_counter() - start
+
+    for bot in bots:
+        bot.close()
+    return connect_time, message_time
+
+
+def run_server_load(args, *server_args):
+    """Start a server with server_args, run the standard load against it and return the timings."""
+    port = free_port()
+    process = start_server(port, "--no-rate-limit", *server_args)
+    try:
+        return asyncio.run(asyncio.wait_for(run_engine_load(port, args.clients, args.messages), args.timeout))
+    finally:
+        process.kill()
+        process.wait()
+
+
+def bench_engines(args):
+    """Compare connection and message throughput of the server engines."""
+    raise_file_limit()
+    print(f"{'engine':<10} {'clients':>8} {'connect/s':>12} {'msgs/s':>12} {'delivered/s':>12}")
+    for engine in args.engines:
+        connect_time, message_time = run_server_load(args, "--engine", engine)
+        sent = args.clients * args.messages
+        delivered = sent * 2 - (args.clients % 2) * args.messages
+        print(f"{engine:<10} {args.clients:>8} {args.clients / connect_time:>12.0f} "
+              f"{sent / message_time:>12.0f} {delivered / message_time:>12.0f}")
+
+
+def bench_logging(args):
+    """Compare message throughput with logging disabled, at the default level and at DEBUG.
+
+    The levels take turns for --repeats rounds, so a slow spell of the machine
+    hits all of them, and each is reported as the median of its runs with the
+    spread between its slowest and fastest.
+    """
+    raise_file_limit()
+    rates = {level: [] for level in args.levels}
+    for round_number in range(args.repeats):
+        for level in args.levels:
+            _, message_time = run_server_load(args, "--engine", args.engine, "--log-level", level)
+            rates[level].append(args.clients * args.messages / message_time)
+        print(f"round {round_number + 1}/{args.repeats}: "
+              + ", ".join(f"{level} {rates[level][-1]:.0f}" for level in args.levels), file=sys.stderr)
+    baseline = statistics.median(rates[args.levels[0]])
+    print(f"{'log level':<10} {'engine':<10} {'median msgs/s':>14} {'min':>8} {'max':>8} {'spread':>7} "
+          f"{'vs ' + args.levels[0]:>8}")
+    for level in args.levels:
+        median = statistics.median(rates[level])
+        spread = (max(rates[level]) - min(rates[level])) / median
+        print(f"{level:<10} {args.engine:<10} {median:>14.0f} {min(rates[level]):>8.0f} {max(rates[level]):>8.0f} "
+              f"{spread:>7.0%} {median / baseline:>7.2f}x")
+
+
+class NullConnection:
+    """Connection that discards what it is sent, so only server-side CPU is measured."""
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.codec = "json"
+
+    def sendall(self, data, droppable=False):
+        self.bytes_sent += len(data)
+
+
+def bench_fanout(args):
+    """Measure the cost of a full Room_State broadcast as the lobby grows, encoding per recipient vs once."""
+    from server import ChatServer
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server = ChatServer("127.0.0.1", 0)
+    print(f"{'clients':>8} {'rooms':>6} {'per-recipient ms':>17} {'encode-once ms':>15} {'speedup':>8}")
+    try:
+        for clients in args.clients:
+            server.clients = {f"user{i}": NullConnection() for i in range(clients)}
+            server.rooms = {f"room{i}": [] for i in range(args.rooms)}
+            message = {
+                "Command": "Room_State",
+                "Available_Rooms": server.available_rooms(),
+                "Users_In_Room": []
+            }
+
+            def per_recipient():
+                for connection in server.clients.values():
+                    connection.sendall(encode_message(message))
+
+            before = timeit.timeit(per_recipient, number=args.repeat) / args.repeat
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                after = timeit.timeit(lambda: server.send_room_state(list(server.clients.values())),
+                                      number=args.repeat) / args.repeat
+            print(f"{clients:>8} {args.rooms:>6} {before * 1000:>17.3f} {after * 1000:>15.3f} {before / after:>7.1f}x")
+    finally:
+        server.shutdown()
+
+
+def bench_flood(args):
+    """Chat flood from one client into a busy room: server work with and without rate limiting."""
+    from server import ChatServer
+    from logconfig import setup_logging
+    from ratelimit import FloodError, RateLimits
+    setup_logging("OFF")
+    frames = b"".join(encode_message({"Command": "Sending_Message", "Room_Name": "flood", "User_Name": "flooder",
+                                      "Text": f"spam {i}"}) for i in range(args.messages))
+    print(f"{'rate limit':<11} {'listeners':>9} {'sent':>7} {'handled':>8} {'broadcast MB':>13} {'ms':>8} "
+          f"{'flooder':>13}")
+    for limited in (False, True):
+        server = ChatServer("127.0.0.1", 0, rate_limits=RateLimits(enabled=limited))
+        server.call_later = lambda delay, callback: None  # Lobby updates are not under test
+        try:
+            connections = {name: NullConnection() for name in ["flooder"] + [f"user{i}" for i in range(args.listeners)]}
+            for name, connection in connections.items():
+                server.handle_message(connection, {"Command": "Check_Username", "User_Name": name}, None)
+                server.handle_message(connection, {"Command": "Join_Room", "Room_Name": "flood", "User_Name": name},
+                                      name)
+            for connection in connections.values():
+                connection.bytes_sent = 0
+            limiter = server.rate_limits.limiter("flooder")
+            decoder = MessageDecoder(admit=limiter.allow)
+            flooder = connections["flooder"]
+            handled, outcome = 0, "connected"
+            start = time.perf_counter()
+            try:
+                # Feed the flood a frame at a time, as it would arrive over the network
+                for offset in range(0, len(frames), 4096):
+                    for message in decoder.feed(frames[offset:offset + 4096]):
+                        server.handle_message(flooder, message, "flooder")
+                        handled += 1
+            except FloodError:
+                outcome = "disconnected"
+            elapsed = time.perf_counter() - start
+            broadcast = sum(connection.bytes_sent for connection in connections.values())
+        finally:
+            server.shutdown()
+        print(f"{'on' if limited else 'off':<11} {args.listeners:>9} {args.messages:>7} {handled:>8} "
+              f"{broadcast / 1e6:>13.2f} {elapsed * 1000:>8.1f} {outcome:>13}")
+
+
+def codec_samples(rooms):
+    """Typical messages, from the hot game commands to a full room list."""
+    return {
+        "Game_Move": {"Command": "Game_Move", "Room_Name": "room1", "User_Name": "alice", "Column": 3},
+        "Game_Update": {"Command": "Game_Update", "Room_Name": "room1", "Seq": 12, "Room_Seq": 57,
+                        "Move": {"player": "alice", "player_id": 0, "column": 3, "row": 2}},
+        "Ready_Status": {"Command": "Ready_Status", "Room_Name": "room1", "User_Name": "alice", "Ready": True},
+        "Ready_Update": {"Command": "Ready_Update", "Room_Name": "room1", "Ready_Users": {"alice": True, "bob": False},
+                         "Room_Seq": 58},
+        "Room_State": {"Command": "Room_State", "Available_Rooms": [f"room{i}" for i in range(rooms)],
+                       "Users_In_Room": []},
+    }
+
+
+def bench_codecs(args):
+    """Encode and decode cost and frame size of each codec for typical messages."""
+    print(f"{'message':<13} {'codec':<7} {'encode ns':>10} {'decode ns':>10} {'bytes':>6}")
+    for command, message in codec_samples(args.rooms).items():
+        for name in args.codecs:
+            decoder = MessageDecoder(codecs=[name])
+            frame = encode_message(message, name)
+            encode = timeit.timeit(lambda: encode_message(message, name), number=args.repeat) / args.repeat
+            decode = timeit.timeit(lambda: decoder.feed(frame), number=args.repeat) / args.repeat
+            assert decoder.feed(frame)[0]["Command"] == command
+            print(f"{command:<13} {name:<7} {encode * 1e9:>10.0f} {decode * 1e9:>10.0f} {len(frame):>6}")
+
+
+def bench_metrics(args):
+    """Cost of recording metrics on the hot path, and of rendering a scrape."""
+    from server import ChatServer
+    from logconfig import setup_logging
+    setup_logging("OFF")
+    server = ChatServer("127.0.0.1", 0)
+    metrics = server.metrics
+    try:
+        for name, record in [
+            ("handled", lambda: metrics.handled("Game_Move", 0.0002)),
+            ("room_call", lambda: metrics.room_call(0.0001, 0.0003)),
+            ("broadcast", lambda: metrics.broadcast("room", 2, 0.00005)),
+            ("counter", lambda: metrics.frames_dropped.inc()),
+        ]:
+            seconds = timeit.timeit(record, number=args.repeat) / args.repeat
+            print(f"{name:<10} {seconds * 1e9:>8.0f} ns/record")
+        seconds = timeit.timeit(metrics.render, number=100) / 100
+        print(f"{'scrape':<10} {seconds * 1e6:>8.0f} us, {len(metrics.render())} bytes")
+    finally:
+        server.shutdown()
+
+
+def bench_broker(args):
+    """Publish throughput and delivery latency of the local broker as the number of nodes grows."""
+    import tempfile
+    from broker import BrokerServer, LocalBroker
+    from logconfig import setup_logging
+    setup_logging("OFF")
+    print(f"{'nodes':>6} {'publishes/s':>12} {'deliveries/s':>13} {'p50 ms':>7} {'p99 ms':>7}")
+    for count in args.nodes:
+        path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+        server = BrokerServer(path)
+        latencies = []
+        done = threading.Event()
+        expected = args.messages * (count - 1)
+        lock = threading.Lock()
+
+        def received(message):
+            with lock:
+                latencies.append(time.perf_counter() - message["Sent"])
+                if len(latencies) == expected:
+                    done.set()
+
+        brokers = []
+        for index in range(count):
+            broker = LocalBroker(path, f"node{index}")
+            broker.subscribe("lobby", received)
+            broker.start()
+            brokers.append(broker)
+        start = time.perf_counter()
+        for i in range(args.messages):
+            brokers[0].publish("lobby", {"Kind": "Room", "Room_Name": f"room{i % 100}", "Occupancy": 1,
+                                         "Sent": time.perf_counter()})
+        done.wait(60)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print(f"{count:>6} {args.messages / elapsed:>12.0f} {len(latencies) / elapsed:>13.0f} "
+              f"{latencies[len(latencies) // 2] * 1000:>7.2f} {latencies[len(latencies) * 99 // 100] * 1000:>7.2f}")
+        for broker in brokers:
+            broker.close()
+        server.close()
+
+
+def scan_check_win(grid, player_id, rows=6, columns=7):
+    """The list-of-lists win check the game models used before rules.py, for comparison."""
+    for c in range(columns - 3):
+        for r in range(rows):
+            if grid[r][c] == player_id and grid[r][c+1] == player_id and grid[r][c+2] == player_id and grid[r][c+3] == player_id:
+                return True
+    for c in range(columns):
+        for r in range(rows - 3):
+            if grid[r][c] == player_id and grid[r+1][c] == player_id and grid[r+2][c] == player_id and grid[r+3][c] == player_id:
+                return True
+    for c in range(columns - 3):
+        for r in range(rows - 3):
+            if grid[r][c] == player_id and grid[r+1][c+1] == player_id and grid[r+2][c+2] == player_id and grid[r+3][c+3] == player_id:
+                return True
+    for c in range(columns - 3):
+        for r in range(3, rows):
+            if grid[r][c] == player_id and grid[r-1][c+1] == player_id and grid[r-2][c+2] == player_id and grid[r-3][c+3] == player_id:
+                return True
+    return False
+
+
+def random_games(count, seed, geometry=None):
+    """Move lists of random games played to the end."""
+    import rules
+    geometry = geometry or rules.STANDARD
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        position, moves = rules.Position(geometry), []
+        while True:
+            column = rng.choice([c for c in range(geometry.columns) if position.can_play(c)])
+            won = position.is_winning_move(column)
+            position.play(column)
+            moves.append(column)
+            if won or position.is_full():
+                break
+        games.append(moves)
+    return games
+
+
+def bench_rules(args):
+    """Win check and per-move cost of the bitboard rules against the old grid scans."""
+    import rules
+    games = random_games(args.games, args.seed)
+
+    def play_scan():
+        for moves in games:
+            grid = [[None] * 7 for _ in range(6)]
+            for turn, column in enumerate(moves):
+                for row in range(6):
+                    if grid[row][column] is None:
+                        grid[row][column] = turn % 2
+                        break
+                if scan_check_win(grid, turn % 2):
+                    break
+                if all(grid[5][c] is not None for c in range(7)):
+                    break
+
+    def play_bitboard():
+        for moves in games:
+            position = rules.Position()
+            for column in moves:
+                if not position.can_play(column):
+                    break
+                won = position.is_winning_move(column)
+                position.play(column)
+                if won or position.is_full():
+                    break
+
+    # Both must agree on every position before timing them
+    grids = []
+    by_fill = collections.defaultdict(list)  # Stones on the board // 10 -> (grid, position, next column)
+    for moves in games:
+        position, grid = rules.Position(), [[None] * 7 for _ in range(6)]
+        for turn, column in enumerate(moves):
+            by_fill[turn // 10].append(([row[:] for row in grid], position.copy(), column))
+            wins = position.is_winning_move(column)
+            grid[position.play(column)][column] = turn % 2
+            if wins != scan_check_win(grid, turn % 2):
+                sys.exit(f"Last-move win check disagrees on {moves[:turn + 1]}")
+            for player in (0, 1):
+                if scan_check_win(grid, player) != rules.alignment(position.stones(player)):
+                    sys.exit(f"Win checks disagree on {moves[:turn + 1]}")
+            grids.append(([row[:] for row in grid], position.stones(turn % 2)))
+
+    moves = sum(len(m) for m in games)
+    scan_check = timeit.timeit(lambda: [scan_check_win(grid, 0) for grid, _ in grids], number=args.repeat)
+    bit_check = timeit.timeit(lambda: [rules.alignment(stones) for _, stones in grids], number=args.repeat)
+    scan_move = timeit.timeit(play_scan, number=args.repeat)
+    bit_move = timeit.timeit(play_bitboard, number=args.repeat)
+    checks = len(grids) * args.repeat
+    print(f"{len(games)} random games, {moves} moves, results match")
+    print(f"{'':<12} {'grid scan':>10} {'bitboard':>10} {'speedup':>8}")
+    print(f"{'win check':<12} {scan_check / checks * 1e9:>8.0f}ns {bit_check / checks * 1e9:>8.0f}ns "
+          f"{scan_check / bit_check:>7.1f}x")
+    print(f"{'move':<12} {scan_move / (moves * args.repeat) * 1e9:>8.0f}ns "
+          f"{bit_move / (moves * args.repeat) * 1e9:>8.0f}ns {scan_move / bit_move:>7.1f}x")
+
+    def scan_move_at(grid, column):
+        row = next(r for r in range(6) if grid[r][column] is None)
+        return row, scan_check_win(grid, 0), all(grid[5][c] is not None for c in range(7))
+
+    def bit_move_at(position, column):
+        return position.can_play(column), position.is_winning_move(column), position.is_full()
+
+    print("per-move cost (find the row, check for a win and a full board) by stones on the board")
+    print(f"{'stones':<12} {'grid scan':>10} {'bitboard':>10}")
+    for fill, samples in sorted(by_fill.items()):
+        calls = len(samples) * args.repeat
+        scan = timeit.timeit(lambda: [scan_move_at(grid, column) for grid, _, column in samples], number=args.repeat)
+        bit = timeit.timeit(lambda: [bit_move_at(position, column) for _, position, column in samples],
+                            number=args.repeat)
+        print(f"{f'{fill * 10}-{fill * 10 + 9}':<12} {scan / calls * 1e9:>8.0f}ns {bit / calls * 1e9:>8.0f}ns")
+
+
+def parse_board(text):
+    """Parse ROWSxCOLUMNS/CONNECT, e.g. 9x7/5."""
+    import rules
+    size, _, connect = text.partition("/")
+    rows, _, columns = size.partition("x")
+    try:
+        return rules.Geometry(int(rows), int(columns), int(connect or rules.CONNECT))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"{text}: {e}")
+
+
+def bench_size(args):
+    """Per-move and whole-board win check cost of the bitboard rules as the board grows."""
+    import rules
+    print(f"{'board':<10} {'moves':>7} {'move ns':>8} {'check ns':>9} {'bits':>5}")
+    for geometry in args.boards:
+        games = random_games(args.games, args.seed, geometry)
+        # The last-move check must agree with a whole-board check before timing either
+        positions = []
+        for moves in games:
+            position = rules.Position(geometry)
+            for column in moves:
+                wins = position.is_winning_move(column)
+                position.play(column)
+                if wins != position.last_player_won():
+                    sys.exit(f"Win checks disagree on {geometry} after {moves}")
+                positions.append(position.stones((position.moves - 1) % 2))
+
+        def play():
+            for moves in games:
+                position = rules.Position(geometry)
+                for column in moves:
+                    won = position.is_winning_move(column)
+                    position.play(column)
+                    if won or position.is_full():
+                        break
+
+        moves = sum(len(m) for m in games)
+        move = timeit.timeit(play, number=args.repeat) / (moves * args.repeat)
+        check = timeit.timeit(lambda: [geometry.alignment(stones) for stones in positions],
+                              number=args.repeat) / (len(positions) * args.repeat)
+        board = f"{geometry.rows}x{geometry.columns}/{geometry.connect}"
+        print(f"{board:<10} {moves:>7} {move * 1e9:>8.0f} {check * 1e9:>9.0f} {geometry.h1 * geometry.columns:>5}")
+
+
+def bench_solver(args):
+    """Time to solve positions after a given number of moves, and the solver's nodes per second."""
+    import rules
+    from solver import Solver
+    games = [moves for moves in random_games(args.games * 20, args.seed) if len(moves) > max(args.moves) + 2]
+    print(f"{'moves':>6} {'positions':>10} {'mean s':>8} {'max s':>8} {'mean nodes':>11} {'nodes/s':>9}")
+    for played in args.moves:
+        solver = Solver(table_bits=args.table_bits)
+        positions = []
+        for moves in games:
+            position = rules.Position()
+            for column in moves[:played]:
+                position.play(column)
+            if not solver.search(position, max_depth=1).exact:  # Skip positions won or lost in one move
+                positions.append(position)
+            if len(positions) == args.games:
+                break
+        seconds, nodes = [], 0
+        for position in positions:
+            result = solver.search(position)
+            seconds.append(result.seconds)
+            nodes += result.nodes
+        print(f"{played:>6} {len(positions):>10} {sum(seconds) / len(positions):>8.3f} {max(seconds):>8.3f} "
+              f"{nodes / len(positions):>11.0f} {nodes / sum(seconds):>9.0f}")
+
+
+def bench_book(args):
+    """Opening book lookup time against searching the same positions."""
+    import tempfile
+    import book
+    from solver import Solver
+    path = args.book
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(), "bench.book")
+        start = time.perf_counter()
+        count = book.build(path, depth=args.depth, think=args.think)
+        print(f"built {count} positions to depth {args.depth} in {time.perf_counter() - start:.1f}s, "
+              f"{os.path.getsize(path)} bytes")
+    opening = book.OpeningBook(path)
+    # Both images of every position, so half the lookups are mirrored
+    positions = list(book.enumerate_positions(opening.geometry, opening.depth).values())
+    positions += [mirror_position(position) for position in positions]
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for position in positions:
+            assert opening.lookup(position) is not None
+    lookup = (time.perf_counter() - start) / (args.repeat * len(positions))
+    sample = positions[:args.searches]
+    solver = Solver()
+    start = time.perf_counter()
+    for position in sample:
+        solver.search(position, budget=args.think)
+    search = (time.perf_counter() - start) / len(sample)
+    print(f"{len(opening)} entries, {len(positions)} positions looked up")
+    print(f"book lookup {lookup * 1e6:.1f} us, search with --think {args.think}: {search * 1e3:.0f} ms")
+
+
+def mirror_position(position):
+    """The mirror image of a position."""
+    from book import mirror_key
+    image = position.copy()
+    image.current = mirror_key(position.current, position.geometry)
+    image.mask = mirror_key(position.mask, position.geometry)
+    image.heights.reverse()
+    return image
+
+
+def bench_timers(args):
+    """Show that timing wheel schedule, cancel and tick costs stay flat as the number of connections grows."""
+    from timers import TimingWheel
+    print(f"{'timers':>8} {'schedule ns':>12} {'cancel ns':>10} {'tick us':>8}")
+    for count in args.timers:
+        wheel = TimingWheel()
+        wheel.stop()  # advance() is called by hand below
+        delays = [random.uniform(1, 60) for _ in range(count)]  # Spread like idle checks
+        start = time.perf_counter()
+        timers = [wheel.schedule(delay, int) for delay in delays]
+        schedule = (time.perf_counter() - start) / count
+        # One tick looks at a single bucket, a full turn at all of them
+        start = time.perf_counter()
+        wheel.advance()
+        tick = time.perf_counter() - start
+        start = time.perf_counter()
+        for timer in timers:
+            wheel.cancel(timer)
+        cancel = (time.perf_counter() - start) / count
+        print(f"{count:>8} {schedule * 1e9:>12.0f} {cancel * 1e9:>10.0f} {tick * 1e6:>8.1f}")
+
+
+def bench_profile(args):
+    """Profile stacks on a server under loadgen traffic and check the session recorded samples."""
+    import tempfile
+    from admin import request
+    port = free_port()
+    admin_path = os.path.join(tempfile.mkdtemp(), "admin.sock")
+    server = start_server(port, "--admin-socket", admin_path, "--admin-token", "bench", "--log-level", "WARNING")
+    load = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "loadgen.py"), "--port", str(port), "--users", str(args.users),
+         "--games", "1000", "--think", str(args.think), "--chat-rate", "1", "--timeout", str(args.seconds + 30)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        time.sleep(args.warmup)  # Let every bot log in and start playing
+        reply = request(admin_path, {"Command": "Profile", "Token": "bench", "Mode": "stacks",
+                                     "Seconds": args.seconds, "Interval": args.interval}, args.seconds + 60)
+    finally:
+        load.terminate()
+        load.wait()
+        server.terminate()
+        server.wait()
+    print(reply.get("Report", reply))
+    samples = int(reply.get("Report", "0").split(" ", 1)[0])
+    if samples == 0:
+        print("FAIL no stack samples under load")
+        sys.exit(1)
+    print("OK")
+
+
+def stress_worker(server, name, room_name, operations, seed, errors):
+    """Drive one simulated client through games in its room, with leaves, quits and reconnects mixed in."""
+    rng = random.Random(seed)
+    connection = NullConnection()
+    username = server.handle_message(connection, {"Command": "Check_Username", "User_Name": name}, None)
+    in_room = False
+    # Like a real client, send Ready once per game, one move per turn and one
+    # restart per game, the room actor may not have handled the last one yet
+    ready_sent = None  # When Ready was sent, while no game has started since
+    moved = None  # (game, seq) of the last move sent
+    restarted = None  # Game of the last restart sent
+    try:
+        for _ in range(operations):
+            action = rng.random()
+            if not in_room:
+                server.handle_message(connection, {"Command": "Join_Room", "Room_Name": room_name, "User_Name": name}, username)
+                in_room = True
+                continue
+            game = server.games.get(room_name)
+            if game is not None:
+                ready_sent = None
+            if action < 0.02:
+                server.handle_message(connection, {"Command": "Sending_Message", "Room_Name": room_name,
+                                                   "User_Name": name, "Text": f"{name} has left the room."}, username)
+                in_room, ready_sent = False, None
+            elif action < 0.03:
+                server.handle_message(connection, {"Command": "Game_Quit", "Room_Name": room_name, "User_Name": name}, username)
+            elif action < 0.04:
+                # Disconnect and log in again
+                server.cleanup_client(username)
+                username = server.handle_message(connection, {"Command": "Check_Username", "User_Name": name}, None)
+                in_room, ready_sent = False, None
+            elif game is None:
+                # Ready again if a game started and was restarted unseen while we waited
+                if ready_sent is None or (time.monotonic() - ready_sent > 0.5 and
+                                          not server.ready_users.get(room_name, {}).get(name)):
+                    server.handle_message(connection, {"Command": "Ready_Status", "Room_Name": room_name,
+                                                       "User_Name": name, "Ready": True}, username)
+                    ready_sent = time.monotonic()
+                time.sleep(0.0005)  # Waiting for the opponent, as a client waits for a reply
+            elif game.game_over or action < 0.045:
+                if restarted is not game:
+                    restarted = game
+                    server.handle_message(connection, {"Command": "Restart_Game", "Room_Name": room_name,
+                                                       "User_Name": name}, username)
+            elif game.players[game.current_player] == name:
+                columns = [column for column in range(game.COLUMNS) if game.position.can_play(column)]
+                # Empty if the actor is between filling the board and ending the game
+                if columns and moved != (game, game.seq):
+                    moved = (game, game.seq)
+                    server.handle_message(connection, {"Command": "Game_Move", "Room_Name": room_name,
+                                                       "User_Name": name, "Column": rng.choice(columns)}, username)
+                else:
+                    time.sleep(0.0005)  # Waiting for the room actor to apply the move
+            elif action < 0.1:
+                # Out of turn, racing the opponent's move
+                server.handle_message(connection, {"Command": "Game_Move", "Room_Name": room_name,
+                                                   "User_Name": name, "Column": rng.randrange(game.COLUMNS)}, username)
+            elif action < 0.15:
+                server.handle_message(connection, {"Command": "Sending_Message", "Room_Name": room_name,
+                                                   "User_Name": name, "Text": "gg"}, username)
+            else:
+                time.sleep(0.0005)  # Waiting for the opponent's move
+    except Exception as e:
+        errors.append(f"{name}: {e!r}")
+
+
+def check_game(room_name, game):
+    """Return a list of inconsistencies between a game's board, position and move count."""
+    chips = sum(cell is not None for row in game.grid for cell in row)
+    if chips != game.seq or game.position.moves != game.seq:
+        return [f"{room_name}: {chips} chips on the board and {game.position.moves} in the position "
+                f"but seq is {game.seq}"]
+    return []
+
+
+def check_invariants(server):
+    """Return a list of inconsistencies between the server's rooms, ready flags and games."""
+    problems = []
+    for room_name, users in server.rooms.items():
+        if len(users) != len(set(users)):
+            problems.append(f"{room_name}: duplicate users {users}")
+        if not users:
+            problems.append(f"{room_name}: empty room left behind")
+        stray = set(server.ready_users.get(room_name, {})) - set(users)
+        if stray:
+            problems.append(f"{room_name}: ready flags for users not in the room {sorted(stray)}")
+    for room_name in server.ready_users:
+        if room_name not in server.rooms:
+            problems.append(f"{room_name}: ready flags for a deleted room")
+    for room_name, game in server.games.items():
+        if room_name not in server.rooms:
+            problems.append(f"{room_name}: game in a deleted room")
+        problems += check_game(room_name, game)
+    return problems
+
+
+def bench_stress(args):
+    """Hammer one in-process server from many threads and check its state stays consistent."""
+    from server import ChatServer
+    from logconfig import setup_logging
+
+    class CountingServer(ChatServer):
+        """Counts the games started and moves applied, and checks the board after every move.
+
+        The counts are kept per room, since each room's calls run under its lock.
+        """
+
+        def __init__(self, *args):
+            self.started = collections.Counter()
+            self.applied = collections.Counter()
+            self.problems = []
+            super().__init__(*args)
+
+        def handle_ready_status(self, room_name, username, ready):
+            game = self.games.get(room_name)
+            super().handle_ready_status(room_name, username, ready)
+            if self.games.get(room_name) not in (None, game):
+                self.started[room_name] += 1
+
+        def handle_game_move(self, room_name, username, column):
+            game = self.games.get(room_name)
+            seq = game.seq if game else None
+            super().handle_game_move(room_name, username, column)
+            if game is not None and game.seq != seq:
+                self.applied[room_name] += 1
+                self.problems += check_game(room_name, game)
+
+    setup_logging("OFF")
+    sys.setswitchinterval(args.switch_interval)  # Switch threads often to shake out races
+    server = CountingServer("127.0.0.1", 0)
+    server.call_later = lambda delay, callback: None  # Lobby updates are not under test
+    errors = []
+    try:
+        # Two users per room, so games start and both players move concurrently
+        threads = [
+            threading.Thread(target=stress_worker,
+                             args=(server, f"user{i}", f"room{i // 2}", args.operations, args.seed + i, errors))
+            for i in range(args.threads)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.actors.join()
+        elapsed = time.perf_counter() - start
+        delays = server.actors.queue_delays()
+    finally:
+        server.shutdown()
+
+    if server.actors.errors:
+        errors.append(f"{server.actors.errors} calls raised in room actors")
+    problems = errors + server.problems[:10] + check_invariants(server)
+    games, moves = sum(server.started.values()), sum(server.applied.values())
+    min_moves = args.min_moves if args.min_moves is not None else args.threads * args.operations // 50
+    if moves < min_moves:
+        problems.append(f"only {moves} moves applied, fewer than the minimum of {min_moves}")
+    total = args.threads * args.operations
+    print(f"{args.threads} threads, {(args.threads + 1) // 2} rooms, {total} operations in {elapsed:.2f}s "
+          f"({total / elapsed:.0f} ops/s)")
+    print(f"{games} games started, {moves} moves applied")
+    print(f"{len(server.rooms)} rooms, {len(server.games)} games left")
+    if delays:
+        worst = max(stats["max_delay"] for stats in delays.values())
+        processed = sum(stats["processed"] for stats in delays.values())
+        mean = sum(stats["mean_delay"] * stats["processed"] for stats in delays.values()) / max(processed, 1)
+        print(f"room actor queueing delay: mean {mean * 1000:.3f}ms, max {worst * 1000:.3f}ms over {processed} calls")
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if problems:
+        sys.exit(1)
+    print("OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect 4 server benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    engines = subparsers.add_parser("engines", help="threaded vs asyncio server engine throughput")
+    engines.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    engines.add_argument("--clients", type=int, default=200)
+    engines.add_argument("--messages", type=int, default=100, help="Ready_Status messages per client")
+    engines.add_argument("--timeout", type=float, default=300, help="give up after this many seconds per engine")
+    engines.set_defaults(func=bench_engines)
+
+    logs = subparsers.add_parser("logging", help="message throughput with logging off, at INFO and at DEBUG")
+    logs.add_argument("--levels", nargs="+", default=["OFF", "INFO", "DEBUG"])
+    logs.add_argument("--engine", default="threaded")
+    logs.add_argument("--clients", type=int, default=100)
+    logs.add_argument("--messages", type=int, default=400, help="Ready_Status messages per client")
+    logs.add_argument("--repeats", type=int, default=5, help="runs per level; the median is reported")
+    logs.add_argument("--timeout", type=float, default=300, help="give up after this many seconds per run")
+    logs.set_defaults(func=bench_logging)
+
+    fanout = subparsers.add_parser("fanout", help="lobby broadcast cost vs number of connected clients")
+    fanout.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    fanout.add_argument("--rooms", type=int, default=50)
+    fanout.add_argument("--repeat", type=int, default=20)
+    fanout.set_defaults(func=bench_fanout)
+
+    flood = subparsers.add_parser("flood", help="chat flood into a busy room with and without rate limiting")
+    flood.add_argument("--listeners", type=int, default=50)
+    flood.add_argument("--messages", type=int, default=5000)
+    flood.set_defaults(func=bench_flood)
+
+    codecs = subparsers.add_parser("codecs", help="encode/decode ns per message and frame size for each codec")
+    codecs.add_argument("--codecs", nargs="+", default=["pickle", "json", "binary"])
+    codecs.add_argument("--rooms", type=int, default=50, help="rooms in the sample Room_State")
+    codecs.add_argument("--repeat", type=int, default=20000)
+    codecs.set_defaults(func=bench_codecs)
+
+    metrics = subparsers.add_parser("metrics", help="cost of recording a metric and of a scrape")
+    metrics.add_argument("--repeat", type=int, default=200000)
+    metrics.set_defaults(func=bench_metrics)
+
+    broker = subparsers.add_parser("broker", help="local broker publish throughput and latency vs number of nodes")
+    broker.add_argument("--nodes", type=int, nargs="+", default=[2, 4, 8])
+    broker.add_argument("--messages", type=int, default=20000)
+    broker.set_defaults(func=bench_broker)
+
+    rules = subparsers.add_parser("rules", help="bitboard win checks and moves vs the old grid scans")
+    rules.add_argument("--games", type=int, default=200)
+    rules.add_argument("--repeat", type=int, default=5)
+    rules.add_argument("--seed", type=int, default=0)
+    rules.set_defaults(func=bench_rules)
+
+    size = subparsers.add_parser("size", help="bitboard cost per move and per whole-board check vs board size")
+    size.add_argument("--boards", nargs="+", type=parse_board,
+                      default=[parse_board(board) for board in ("6x7/4", "7x8/4", "9x7/4", "9x7/5", "12x12/5", "16x16/6")],
+                      help="ROWSxCOLUMNS/CONNECT")
+    size.add_argument("--games", type=int, default=200)
+    size.add_argument("--repeat", type=int, default=5)
+    size.add_argument("--seed", type=int, default=1)
+    size.set_defaults(func=bench_size)
+
+    solver = subparsers.add_parser("solver", help="time to solve positions after N moves and nodes per second")
+    solver.add_argument("--moves", nargs="+", type=int, default=[24, 20, 16], help="moves played before solving")
+    solver.add_argument("--games", type=int, default=5, help="positions solved per move count")
+    solver.add_argument("--table-bits", type=int, default=20)
+    solver.add_argument("--seed", type=int, default=1)
+    solver.set_defaults(func=bench_solver)
+
+    book = subparsers.add_parser("book", help="opening book lookup time vs searching the same positions")
+    book.add_argument("--book", help="book file to read; by default a small one is built first")
+    book.add_argument("--depth", type=int, default=3, help="plies covered by the built book")
+    book.add_argument("--think", type=float, default=0.05, help="seconds of search per position")
+    book.add_argument("--repeat", type=int, default=20)
+    book.add_argument("--searches", type=int, default=20, help="positions searched for comparison")
+    book.set_defaults(func=bench_book)
+
+    timers = subparsers.add_parser("timers", help="timing wheel cost per operation vs number of timers")
+    timers.add_argument("--timers", type=int, nargs="+", default=[1000, 10000, 100000])
+    timers.set_defaults(func=bench_timers)
+
+    profile = subparsers.add_parser("profile", help="stack profiling under loadgen traffic records samples")
+    profile.add_argument("--users", type=int, default=200, help="loadgen bots")
+    profile.add_argument("--think", type=float, default=0.05, help="mean seconds a bot thinks before each move")
+    profile.add_argument("--seconds", type=float, default=5, help="length of the profiling session")
+    profile.add_argument("--interval", type=float, default=0.005, help="seconds of command time between samples")
+    profile.add_argument("--warmup", type=float, default=3)
+    profile.set_defaults(func=bench_profile)
+
+    stress = subparsers.add_parser("stress", help="concurrent joins, leaves and moves with an invariant check")
+    stress.add_argument("--threads", type=int, default=32, help="simulated clients, two per room")
+    stress.add_argument("--operations", type=int, default=2000, help="operations per thread")
+    stress.add_argument("--seed", type=int, default=0)
+    stress.add_argument("--min-moves", type=int,
+                        help="fail unless at least this many moves were applied (default: one per 50 operations)")
+    stress.add_argument("--switch-interval", type=float, default=1e-6, help="sys.setswitchinterval() during the run")
+    stress.set_defaults(func=bench_stress)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
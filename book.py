@@ -0,0 +1,213 @@
+import argparse
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import rules
+from solver import Solver
+
+# Opening book: the solver's answers for every position of the first few
+# plies, computed offline and looked up at runtime instead of searched.
+#
+# The builder enumerates all positions up to --depth plies, keeps one of each
+# pair of mirror images, searches each for --think seconds (positions the
+# search proves are marked exact) and writes them to a file sorted by
+# position key:
+#
+#   header   magic "C4BK", version, rows, columns, connect, key bytes, depth, entries
+#   entries  key (big-endian), score (signed 16-bit), column (byte), flags (byte)
+#
+# At runtime the file is memory-mapped and searched by bisection, so every
+# server process shares one copy in the page cache and a lookup reads about
+# log2(entries) keys. A position's key is its mirror image's if that is
+# smaller, and the column is mirrored back on the way out.
+#
+#   python book.py --output opening.book --depth 4 --think 5 --jobs 4
+
+MAGIC = b"C4BK"
+VERSION = 2  # Version 1 stored scores in a byte, too small for the largest boards
+HEADER = struct.Struct(">4sBBBBBBI")  # magic, version, rows, columns, connect, key bytes, depth, entries
+ENTRY = struct.Struct(">hBB")  # Score, column and flags, after the key
+EXACT_FLAG = 1
+
+
+class BookEntry:
+    """What the book knows about a position."""
+
+    __slots__ = ("column", "score", "exact")
+
+    def __init__(self, column, score, exact):
+        self.column = column
+        self.score = score
+        self.exact = exact  # Proven, otherwise the best the builder found in its time
+
+    def __repr__(self):
+        return f"BookEntry(column={self.column}, score={self.score}, exact={self.exact})"
+
+
+def key_bytes(geometry):
+    return (geometry.h1 * geometry.columns + 7) // 8
+
+
+def position_key(position):
+    """Key of a position, unique for a geometry: the stones to move plus the occupied cells."""
+    return position.current + position.mask
+
+
+def mirror_key(key, geometry):
+    """Key of the position's mirror image; a key never carries from one column into the next."""
+    h1 = geometry.h1
+    column_bits = (1 << h1) - 1
+    mirrored = 0
+    for column in range(geometry.columns):
+        mirrored |= ((key >> (column * h1)) & column_bits) << ((geometry.columns - 1 - column) * h1)
+    return mirrored
+
+
+def canonical(position):
+    """Return the smaller of the position's key and its mirror's, and whether it is the mirror's."""
+    key = position_key(position)
+    mirrored = mirror_key(key, position.geometry)
+    return (mirrored, True) if mirrored < key else (key, False)
+
+
+class OpeningBook:
+    """A book file, memory-mapped and searched in place; safe to share between threads."""
+
+    def __init__(self, path):
+        with open(path, "rb") as book_file:
+            self.data = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, rows, columns, connect, self.key_size, self.depth, self.entries = \
+            HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} opening book")
+        self.geometry = rules.Geometry(rows, columns, connect)
+        self.record_size = self.key_size + ENTRY.size
+        if len(self.data) != HEADER.size + self.entries * self.record_size:
+            raise ValueError(f"{path} is truncated")
+
+    def __len__(self):
+        return self.entries
+
+    def lookup(self, position):
+        """Return the BookEntry for a position, or None if the book does not have it."""
+        if position.geometry != self.geometry or position.moves > self.depth:
+            return None
+        key, mirrored = canonical(position)
+        target = key.to_bytes(self.key_size, "big")  # Big-endian bytes compare like the numbers
+        data, size, key_size = self.data, self.record_size, self.key_size
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * size
+            probe = data[offset:offset + key_size]
+            if probe < target:
+                low = middle + 1
+            elif probe > target:
+                high = middle
+            else:
+                score, column, flags = ENTRY.unpack_from(data, offset + key_size)
+                if mirrored:
+                    column = self.geometry.columns - 1 - column
+                return BookEntry(column, score, bool(flags & EXACT_FLAG))
+        return None
+
+    def close(self):
+        self.data.close()
+
+
+def enumerate_positions(geometry, depth):
+    """All positions of up to depth plies with the game still going, one of each mirror pair."""
+    layer = {canonical(rules.Position(geometry))[0]: rules.Position(geometry)}
+    positions = dict(layer)
+    for _ in range(depth):
+        next_layer = {}
+        for position in layer.values():
+            for column in range(geometry.columns):
+                if not position.can_play(column) or position.is_winning_move(column):
+                    continue
+                child = position.copy()
+                child.play(column)
+                if child.is_full():
+                    continue
+                key = canonical(child)[0]
+                if key not in next_layer:
+                    next_layer[key] = child
+        positions.update(next_layer)
+        layer = next_layer
+    return positions
+
+
+# Each builder process keeps one solver, and its table, for all its positions
+_solver = None
+
+
+def _init_worker(table_bits):
+    global _solver
+    _solver = Solver(table_bits=table_bits)
+
+
+def _search(job):
+    key, position, think = job
+    result = _solver.search(position, budget=think)
+    return key, result.column, result.score, result.exact
+
+
+def build(path, geometry=rules.STANDARD, depth=4, think=2.0, jobs=1, table_bits=20, progress=None):
+    """Search every position of the first depth plies and write the book to path."""
+    positions = enumerate_positions(geometry, depth)
+    # Deepest first, so the shallow positions find their children in the table
+    work = [(key, position, think) for key, position in
+            sorted(positions.items(), key=lambda item: -item[1].moves)]
+    records = []
+    context = multiprocessing.get_context("fork")
+    with context.Pool(jobs, initializer=_init_worker, initargs=(table_bits,)) as pool:
+        for key, column, score, exact in pool.imap_unordered(_search, work, chunksize=4):
+            if canonical(positions[key])[1]:  # Searched as found, stored as its canonical image
+                column = geometry.columns - 1 - column
+            records.append((key, column, score, exact))
+            if progress:
+                progress(len(records), len(work))
+    records.sort()
+    size = key_bytes(geometry)
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as book_file:
+        book_file.write(HEADER.pack(MAGIC, VERSION, geometry.rows, geometry.columns, geometry.connect, size, depth,
+                                    len(records)))
+        for key, column, score, exact in records:
+            book_file.write(key.to_bytes(size, "big"))
+            book_file.write(ENTRY.pack(score, column, EXACT_FLAG if exact else 0))
+    os.replace(temporary, path)  # Readers never see a half-written book
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a Connect 4 opening book")
+    parser.add_argument("--output", required=True, help="book file to write")
+    parser.add_argument("--depth", type=int, default=4, help="plies covered by the book")
+    parser.add_argument("--think", type=float, default=2.0, help="seconds of search per position")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="positions searched in parallel")
+    parser.add_argument("--table-bits", type=int, default=20, help="transposition table size per job, as a power of two")
+    parser.add_argument("--rows", type=int, default=rules.ROWS)
+    parser.add_argument("--columns", type=int, default=rules.COLUMNS)
+    parser.add_argument("--connect", type=int, default=rules.CONNECT)
+    args = parser.parse_args()
+    try:
+        geometry = rules.Geometry(args.rows, args.columns, args.connect)
+    except ValueError as e:
+        parser.error(str(e))
+    started = time.perf_counter()
+
+    def progress(done, total):
+        if done % 100 == 0 or done == total:
+            print(f"{done}/{total} positions, {time.perf_counter() - started:.0f}s", file=sys.stderr)
+
+    count = build(args.output, geometry, args.depth, args.think, args.jobs, args.table_bits, progress)
+    print(f"Wrote {count} positions to {args.output} ({os.path.getsize(args.output)} bytes) "
+          f"in {time.perf_counter() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import collections
+import threading
+from book import OpeningBook
+from solver import Solver
+from logconfig import get_logger
+
+log = get_logger("bots")
+
+# Bot seats. A player alone in a room can seat the computer as the second
+# player with Add_Bot. The bot is a room member named BOT_NAME that is always
+# ready, so the game starts as soon as the human is ready too, and it leaves
+# with the last human.
+#
+# Searching takes far longer than any other room call, so it does not run on
+# the room actors. When it is the bot's turn, the room hands a copy of the
+# position to the BotPlayer's own threads, each with its own solver and
+# transposition table, and the chosen move comes back to the room actor like
+# a player's move. A move for a game that was restarted or ended meanwhile is
+# dropped.
+#
+# With an opening book (book.py) the early moves come straight from the
+# book's memory-mapped file, which all worker threads and server processes
+# share.
+
+BOT_NAME = "Computer"
+
+
+class BotSettings:
+    """How long the bot thinks per move and the resources its search may use."""
+
+    def __init__(self, think=1.0, workers=1, table_bits=20, book=None):
+        self.think = think  # Seconds of search per move
+        self.workers = workers  # Bot moves searched at the same time, over all rooms
+        self.table_bits = table_bits  # Transposition table slots per worker, as a power of two
+        self.book = book  # Path of an opening book file
+
+
+class BotPlayer:
+    """Searches the bot's moves for every room with a bot seat."""
+
+    def __init__(self, server, settings=None):
+        self.server = server
+        self.settings = settings or BotSettings()
+        self.jobs = collections.deque()  # (room name, game, seq, position)
+        self.condition = threading.Condition()
+        self.running = True
+        self.threads = []  # Started with the first bot move, each table takes tens of megabytes
+        # Mapped in the process that plays, so forked workers each map it after fork
+        self.book = OpeningBook(self.settings.book) if self.settings.book else None
+
+    def request_move(self, room_name, game):
+        """Search a move for the bot in game, which must be the bot's turn; called with the room's lock held."""
+        with self.condition:
+            if not self.threads:
+                self.threads = [threading.Thread(target=self.work, name=f"bot-{i}", daemon=True)
+                                for i in range(self.settings.workers)]
+                for thread in self.threads:
+                    thread.start()
+            self.jobs.append((room_name, game, game.seq, game.position.copy()))
+            self.condition.notify()
+
+    def work(self):
+        solver = Solver(table_bits=self.settings.table_bits, book=self.book)
+        while True:
+            with self.condition:
+                while not self.jobs and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                room_name, game, seq, position = self.jobs.popleft()
+            try:
+                result = solver.search(position, budget=self.settings.think)
+            except Exception:
+                log.exception("Bot search failed", extra={"fields": {"room": room_name}})
+                continue
+            log.debug("Bot move", extra={"fields": {
+                "room": room_name, "column": result.column, "score": result.score, "depth": result.depth,
+                "exact": result.exact, "nodes": result.nodes, "nodes_per_second": round(result.nodes_per_second)
+            }})
+            self.server.metrics.bot_search(result)
+            self.server.run_in_room(room_name, self.server.handle_bot_move, game, seq, result.column)
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
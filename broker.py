@@ -0,0 +1,253 @@
+import argparse
+import collections
+import os
+import signal
+import socket
+import threading
+from protocol import MessageReader, encode_message
+from logconfig import get_logger, setup_logging, stop_logging, LEVELS
+
+log = get_logger("broker")
+
+# Publish/subscribe between the nodes of a multi-node deployment (see
+# cluster.py). Nodes only share lobby state through it: which rooms exist,
+# how full they are and which users are online. Games and chat never leave
+# the node that owns the room.
+#
+# Broker is the interface the nodes use. LocalBroker talks to a BrokerServer
+# over a Unix socket, which is enough to run several nodes on one machine
+# without any outside service; a broker for nodes on several machines only
+# needs to implement the same three methods.
+#
+#   python broker.py --socket /tmp/connect4-broker.sock
+#
+# Messages from one publisher reach each subscriber in the order they were
+# published. The broker also publishes Node_Joined and Node_Left on the
+# "nodes" topic, so nodes can resend their state to a newcomer and forget the
+# state of a node that went away.
+
+NODES_TOPIC = "nodes"
+
+
+class Broker:
+    """Interface between a node and the other nodes."""
+
+    def subscribe(self, topic, callback):
+        """Call callback(message) for every message published on topic by another node."""
+        raise NotImplementedError
+
+    def publish(self, topic, message):
+        """Send a message to the nodes subscribed to topic; returns False if it could not be sent."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalBroker(Broker):
+    """Client of a BrokerServer on a Unix socket, reconnecting if the broker restarts.
+
+    Subscribe to every topic before start(). on_connect runs after each
+    (re)connection, which is where a node republishes its state, since
+    anything published while disconnected is dropped.
+    """
+
+    def __init__(self, path, node, retry=1.0):
+        self.path = path
+        self.node = node
+        self.retry = retry
+        self.callbacks = {}  # Topic -> callback
+        self.on_connect = None
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.running = False
+        self.connected = threading.Event()
+
+    def subscribe(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def start(self, on_connect=None, timeout=5.0):
+        """Connect in the background; waits up to timeout for the first connection."""
+        self.on_connect = on_connect
+        self.running = True
+        threading.Thread(target=self.run, name="broker", daemon=True).start()
+        if not self.connected.wait(timeout):
+            log.warning(f"Broker at {self.path} not reachable yet, retrying in the background")
+
+    def run(self):
+        while self.running:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                sock.sendall(encode_message({"Command": "Hello", "Node": self.node, "Topics": list(self.callbacks)}))
+            except OSError as e:
+                sock.close()
+                log.debug(f"Cannot reach broker: {e}")
+                threading.Event().wait(self.retry)
+                continue
+            with self.send_lock:
+                self.sock = sock
+            log.info(f"Connected to broker at {self.path}", extra={"fields": {"node": self.node}})
+            self.connected.set()
+            if self.on_connect:
+                self.on_connect()
+            self.read_messages(sock)
+            with self.send_lock:
+                self.sock = None
+            sock.close()
+            if self.running:
+                log.warning("Lost the broker connection, reconnecting", extra={"fields": {"node": self.node}})
+                threading.Event().wait(self.retry)
+
+    def read_messages(self, sock):
+        reader = MessageReader(sock, codecs=["json"])
+        while True:
+            try:
+                messages = reader.read_messages()
+            except OSError:
+                return
+            if messages is None:
+                return
+            for message in messages:
+                callback = self.callbacks.get(message.get("Topic"))
+                if callback is None:
+                    continue
+                try:
+                    callback(message["Message"])
+                except Exception as e:
+                    log.exception(f"Error handling broker message on {message['Topic']}: {e}")
+
+    def publish(self, topic, message):
+        frame = encode_message({"Command": "Publish", "Topic": topic, "Message": message})
+        with self.send_lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                return False  # The reader notices and reconnects
+        return True
+
+    def close(self):
+        self.running = False
+        with self.send_lock:
+            if self.sock is not None:
+                self.sock.shutdown(socket.SHUT_RDWR)
+
+
+class BrokerServer:
+    """Fans published messages out to the subscribers of their topic, one thread per node."""
+
+    def __init__(self, path):
+        self.path = path
+        self.topics = collections.defaultdict(set)  # Topic -> subscribed connections
+        self.nodes = {}  # Connection -> node name
+        self.send_locks = {}  # Connection -> lock, since every publisher's thread writes to it
+        self.published = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a broker that did not shut down cleanly
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)  # Only the user running the nodes may connect
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(64)
+        self.running = True
+        threading.Thread(target=self.accept_connections, name="broker-accept", daemon=True).start()
+        log.info(f"Broker listening on {path}")
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                break
+            with self.lock:
+                self.send_locks[connection] = threading.Lock()
+            threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        reader = MessageReader(connection, codecs=["json"])
+        try:
+            while True:
+                messages = reader.read_messages()
+                if messages is None:
+                    break
+                for message in messages:
+                    self.handle_message(connection, message)
+        except Exception as e:
+            log.warning(f"Error handling broker connection: {e}")
+        finally:
+            self.drop(connection)
+
+    def handle_message(self, connection, message):
+        command = message["Command"]
+        if command == "Publish":
+            self.publish(message["Topic"], message["Message"], connection)
+        elif command == "Hello":
+            with self.lock:
+                self.nodes[connection] = message["Node"]
+                for topic in message.get("Topics", ()):
+                    self.topics[topic].add(connection)
+            log.info("Node connected", extra={"fields": {"node": message["Node"]}})
+            self.publish(NODES_TOPIC, {"Kind": "Node_Joined", "Node": message["Node"]}, connection)
+        elif command == "Subscribe":
+            with self.lock:
+                self.topics[message["Topic"]].add(connection)
+
+    def publish(self, topic, message, sender=None):
+        frame = encode_message({"Command": "Message", "Topic": topic, "Message": message})
+        with self.lock:
+            self.published += 1
+            targets = [(c, self.send_locks[c]) for c in self.topics.get(topic, ()) if c is not sender]
+        for connection, send_lock in targets:
+            try:
+                with send_lock:
+                    connection.sendall(frame)
+            except OSError:
+                pass  # Its own thread drops it
+
+    def drop(self, connection):
+        with self.lock:
+            node = self.nodes.pop(connection, None)
+            for subscribers in self.topics.values():
+                subscribers.discard(connection)
+            self.send_locks.pop(connection, None)
+        connection.close()
+        if node is not None:
+            log.info("Node disconnected", extra={"fields": {"node": node}})
+            self.publish(NODES_TOPIC, {"Kind": "Node_Left", "Node": node})
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.close()
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local pub/sub broker for a multi-node Connect 4 server")
+    parser.add_argument("--socket", default="/tmp/connect4-broker.sock", help="Unix socket to listen on")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="INFO")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_logging(args.log_level)
+    broker = BrokerServer(args.socket)
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    stopped.wait()
+    log.info(f"Broker stopping after {broker.published} messages")
+    broker.close()
+    stop_logging()
+
+
+if __name__ == "__main__":
+    main()
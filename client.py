@@ -1,30 +1,40 @@
 import sys
-import pickle
 import threading
 import socket
 import errno
+import time
 import pygame
 from PyQt5.QtWidgets import QSizePolicy, QApplication, QWidget, QVBoxLayout, QTextEdit, QPushButton, QLineEdit, QLabel, QComboBox, QMainWindow, QHBoxLayout, QListWidget, QMessageBox
 from PyQt5.QtCore import Qt, QEvent, QCoreApplication, QTimer
 from PyQt5.QtGui import QColor
+from protocol import MessageReader, FramingError, encode_message
+from message_codecs import DEFAULT_CODEC
+import rules
+
+# Codecs this client speaks, in order of preference
+CLIENT_CODECS = ["binary", "json"]
+
+# Board variants offered when creating a room, as (rows, columns, connect)
+BOARD_VARIANTS = [(6, 7, 4), (7, 8, 4), (9, 7, 4), (9, 7, 5), (8, 10, 5)]
+
+# Space the board may take up in the game window
+BOARD_AREA_WIDTH = 525
+BOARD_AREA_HEIGHT = 450
 
 class Connect4GameUI:
     def __init__(self, parent):
         self.parent = parent
-        self.CHIP_SIZE = 60
         self.OFFSET = 40
-        self.CHIP_OFFSET = 15
-        self.BOARD_HEIGHT = 450
-        self.CHIP_RADIUS = int(self.CHIP_SIZE / 2)
-        self.ROWS = 6
-        self.COLUMNS = 7
+        self.set_geometry(rules.STANDARD)
         self.grid = [[None for i in range(self.COLUMNS)] for j in range(self.ROWS)]
+        self.position = rules.Position()  # Same board as self.grid, for checking moves
         self.current_player_id = 0
         self.players = []
         self.game_over = False
         self.winner = None
         self.my_player_id = None
         self.end_game = False
+        self.seq = 0  # Sequence number of the last move applied to self.grid
         
         # Initialize pygame
         pygame.init()
@@ -39,6 +49,31 @@ class Connect4GameUI:
         self.running = True
         self.my_turn = False
         
+    def set_geometry(self, geometry):
+        """Size the chips so a board of this geometry fits the window"""
+        self.geometry = geometry
+        self.ROWS = geometry.rows
+        self.COLUMNS = geometry.columns
+        pitch = min(75, BOARD_AREA_WIDTH // self.COLUMNS, BOARD_AREA_HEIGHT // self.ROWS)
+        self.CHIP_SIZE = pitch * 4 // 5
+        self.CHIP_OFFSET = pitch - self.CHIP_SIZE
+        self.CHIP_RADIUS = int(self.CHIP_SIZE / 2)
+        self.BOARD_HEIGHT = self.OFFSET + self.CHIP_RADIUS + (self.ROWS - 1) * pitch + 5
+
+    def load_geometry(self, game_state):
+        """Take the board size and line length from the server's game state"""
+        grid = game_state["grid"]
+        geometry = rules.Geometry(game_state.get("rows", len(grid)), game_state.get("columns", len(grid[0])),
+                                  game_state.get("connect", rules.CONNECT))
+        if geometry != self.geometry:
+            self.set_geometry(geometry)
+
+    def column_at(self, x):
+        """Column under a horizontal window position, or None"""
+        pitch = self.CHIP_SIZE + self.CHIP_OFFSET
+        column = (x - self.OFFSET + self.CHIP_OFFSET // 2) // pitch
+        return column if 0 <= column < self.COLUMNS else None
+
     def get_player_color(self, player_id):
         """Get color for player ID"""
         if player_id == 0:
@@ -55,11 +90,14 @@ class Connect4GameUI:
     
     def start_game(self, game_state):
         """Initialize the game with server state"""
+        self.load_geometry(game_state)
         self.grid = game_state["grid"]
+        self.position = rules.Position.from_grid(self.grid, self.geometry)
         self.current_player_id = game_state["current_player_id"]
         self.players = game_state["players"]
         self.game_over = game_state["game_over"]
         self.winner = game_state["winner"]
+        self.seq = game_state["seq"]
         
         # Determine which player ID I am
         if self.parent.current_user in self.players:
@@ -72,14 +110,40 @@ class Connect4GameUI:
         threading.Thread(target=self.game_loop, daemon=True).start()
         
     def update_game_state(self, game_state):
-        """Update game state from server"""
+        """Replace the local game state with a full snapshot from the server"""
+        self.load_geometry(game_state)
         self.grid = game_state["grid"]
+        self.position = rules.Position.from_grid(self.grid, self.geometry)
         self.current_player_id = game_state["current_player_id"]
         self.game_over = game_state["game_over"]
         self.winner = game_state["winner"]
+        self.seq = game_state["seq"]
         
         self.my_turn = (not self.game_over and 
                        game_state["current_player"] == self.parent.current_user)
+
+    def apply_move(self, move, seq):
+        """Apply a single move from the server, returns False if updates were missed"""
+        if seq <= self.seq:
+            return True  # Already applied (e.g. included in a snapshot)
+        if seq != self.seq + 1:
+            self.parent.send_game_sync()
+            return False
+        self.grid[move["row"]][move["column"]] = move["player_id"]
+        self.position.play(move["column"])
+        self.seq = seq
+        self.current_player_id = 1 - move["player_id"]
+        self.my_turn = (not self.game_over and
+                       self.players[self.current_player_id] == self.parent.current_user)
+        return True
+
+    def finish_game(self, winner, seq):
+        """Mark the game as over once the final move has been applied"""
+        if seq > self.seq:
+            self.parent.send_game_sync()
+        self.game_over = True
+        self.winner = winner
+        self.my_turn = False
         
     def game_loop(self):
         """Main game loop"""
@@ -99,6 +163,11 @@ class Connect4GameUI:
                         if self.is_valid_move(column):
                             # Send move to server
                             self.parent.send_game_move(column)
+                elif event.type == pygame.MOUSEBUTTONUP and self.my_turn and not self.game_over:
+                    # Click a column, for boards wider than the number keys
+                    column = self.column_at(event.pos[0])
+                    if column is not None and self.is_valid_move(column):
+                        self.parent.send_game_move(column)
                 elif event.type == pygame.KEYUP and self.game_over:
                     # Handle restart (Y key)
                     if event.key in [121, 122]:  # Y or Z key
@@ -109,10 +178,7 @@ class Connect4GameUI:
             
     def is_valid_move(self, column):
         """Check if a move is valid locally"""
-        if column < 0 or column >= self.COLUMNS:
-            return False
-        # Check if column has space
-        return self.grid[self.ROWS-1][column] is None
+        return self.position.can_play(column)
     
     def draw(self):
         """Draw the game board and pieces"""
@@ -196,7 +262,7 @@ class Connect4GameUI:
                 "User_Name": self.parent.current_user
             }
             try:
-                data = pickle.dumps(message)
+                data = client_menu.encode(message)
                 client_menu.client_socket.sendall(data)
             except Exception as e:
                 print(f"Error sending game quit message: {e}")
@@ -331,6 +397,29 @@ class New_game_room(QMainWindow):
         """)
         input_layout.addWidget(self.ready_button)
 
+        # Play against the computer
+        self.bot_button = QPushButton("Add Bot")
+        self.bot_button.clicked.connect(self.add_bot)
+        self.bot_button.setFixedSize(100, 40)
+        self.bot_button.setStyleSheet("""
+            QPushButton {
+                background-color: #6f42c1;
+                color: #ffffff;
+                border: none;
+                border-radius: 8px;
+                padding: 8px;
+                font-size: 16px;
+                font-family: 'Arial', sans-serif;
+            }
+            QPushButton:hover {
+                background-color: #5a32a3;
+            }
+            QPushButton:pressed {
+                background-color: #4b2a89;
+            }
+        """)
+        input_layout.addWidget(self.bot_button)
+
         chat_layout.addLayout(input_layout)
         chat_layout.addSpacing(10)
         main_layout.addLayout(chat_layout, stretch=3)
@@ -438,11 +527,25 @@ class New_game_room(QMainWindow):
                 "Ready": new_ready
             }
             try:
-                data = pickle.dumps(message)
+                data = client_menu.encode(message)
                 client_menu.client_socket.sendall(data)
             except Exception as e:
                 self.text_edit.append(f"Error sending ready status: {e}")
 
+    def add_bot(self):
+        """Ask the server to seat the computer as the other player"""
+        if client_menu.client_socket:
+            message = {
+                "Command": "Add_Bot",
+                "Room_Name": self.room_name,
+                "User_Name": self.current_user
+            }
+            try:
+                data = client_menu.encode(message)
+                client_menu.client_socket.sendall(data)
+            except Exception as e:
+                self.text_edit.append(f"Error adding bot: {e}")
+
     def send_message(self):
         """Send a message to the server"""
         message_text = self.message_input.text().strip()
@@ -454,7 +557,7 @@ class New_game_room(QMainWindow):
                 "Text": message_text
             }
             try:
-                data = pickle.dumps(message)
+                data = client_menu.encode(message)
                 client_menu.client_socket.sendall(data)
                 self.message_input.clear()
             except Exception as e:
@@ -487,7 +590,7 @@ class New_game_room(QMainWindow):
         self.game_ui = Connect4GameUI(self)
         self.game_ui.start_game(game_state)
 
-    def handle_game_update(self, move, game_state):
+    def handle_game_update(self, move, seq):
         """Handle game move update from server"""
         # Update the game UI with the move
         
@@ -496,10 +599,15 @@ class New_game_room(QMainWindow):
         column = move["column"]
         self.text_edit.append(f"{player} played column {column + 1}")
         
+        if self.game_ui:
+            self.game_ui.apply_move(move, seq)
+
+    def handle_game_state(self, game_state):
+        """Handle a full game state snapshot from server"""
         if self.game_ui:
             self.game_ui.update_game_state(game_state)
 
-    def handle_game_over(self, winner, game_state):
+    def handle_game_over(self, winner, seq, game_state=None):
         """Handle game over from server"""
         if winner == "No_one":
             self.text_edit.append("Game Over! IT IS A DRAW LOL!")
@@ -517,14 +625,17 @@ class New_game_room(QMainWindow):
                 "Ready": not current_ready
             }
         try:
-            data = pickle.dumps(message)
+            data = client_menu.encode(message)
             client_menu.client_socket.sendall(data)
         except Exception as e:
             self.text_edit.append(f"Error sending ready status: {e}")
         # Update the ready button color to match the new state
         self.changing_color(not current_ready)
         if self.game_ui:
-            self.game_ui.update_game_state(game_state)
+            if game_state is not None:
+                self.game_ui.update_game_state(game_state)
+            else:
+                self.game_ui.finish_game(winner, seq)
 
     def handle_game_restart(self, ready_users):
         """Handle game restart from server"""
@@ -546,11 +657,25 @@ class New_game_room(QMainWindow):
                 "Column": column
             }
             try:
-                data = pickle.dumps(message)
+                data = client_menu.encode(message)
                 client_menu.client_socket.sendall(data)
             except Exception as e:
                 self.text_edit.append(f"Error sending move: {e}")
 
+    def send_game_sync(self):
+        """Ask the server for a full game state after missing an update"""
+        if client_menu.client_socket:
+            message = {
+                "Command": "Game_Sync",
+                "Room_Name": self.room_name,
+                "User_Name": self.current_user
+            }
+            try:
+                data = client_menu.encode(message)
+                client_menu.client_socket.sendall(data)
+            except Exception as e:
+                self.text_edit.append(f"Error requesting game state: {e}")
+
     def send_restart_game(self):
         """Send a game restart request to the server"""
         if client_menu.client_socket:
@@ -560,7 +685,7 @@ class New_game_room(QMainWindow):
                 "User_Name": self.current_user
             }
             try:
-                data = pickle.dumps(message)
+                data = client_menu.encode(message)
                 client_menu.client_socket.sendall(data)
             except Exception as e:
                 self.text_edit.append(f"Error restarting game: {e}")
@@ -586,7 +711,7 @@ class New_game_room(QMainWindow):
                     "Text": f"{self.current_user} has left the room."
                 }
                 print(f"Sending close Box_chat: {leave_message}")
-                data = pickle.dumps(leave_message)
+                data = client_menu.encode(leave_message)
                 self.client_socket.sendall(data)
                 client_menu.alreadyinroom = False
             except:
@@ -602,7 +727,11 @@ class ClientMenu(QMainWindow):
         self.username = None  
         self.room_name = None
         self.list_of_available_rooms = []
+        self.lobby_rooms = None  # Room name -> number of users, once subscribed to lobby updates
         self.client_socket = None
+        self.session_token = None  # Lets the client resume its session after a dropped connection
+        self.room_seq = 0  # Room_Seq of the last room event received
+        self.codec = DEFAULT_CODEC  # Codec negotiated with the server
         self.chatroom = None
         self.running = True
         self.is_disconnected = False
@@ -765,6 +894,32 @@ class ClientMenu(QMainWindow):
         """)
         self.layout.addWidget(self.room_input)
 
+        self.board_selector = QComboBox()
+        for rows, columns, connect in BOARD_VARIANTS:
+            self.board_selector.addItem(f"{rows}x{columns} board, connect {connect}", (rows, columns, connect))
+        self.board_selector.setEnabled(False)
+        self.board_selector.setFixedHeight(30)
+        self.board_selector.setStyleSheet("""
+            QComboBox {
+                background-color: #3c3f41;
+                color: #ffffff;
+                border: 1px solid #555555;
+                border-radius: 5px;
+                padding: 5px;
+                font-size: 14px;
+            }
+            QComboBox::drop-down {
+                border: none;
+            }
+            QComboBox QAbstractItemView {
+                background-color: #3c3f41;
+                color: #ffffff;
+                selection-background-color: #1e90ff;
+                border: 1px solid #555555;
+            }
+        """)
+        self.layout.addWidget(self.board_selector)
+
         # Room action buttons layout
         room_button_layout = QHBoxLayout()
         self.create_room_button = QPushButton("Create Room")
@@ -869,7 +1024,8 @@ class ClientMenu(QMainWindow):
             
         self.send_message({
             "Command": "Check_Username",
-            "User_Name": self.username
+            "User_Name": self.username,
+            "Codecs": CLIENT_CODECS
         })
         
         threading.Thread(target=self.receive_messages, daemon=True).start()
@@ -880,6 +1036,10 @@ class ClientMenu(QMainWindow):
             return
         self.running = False
         self.is_disconnected = True
+        self.lobby_rooms = None
+        self.session_token = None
+        self.room_seq = 0
+        self.codec = DEFAULT_CODEC
         if self.client_socket:
             try:
                 self.client_socket.close()
@@ -891,6 +1051,7 @@ class ClientMenu(QMainWindow):
         self.username_input.setEnabled(True)
         self.room_selector.setEnabled(False)
         self.create_room_button.setEnabled(False)
+        self.board_selector.setEnabled(False)
         self.join_room_button.setEnabled(False)
         self.text_edit.append("Disconnected from server.")
         if self.chatroom:
@@ -899,32 +1060,141 @@ class ClientMenu(QMainWindow):
 
     def receive_messages(self):
         """Receive messages from the server in a separate thread."""
+        reader = MessageReader(self.client_socket, codecs=CLIENT_CODECS)
         while self.running and self.client_socket:
             try:
-                data = self.client_socket.recv(1048576)
-                if not data:
+                messages = reader.read_messages()
+                if messages is None:
+                    if self.resume_session():
+                        reader = MessageReader(self.client_socket, codecs=CLIENT_CODECS)
+                        continue
                     QCoreApplication.postEvent(self, MessageEvent("status", "Server disconnected."))
                     self.disconnect()
                     break
-                message = pickle.loads(data)
-                if message:
+                redirected = False
+                for message in messages:
+                    if not message:
+                        continue
+                    if message["Command"] == "Redirect":
+                        # The room lives on another node, anything after this is from the old one
+                        redirected = self.follow_redirect(message)
+                        if redirected:
+                            break
+                        continue
+                    if "Room_Seq" in message:
+                        self.room_seq = message["Room_Seq"]
+                    if message["Command"] == "Ping":
+                        # Answer heartbeats straight away so an idle client isn't disconnected
+                        self.client_socket.sendall(self.encode({"Command": "Pong"}))
+                        continue
+                    if message["Command"] == "Resume_Session":
+                        if message["Resumed"]:
+                            self.codec = message.get("Codec", DEFAULT_CODEC)
+                            QCoreApplication.postEvent(self, MessageEvent("status", "Reconnected to server."))
+                            self.send_message({"Command": "Lobby_Subscribe", "User_Name": self.username})
+                        else:
+                            QCoreApplication.postEvent(self, MessageEvent("status", "Session expired, please connect again."))
+                            self.disconnect()
+                        continue
                     print(f"Processing message: {message}")
                     if message["Command"] in ["Join_Room", "Sending_Message"]:
                         QCoreApplication.postEvent(self, MessageEvent("chat", message))
-                    elif message["Command"] in ["Room_State", "Check_Username"]:
+                    elif message["Command"] in ["Room_State", "Check_Username", "Lobby_Snapshot", "Lobby_Update"]:
                         QCoreApplication.postEvent(self, MessageEvent("rooms", message))
-                    elif message["Command"] in ["Ready_Update", "Game_Start", "Game_Update", "Game_Over", "Game_Restart"]:
+                    elif message["Command"] in ["Ready_Update", "Game_Start", "Game_Update", "Game_State", "Game_Over", "Game_Restart"]:
                         QCoreApplication.postEvent(self, MessageEvent("game", message))
+                    elif message["Command"] == "Error":
+                        QCoreApplication.postEvent(self, MessageEvent("status", f"Server rejected {message['For']}: {message['Error']}"))
                     else:
                         QCoreApplication.postEvent(self, MessageEvent("status", f"Unknown command received: {message['Command']}"))
+                if redirected:
+                    reader = MessageReader(self.client_socket, codecs=CLIENT_CODECS)
+            except FramingError as e:
+                if self.running:
+                    QCoreApplication.postEvent(self, MessageEvent("status", f"Error receiving message: {e}"))
+                    self.disconnect()
+                break
             except socket.error as e:
                 if self.running and e.errno == errno.WSAEWOULDBLOCK:
                     continue
+                if self.resume_session():
+                    reader = MessageReader(self.client_socket, codecs=CLIENT_CODECS)
+                    continue
                 if self.running:
                     QCoreApplication.postEvent(self, MessageEvent("status", f"Error receiving message: {e}"))
                     self.disconnect()
                 break
 
+    def resume_session(self, attempts=5):
+        """Reconnect after a dropped connection and ask the server to resume the session.
+
+        Returns True once a new connection is open and Resume_Session is sent;
+        the server's answer arrives like any other message.
+        """
+        if not self.running or self.is_disconnected or not self.session_token:
+            return False
+        QCoreApplication.postEvent(self, MessageEvent("status", "Connection lost, reconnecting..."))
+        for attempt in range(attempts):
+            time.sleep(0.5 * 2 ** attempt)
+            try:
+                new_socket = socket.create_connection((self.host, self.port), timeout=5)
+                new_socket.settimeout(None)
+                new_socket.sendall(encode_message({
+                    "Command": "Resume_Session",
+                    "Session_Token": self.session_token,
+                    "Room_Name": self.chatroom.room_name if self.chatroom else None,
+                    "Last_Seq": self.room_seq,
+                    "Codecs": CLIENT_CODECS
+                }))
+            except OSError:
+                continue
+            self.replace_socket(new_socket)
+            return True
+        return False
+
+    def follow_redirect(self, message):
+        """Reconnect to the node that owns a room and repeat the redirected command there.
+
+        Returns True once the new connection is open; the new node's replies
+        arrive like any other message.
+        """
+        QCoreApplication.postEvent(self, MessageEvent("status", f"Room {message['Room_Name']} is on "
+                                                                f"{message['Host']}:{message['Port']}, moving there..."))
+        if message["For"] == "Resume_Session":
+            commands = [{
+                "Command": "Resume_Session",
+                "Session_Token": self.session_token,
+                "Room_Name": message["Room_Name"],
+                "Last_Seq": self.room_seq,
+                "Codecs": CLIENT_CODECS
+            }]
+        else:
+            # Sessions belong to one node, so log in there again before joining
+            commands = [
+                {"Command": "Check_Username", "User_Name": self.username, "Codecs": CLIENT_CODECS},
+                {"Command": "Join_Room", "Room_Name": message["Room_Name"], "User_Name": self.username}
+            ]
+        try:
+            new_socket = socket.create_connection((message["Host"], message["Port"]), timeout=5)
+            new_socket.settimeout(None)
+            new_socket.sendall(b"".join(encode_message(command) for command in commands))
+        except OSError as e:
+            QCoreApplication.postEvent(self, MessageEvent("status", f"Error connecting to {message['Host']}: {e}"))
+            return False
+        self.host, self.port = message["Host"], message["Port"]
+        self.codec = DEFAULT_CODEC  # Until the new node picks one
+        self.replace_socket(new_socket)
+        return True
+
+    def replace_socket(self, new_socket):
+        old_socket, self.client_socket = self.client_socket, new_socket
+        if self.chatroom:
+            self.chatroom.client_socket = new_socket
+        try:
+            old_socket.close()
+        except Exception:
+            pass
+
     def customEvent(self, event):
         """Handle custom events for thread-safe UI updates."""
         if event.type() == MessageEvent.EventType:
@@ -971,18 +1241,49 @@ class ClientMenu(QMainWindow):
         try:
             if message["Command"] == "Check_Username":
                 self.list_of_users_in_room = message["Users_In_Room"]
+                self.session_token = message.get("Session_Token")
+                self.codec = message.get("Codec", DEFAULT_CODEC)
                 self.text_edit.append(f"Username {self.username} is valid.")
                 self.room_selector.setEnabled(True)
                 self.join_room_button.setEnabled(True)
                 self.create_room_button.setEnabled(True)
+                self.board_selector.setEnabled(True)
                 self.room_input.setEnabled(True)
-                
+                # Ask for incremental room updates instead of full room lists
+                self.send_message({
+                    "Command": "Lobby_Subscribe",
+                    "User_Name": self.username
+                })
+
+            elif message["Command"] == "Lobby_Snapshot":
+                self.lobby_rooms = {}
+                self.list_of_available_rooms = []
+                self.room_selector.clear()
+                for room_name, occupancy in message["Rooms"].items():
+                    self.add_lobby_room(room_name, occupancy)
+
+            elif message["Command"] == "Lobby_Update":
+                if self.lobby_rooms is None:
+                    return  # Updates only make sense on top of a snapshot
+                added_rooms = []
+                for event, room_name, occupancy in message["Events"]:
+                    if event == "room_added":
+                        self.add_lobby_room(room_name, occupancy)
+                        added_rooms.append(room_name)
+                    elif event == "room_removed":
+                        self.remove_lobby_room(room_name)
+                    elif event == "occupancy_changed":
+                        self.set_lobby_occupancy(room_name, occupancy)
+                if added_rooms:
+                    self.text_edit.append(f"New room(s) created: {', '.join(added_rooms)}")
+
             elif message["Command"] == "Room_State":
+                if message["Users_In_Room"]:
+                    self.list_of_users_in_room = message["Users_In_Room"]
+                if self.lobby_rooms is not None:
+                    return  # The room selector is kept up to date by lobby updates
                 new_rooms = set(message["Available_Rooms"])
                 old_rooms = set(self.list_of_available_rooms)
-                userinrooms = message["Users_In_Room"]
-                if message["Users_In_Room"]: 
-                    self.list_of_users_in_room = userinrooms
                 self.list_of_available_rooms = message["Available_Rooms"]
                 self.room_selector.clear()
                 self.room_selector.addItems(self.list_of_available_rooms)
@@ -994,11 +1295,38 @@ class ClientMenu(QMainWindow):
                 self.room_selector.setEnabled(True)
                 self.join_room_button.setEnabled(True)
                 self.create_room_button.setEnabled(True)
+                self.board_selector.setEnabled(True)
                 self.room_input.setEnabled(True)
                 
         except Exception as e:
             QCoreApplication.postEvent(self, MessageEvent("status", f"Error processing room update: {e}"))
 
+    def add_lobby_room(self, room_name, occupancy):
+        """Add a room to the room selector."""
+        if room_name in self.lobby_rooms:
+            self.set_lobby_occupancy(room_name, occupancy)
+            return
+        self.lobby_rooms[room_name] = occupancy
+        self.list_of_available_rooms.append(room_name)
+        self.room_selector.addItem(room_name)
+        self.set_lobby_occupancy(room_name, occupancy)
+
+    def remove_lobby_room(self, room_name):
+        """Remove a room from the room selector."""
+        if self.lobby_rooms.pop(room_name, None) is None:
+            return
+        self.list_of_available_rooms.remove(room_name)
+        index = self.room_selector.findText(room_name)
+        if index >= 0:
+            self.room_selector.removeItem(index)
+
+    def set_lobby_occupancy(self, room_name, occupancy):
+        """Show how many users are in a room as the item's tooltip."""
+        self.lobby_rooms[room_name] = occupancy
+        index = self.room_selector.findText(room_name)
+        if index >= 0:
+            self.room_selector.setItemData(index, f"{occupancy} user(s) in room", Qt.ToolTipRole)
+
     def process_game_update(self, message):
         """Handle game-related updates."""
         print(f"Received game message: {message}")
@@ -1009,9 +1337,11 @@ class ClientMenu(QMainWindow):
                 elif message["Command"] == "Game_Start":
                     self.chatroom.handle_game_start(message["Game_State"])
                 elif message["Command"] == "Game_Update":
-                    self.chatroom.handle_game_update(message["Move"], message["Game_State"])
+                    self.chatroom.handle_game_update(message["Move"], message["Seq"])
+                elif message["Command"] == "Game_State":
+                    self.chatroom.handle_game_state(message["Game_State"])
                 elif message["Command"] == "Game_Over":
-                    self.chatroom.handle_game_over(message["Winner"], message["Game_State"])
+                    self.chatroom.handle_game_over(message["Winner"], message.get("Seq", 0), message.get("Game_State"))
                 elif message["Command"] == "Game_Restart":
                     self.chatroom.handle_game_restart(message["Ready_Users"])
         except Exception as e:
@@ -1025,10 +1355,14 @@ class ClientMenu(QMainWindow):
         """Create a new room and send request to server"""
         current_room = self.room_input.text().strip()
         if current_room:
+            rows, columns, connect = self.board_selector.currentData()
             message = {
                 "Command": "Create_Room",
                 "Room_Name": current_room,
-                "User_Name": self.username
+                "User_Name": self.username,
+                "Rows": rows,
+                "Columns": columns,
+                "Connect": connect
             }
             self.send_message(message)
             self.text_edit.append(f"Requested creation of room {current_room}")
@@ -1045,10 +1379,6 @@ class ClientMenu(QMainWindow):
                 "User_Name": self.username
             }
             self.send_message(message)
-            self.send_message({
-                "Command": "Request_Room_State",
-                "User_Name": self.username
-            })
             self.send_message({
                 "Command": "Sending_Message",
                 "Room_Name": current_room,
@@ -1067,12 +1397,16 @@ class ClientMenu(QMainWindow):
         else:
             self.join_room_button.setEnabled(False)   
                 
+    def encode(self, message):
+        """Encode a message in the codec negotiated with the server."""
+        return encode_message(message, self.codec)
+
     def send_message(self, message):
         """Send a message to the server."""
         if self.client_socket and self.running and not self.is_disconnected:
             try:
                 self.client_socket.setblocking(True)
-                data = pickle.dumps(message)
+                data = self.encode(message)
                 self.client_socket.sendall(data)
             except socket.error as e:
                 if e.errno == errno.WSAEWOULDBLOCK:
@@ -0,0 +1,216 @@
+import threading
+import rules
+from server import ChatServer
+from sharded_server import room_owner
+from broker import NODES_TOPIC
+from logconfig import get_logger
+
+log = get_logger("cluster")
+
+# Multi-node server. Several server.py processes, on one machine or several,
+# run behind one address and share their lobby through a broker (broker.py).
+# Every node knows the addresses of all nodes, in the same order, and each room
+# is owned by the node its name hashes to. A client that joins a room owned by
+# another node gets a Redirect to that node and reconnects there, so moves and
+# chat are only ever handled by the room's owner.
+#
+# Lobby events are publishes: a node publishes the occupancy of its own rooms
+# whenever it changes, and every node applies what it hears to its merged view
+# of the lobby, which its LobbyPublisher then fans out to its own clients.
+# Presence (which users are online where) is published the same way.
+#
+#   python broker.py --socket /tmp/connect4-broker.sock
+#   python server.py --port 12345 --broker /tmp/connect4-broker.sock --nodes 127.0.0.1:12345 127.0.0.1:12346
+#   python server.py --port 12346 --broker /tmp/connect4-broker.sock --nodes 127.0.0.1:12345 127.0.0.1:12346
+
+LOBBY_TOPIC = "lobby"
+PRESENCE_TOPIC = "presence"
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class ClusterNode(ChatServer):
+    """ChatServer owning a share of the rooms of a multi-node deployment."""
+
+    def __init__(self, host, port, nodes, node, broker, backpressure=None, room_workers=4, heartbeat=None,
+                 resume_grace=30.0, codecs=None, rate_limits=None, bots=None):
+        self.nodes = nodes  # Client-facing "host:port" of every node, the same list on every node
+        self.node = node  # This node's entry in nodes
+        self.index = nodes.index(node)
+        self.broker = broker
+        self.lobby_occupancy = {}  # Room name -> users, for the rooms of every node
+        self.node_rooms = {}  # Node -> names of the rooms it owns, as it last published them
+        self.presence = {}  # Other node -> usernames online there
+        # Publishes go out in the order their state was read, without holding
+        # self.lock (and with it every login and room change) over broker I/O
+        self.publish_lock = threading.Lock()
+        super().__init__(host, port, backpressure, room_workers, heartbeat, resume_grace, codecs, rate_limits, bots)
+        self.metrics.gauge("connect4_cluster_nodes", "Nodes this node has heard from, itself included",
+                           collect=lambda: len(set(self.node_rooms) | set(self.presence) | {self.node}))
+        self.metrics.gauge("connect4_cluster_users", "Users online on any node", collect=self.cluster_users)
+        broker.subscribe(LOBBY_TOPIC, self.on_lobby_event)
+        broker.subscribe(PRESENCE_TOPIC, self.on_presence_event)
+        broker.subscribe(NODES_TOPIC, self.on_node_event)
+        broker.subscribe(f"node.{node}", self.on_node_request)
+        broker.start(on_connect=self.publish_state)
+
+    def owner(self, room_name):
+        return self.nodes[room_owner(room_name, len(self.nodes))]
+
+    def owns(self, room_name):
+        return room_owner(room_name, len(self.nodes)) == self.index
+
+    def redirect(self, client_socket, message):
+        """Tell the client to repeat the command on the node that owns its room."""
+        owner = self.owner(message["Room_Name"])
+        host, port = parse_address(owner)
+        log.debug("Redirecting client", extra={"fields": {"room": message["Room_Name"], "node": owner}})
+        self.send_message(client_socket, {
+            "Command": "Redirect",
+            "For": message["Command"],
+            "Room_Name": message["Room_Name"],
+            "Host": host,
+            "Port": port
+        })
+
+    # Client commands that depend on where the room lives
+
+    def on_check_username(self, client_socket, message, username):
+        username = super().on_check_username(client_socket, message, username)
+        if username is not None:  # None if the name was refused
+            self.broker.publish(PRESENCE_TOPIC, {"Kind": "Online", "Node": self.node, "User_Name": username})
+        return username
+
+    def on_resume_session(self, client_socket, message, username):
+        if message.get("Room_Name") and not self.owns(message["Room_Name"]):
+            self.redirect(client_socket, message)  # The session lives on the node of its room
+            return None
+        return super().on_resume_session(client_socket, message, username)
+
+    def on_join_room(self, client_socket, message, username):
+        if not self.owns(message["Room_Name"]):
+            self.redirect(client_socket, message)
+            return None
+        return super().on_join_room(client_socket, message, username)
+
+    def cleanup_client(self, username):
+        super().cleanup_client(username)
+        if username:
+            self.broker.publish(PRESENCE_TOPIC, {"Kind": "Offline", "Node": self.node, "User_Name": username})
+
+    # Lobby state
+
+    def lobby_changed(self, room_name):
+        """Publish the new occupancy of one of our rooms, then fan it out to our own clients."""
+        with self.publish_lock:
+            with self.lock:
+                users = self.rooms.get(room_name)
+                occupancy = None if users is None else len(users)
+                if self.lobby_occupancy.get(room_name) == occupancy:
+                    return
+                self.set_occupancy(self.node, room_name, occupancy)
+            self.broker.publish(LOBBY_TOPIC, {
+                "Kind": "Room",
+                "Node": self.node,
+                "Room_Name": room_name,
+                "Occupancy": occupancy
+            })
+        self.lobby.room_changed(room_name)
+
+    def set_occupancy(self, node, room_name, occupancy):
+        """Record a room's occupancy, or its removal if None; called with self.lock held."""
+        if occupancy is None:
+            self.lobby_occupancy.pop(room_name, None)
+            self.node_rooms.get(node, set()).discard(room_name)
+        else:
+            self.lobby_occupancy[room_name] = occupancy
+            self.node_rooms.setdefault(node, set()).add(room_name)
+
+    def publish_state(self):
+        """Publish all our rooms and users, after connecting to the broker or when a node joins."""
+        with self.publish_lock:
+            with self.lock:
+                rooms = {room_name: len(users) for room_name, users in self.rooms.items()}
+                users = list(self.clients)
+            self.broker.publish(LOBBY_TOPIC, {"Kind": "Rooms", "Node": self.node, "Rooms": rooms})
+            self.broker.publish(PRESENCE_TOPIC, {"Kind": "Users", "Node": self.node, "Users": users})
+
+    def on_lobby_event(self, message):
+        node = message["Node"]
+        if message["Kind"] == "Room":
+            changes = {message["Room_Name"]: message["Occupancy"]}
+        else:
+            # A full list of the node's rooms replaces whatever we had for it
+            changes = dict.fromkeys(self.node_rooms.get(node, ()), None)
+            changes.update(message["Rooms"])
+        self.apply_rooms(node, changes)
+
+    def apply_rooms(self, node, changes):
+        changed = []
+        with self.lock:
+            for room_name, occupancy in changes.items():
+                if self.lobby_occupancy.get(room_name) != occupancy:
+                    changed.append(room_name)
+                self.set_occupancy(node, room_name, occupancy)
+        # The lobby lock comes before the server lock, so notify after releasing it
+        for room_name in changed:
+            self.lobby.room_changed(room_name)
+
+    def on_presence_event(self, message):
+        node = message["Node"]
+        with self.lock:
+            if message["Kind"] == "Users":
+                self.presence[node] = set(message["Users"])
+            elif message["Kind"] == "Online":
+                self.presence.setdefault(node, set()).add(message["User_Name"])
+            elif message["Kind"] == "Offline":
+                self.presence.get(node, set()).discard(message["User_Name"])
+
+    def on_node_event(self, message):
+        node = message["Node"]
+        if message["Kind"] == "Node_Joined":
+            log.info("Node joined", extra={"fields": {"node": node}})
+            self.publish_state()  # It has not heard about our rooms and users yet
+        elif message["Kind"] == "Node_Left":
+            log.info("Node left", extra={"fields": {"node": node}})
+            with self.lock:
+                self.presence.pop(node, None)
+            self.apply_rooms(node, dict.fromkeys(self.node_rooms.pop(node, ()), None))
+
+    def on_node_request(self, message):
+        if message["Kind"] == "Create_Room":
+            self.create_room(message["Room_Name"], message["User_Name"], rules.Geometry(*message["Board"]))
+
+    def create_room(self, room_name, username, geometry=rules.STANDARD):
+        """Create the room on its owning node."""
+        if not self.owns(room_name):
+            self.broker.publish(f"node.{self.owner(room_name)}", {
+                "Kind": "Create_Room",
+                "Room_Name": room_name,
+                "User_Name": username,
+                "Board": geometry.key()
+            })
+            return
+        super().create_room(room_name, username, geometry)
+
+    def cluster_users(self):
+        with self.lock:
+            online = set(self.clients)
+            for users in self.presence.values():
+                online |= users
+        return len(online)
+
+    def available_rooms(self):
+        """Return the rooms of every node."""
+        with self.lock:
+            return list(self.lobby_occupancy)
+
+    def lobby_state(self, room_name):
+        return self.lobby_occupancy.get(room_name)
+
+    def shutdown(self):
+        super().shutdown()
+        self.broker.close()
@@ -1,4 +1,8 @@
+import argparse
 import pygame
+import rules
+from book import OpeningBook
+from solver import Solver
 
 class Player:
     def __init__(self, id):
@@ -21,63 +25,46 @@ class Player:
 
 
 class Board:
-    def __init__(self):
-        self.ROWS = 6
-        self.COLUMNS = 7
+    def __init__(self, geometry=rules.STANDARD):
+        self.geometry = geometry
+        self.ROWS = geometry.rows
+        self.COLUMNS = geometry.columns
         self.clear()
 
     def clear(self):
-        self._grid = [[None for i in range(self.COLUMNS)] for j in range(self.ROWS)]   
+        self._position = rules.Position(self.geometry)
+        self._first = None  # Id of the player who moved first in this game
 
     def check_player_wins(self, player):
-        id = player.get_id()
-        
-        # Check horizontal
-        for c in range(self.COLUMNS - 3):
-            for r in range(self.ROWS):
-                if (self._grid[r][c] == id and self._grid[r][c+1] == id and 
-                    self._grid[r][c+2] == id and self._grid[r][c+3] == id):
-                    return True
-
-        # Check vertical
-        for c in range(self.COLUMNS):
-            for r in range(self.ROWS - 3):
-                if (self._grid[r][c] == id and self._grid[r+1][c] == id and 
-                    self._grid[r+2][c] == id and self._grid[r+3][c] == id):
-                    return True
-
-        # Check positive diagonal
-        for c in range(self.COLUMNS - 3):
-            for r in range(self.ROWS - 3):
-                if (self._grid[r][c] == id and self._grid[r+1][c+1] == id and 
-                    self._grid[r+2][c+2] == id and self._grid[r+3][c+3] == id):
-                    return True
-
-        # Check negative diagonal
-        for c in range(self.COLUMNS - 3):
-            for r in range(3, self.ROWS):
-                if (self._grid[r][c] == id and self._grid[r-1][c+1] == id and 
-                    self._grid[r-2][c+2] == id and self._grid[r-3][c+3] == id):
-                    return True
-
-        return False
+        if self._first is None:
+            return False
+        return self.geometry.alignment(self._position.stones(0 if player.get_id() == self._first else 1))
+
+    def get_position(self):
+        return self._position.copy()
+
+    def is_full(self):
+        return self._position.is_full()
 
     def add_chip(self, player, column):
-        for row in range(self.ROWS):
-            cell_value = self._grid[row][column]
-            if cell_value is None:
-                self._grid[row][column] = player.get_id()
-                return row
-        return -1
+        if not self._position.can_play(column):
+            return -1
+        if self._first is None:
+            self._first = player.get_id()
+        return self._position.play(column)
 
 
 class GameUI:
-    def __init__(self, player):
-        self.CHIP_SIZE = 80
+    def __init__(self, player, geometry=rules.STANDARD):
+        self.ROWS = geometry.rows
+        self.COLUMNS = geometry.columns
+        # Chips shrink so larger boards still fit the window
+        pitch = min(100, 700 // self.COLUMNS, 600 // self.ROWS)
+        self.CHIP_SIZE = pitch * 4 // 5
         self.OFFSET = 60
-        self.CHIP_OFFSET = 20
-        self.BOARD_HEIGHT = 600
+        self.CHIP_OFFSET = pitch - self.CHIP_SIZE
         self.CHIP_RADIUS = int(self.CHIP_SIZE / 2)
+        self.BOARD_HEIGHT = self.OFFSET + self.CHIP_RADIUS + (self.ROWS - 1) * pitch
 
         pygame.init()
         pygame.font.init()
@@ -85,18 +72,27 @@ class GameUI:
 
         self._screen = pygame.display.set_mode((800, 700))
         
-        # Load images from the img folder
-        try:
-            self._board_img = pygame.image.load("./img/board.png")
-            self._board_img_numbers = pygame.image.load("./img/board_numbers.png")
-        except pygame.error:
-            print("Warning: Could not load board images from ./img/ folder")
-            self._board_img = None
-            self._board_img_numbers = None
+        # Load images from the img folder, they are drawn for the standard board only
+        self._board_img = None
+        self._board_img_numbers = None
+        if geometry == rules.STANDARD:
+            try:
+                self._board_img = pygame.image.load("./img/board.png")
+                self._board_img_numbers = pygame.image.load("./img/board_numbers.png")
+            except pygame.error:
+                print("Warning: Could not load board images from ./img/ folder")
+                self._board_img = None
+                self._board_img_numbers = None
             
         self._font = pygame.font.SysFont('Calibri', 26)
         self.init_ui(player)
 
+    def column_at(self, x):
+        """Column under a horizontal window position, or None"""
+        pitch = self.CHIP_SIZE + self.CHIP_OFFSET
+        column = (x - self.OFFSET + self.CHIP_OFFSET // 2) // pitch
+        return column if 0 <= column < self.COLUMNS else None
+
     def init_ui(self, player):
         self._screen.fill((255, 255, 255))
         self.draw_board()
@@ -147,14 +143,17 @@ class GameUI:
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, geometry=rules.STANDARD, computer=(), think=1.0, book=None):
         self._current_player = 0
         self._players = [Player(0), Player(1)]
-        self._board = Board()
-        self._gameUI = GameUI(self._players[0])
+        self._board = Board(geometry)
+        self._gameUI = GameUI(self._players[0], geometry)
+        self._computer = set(computer)  # Ids of the players the computer plays
+        self._think = think
+        self._solver = Solver(geometry, book=OpeningBook(book) if book else None) if computer else None
 
     def game_loop(self):
-        valid_keys = [1, 2, 3, 4, 5, 6, 7]
+        valid_keys = list(range(1, min(self._board.COLUMNS, 9) + 1))
         
         update_ui = False
         done = False
@@ -165,6 +164,15 @@ class Game:
         while not done:
             update_ui = False
 
+            # Let the computer move when it is its turn
+            if (not player_won and self._current_player in self._computer and
+                    not self._board.is_full()):
+                pygame.event.pump()  # Keep the window responsive before thinking
+                column = self._solver.search(self._board.get_position(), budget=self._think).column
+                row = self.add_chip(column)
+                player_won = self.check_player_wins(self.get_current_player())
+                update_ui = True
+
             # Check for player input events
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -180,7 +188,7 @@ class Game:
                             player_won = False
                             done = False
                             self.restart()
-                    else:
+                    elif self._current_player not in self._computer:
                         # Try to insert to a column
                         column = (event.key - 49)
                         if column + 1 in valid_keys:
@@ -191,6 +199,17 @@ class Game:
                                 player_won = self.check_player_wins(self.get_current_player())
                                 update_ui = True
 
+                elif (event.type == pygame.MOUSEBUTTONUP and not player_won and
+                        self._current_player not in self._computer):
+                    # Click a column, for boards wider than the number keys
+                    clicked = self._gameUI.column_at(event.pos[0])
+                    if clicked is not None:
+                        row = self.add_chip(clicked)
+                        if row > -1:
+                            column = clicked
+                            player_won = self.check_player_wins(self.get_current_player())
+                            update_ui = True
+
             # UI has to be updated
             if update_ui:
                 self._gameUI.draw_board(self.get_current_player(), row, column)
@@ -228,6 +247,20 @@ class Game:
 
 # Main game execution
 if __name__ == "__main__":
-    game = Game()
+    parser = argparse.ArgumentParser(description="Connect 4 for two players on one computer")
+    parser.add_argument("--rows", type=int, default=rules.ROWS)
+    parser.add_argument("--columns", type=int, default=rules.COLUMNS)
+    parser.add_argument("--connect", type=int, default=rules.CONNECT, help="Chips in a row needed to win")
+    parser.add_argument("--computer", choices=["red", "yellow", "both"],
+                        help="let the computer play this color (red moves first)")
+    parser.add_argument("--think", type=float, default=1.0, help="seconds the computer thinks per move")
+    parser.add_argument("--book", help="opening book built by book.py for the computer's early moves")
+    args = parser.parse_args()
+    try:
+        geometry = rules.Geometry(args.rows, args.columns, args.connect)
+    except ValueError as e:
+        parser.error(str(e))
+    computer = {"red": [0], "yellow": [1], "both": [0, 1]}.get(args.computer, [])
+    game = Game(geometry, computer, args.think, args.book)
     game.game_loop()
     pygame.quit()
\ No newline at end of file
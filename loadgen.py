@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import math
+import random
+import shlex
+import sys
+import time
+from protocol import MessageDecoder, encode_message
+from benchmark import free_port, raise_file_limit, start_server
+
+# Headless load generator. Connects a swarm of bots that speak the real
+# protocol: each pair of bots shares a room, readies up, plays full games of
+# random legal moves with a think time between moves and chats while it plays.
+# Reports throughput and the latency from sending a Game_Move to receiving
+# its Game_Update.
+#
+#   python loadgen.py --spawn --users 1000 --games 3
+#   python loadgen.py --port 12345 --users 200 --think 0.5 --chat-rate 0.2
+
+
+class LoadStats:
+    """Counters and latency samples shared by every bot of a run."""
+
+    def __init__(self):
+        self.login_latencies = []
+        self.move_latencies = []
+        self.sent = 0
+        self.received = 0
+        self.moves = 0
+        self.chats = 0
+        self.games = 0
+        self.disconnects = 0
+
+
+class Bot:
+    """One simulated player, playing `games` games against the other bot in its room."""
+
+    def __init__(self, name, room, games, think, chat_rate, codec, stats):
+        self.name = name
+        self.room = room
+        self.games_left = games
+        self.think = think
+        self.chat_rate = chat_rate
+        self.offered_codec = codec
+        self.codec = "json"  # Until the server has picked one
+        self.stats = stats
+        self.decoder = MessageDecoder()
+        self.reader = None
+        self.writer = None
+        self.login_sent = None
+        self.heights = None  # Chips per column of the current game, None between games
+        self.rows = 6
+        self.my_turn = False
+        self.move_sent = None  # When our last Game_Move was sent, until its Game_Update arrives
+        self.first = False  # Seat 0 asks for the restart between games
+        self.done = asyncio.Event()
+        self.tasks = []
+
+    async def run(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.login_sent = time.perf_counter()
+        self.send({"Command": "Check_Username", "User_Name": self.name, "Codecs": [self.offered_codec, "json"]})
+        self.tasks.append(asyncio.ensure_future(self.chat_loop()))
+        try:
+            await self.read_loop()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.writer.close()
+
+    def send(self, message):
+        if self.writer.is_closing():
+            return
+        self.writer.write(encode_message(message, self.codec))
+        self.stats.sent += 1
+
+    async def read_loop(self):
+        while not self.done.is_set():
+            try:
+                data = await self.reader.read(65536)
+            except ConnectionError:
+                data = b""
+            if not data:
+                self.stats.disconnects += 1
+                return
+            for message in self.decoder.feed(data):
+                self.stats.received += 1
+                self.handle(message)
+
+    def handle(self, message):
+        command = message["Command"]
+        if command == "Check_Username":
+            self.stats.login_latencies.append(time.perf_counter() - self.login_sent)
+            self.login_sent = None
+            self.codec = message.get("Codec", "json")
+            self.send({"Command": "Lobby_Subscribe"})
+            self.send({"Command": "Join_Room", "Room_Name": self.room, "User_Name": self.name})
+        elif command == "Join_Room" and message["User_Name"] == self.name:
+            self.ready()
+        elif command == "Game_Restart":
+            self.ready()
+        elif command == "Ping":
+            self.send({"Command": "Pong"})
+        elif command == "Game_Start":
+            state = message["Game_State"]
+            self.heights = [sum(row[column] is not None for row in state["grid"])
+                            for column in range(len(state["grid"][0]))]
+            self.rows = len(state["grid"])
+            self.first = state["players"][0] == self.name
+            self.turn(state["current_player"] == self.name)
+        elif command == "Game_Update":
+            move = message["Move"]
+            if self.heights is None:
+                return
+            self.heights[move["column"]] += 1
+            if move["player"] == self.name:
+                self.stats.move_latencies.append(time.perf_counter() - self.move_sent)
+                self.stats.moves += 1
+                self.move_sent = None
+            self.turn(move["player"] != self.name)
+        elif command == "Game_Over":
+            self.heights = None
+            self.my_turn = False
+            self.games_left -= 1
+            if self.first:
+                self.stats.games += 1
+            if self.games_left <= 0:
+                self.done.set()
+            elif self.first:
+                self.send({"Command": "Restart_Game", "Room_Name": self.room, "User_Name": self.name})
+
+    def ready(self):
+        self.send({"Command": "Ready_Status", "Room_Name": self.room, "User_Name": self.name, "Ready": True})
+
+    def turn(self, mine):
+        self.my_turn = mine
+        if mine:
+            self.tasks.append(asyncio.ensure_future(self.move_after_thinking()))
+
+    async def move_after_thinking(self):
+        if self.think:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.think)
+        if not self.my_turn or self.heights is None:
+            return  # The game ended while we were thinking
+        columns = [column for column, height in enumerate(self.heights) if height < self.rows]
+        self.my_turn = False
+        self.move_sent = time.perf_counter()
+        self.send({"Command": "Game_Move", "Room_Name": self.room, "User_Name": self.name,
+                   "Column": random.choice(columns)})
+
+    async def chat_loop(self):
+        """Chat at chat_rate messages per second on average, while in a game."""
+        if not self.chat_rate:
+            return
+        while True:
+            await asyncio.sleep(random.expovariate(self.chat_rate))
+            if self.heights is not None:
+                self.stats.chats += 1
+                self.send({"Command": "Sending_Message", "Room_Name": self.room, "User_Name": self.name,
+                           "Text": f"gg from {self.name}"})
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_line(name, samples):
+    samples = sorted(samples)
+    if not samples:
+        return f"{name:<6} no samples"
+    return (f"{name:<6} n={len(samples):<7} p50 {percentile(samples, 50) * 1000:8.2f}ms  "
+            f"p95 {percentile(samples, 95) * 1000:8.2f}ms  p99 {percentile(samples, 99) * 1000:8.2f}ms  "
+            f"max {samples[-1] * 1000:8.2f}ms")
+
+
+async def run_swarm(args, port):
+    stats = LoadStats()
+    tag = f"{random.randrange(1 << 24):06x}"  # Keeps names unique across runs against one server
+    bots = [Bot(f"bot{tag}_{i}", f"load{tag}_{i // 2}", args.games, args.think, args.chat_rate, args.codec, stats)
+            for i in range(args.users - args.users % 2)]
+    start = time.perf_counter()
+    tasks = []
+    for i, bot in enumerate(bots):
+        tasks.append(asyncio.ensure_future(bot.run(port)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / len(bots))
+        elif i % 100 == 99:
+            await asyncio.sleep(0)  # Let the accepts keep up
+    done, pending = await asyncio.wait(tasks, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+    failed = [task for task in done if task.exception() is not None]
+    unfinished = sum(not bot.done.is_set() for bot in bots)
+    return stats, elapsed, unfinished, failed
+
+
+def report(args, stats, elapsed, unfinished, failed):
+    print(f"{len(stats.login_latencies)} of {args.users - args.users % 2} bots logged in, "
+          f"{stats.games} games, {stats.moves} moves, {stats.chats} chats in {elapsed:.2f}s")
+    print(f"throughput: {stats.games / elapsed:.1f} games/s  {stats.moves / elapsed:.1f} moves/s  "
+          f"{stats.sent / elapsed:.0f} msgs/s sent  {stats.received / elapsed:.0f} msgs/s received")
+    print(latency_line("login", stats.login_latencies))
+    print(latency_line("move", stats.move_latencies))
+    if failed:
+        print(f"{len(failed)} bots failed, first error: {failed[0].exception()!r}")
+    if unfinished or stats.disconnects:
+        print(f"{unfinished} bots did not finish, {stats.disconnects} were disconnected")
+    return not (unfinished or failed)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Headless bot swarm load test for the Connect 4 server")
+    parser.add_argument("--port", type=int, default=12345, help="port of a server already running on localhost")
+    parser.add_argument("--spawn", action="store_true", help="start a server on a free port for the run instead")
+    parser.add_argument("--server-args", default="", help="extra arguments for the spawned server, e.g. "
+                                                          "\"--engine asyncio\"")
+    parser.add_argument("--users", type=int, default=200, help="bots to connect, two per room")
+    parser.add_argument("--games", type=int, default=3, help="games each pair of bots plays")
+    parser.add_argument("--think", type=float, default=0.05, help="mean seconds a bot thinks before each move")
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="chat messages per second per bot in a game")
+    parser.add_argument("--ramp", type=float, default=0.0, help="spread the connections over this many seconds")
+    parser.add_argument("--codec", default="json", choices=["json", "binary"])
+    parser.add_argument("--timeout", type=float, default=300, help="give up on bots still playing after this")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    raise_file_limit()
+    port, process = args.port, None
+    if args.spawn:
+        port = free_port()
+        process = start_server(port, *shlex.split(args.server_args))
+    try:
+        stats, elapsed, unfinished, failed = asyncio.run(run_swarm(args, port))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    if not report(args, stats, elapsed, unfinished, failed):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import threading
+import time
+from protocol import Frames
+
+# Event names used in Lobby_Update messages
+ROOM_ADDED = "room_added"
+ROOM_REMOVED = "room_removed"
+OCCUPANCY_CHANGED = "occupancy_changed"
+
+
+class LobbyPublisher:
+    """Sends lobby changes to subscribed clients as debounced, incremental updates.
+
+    Room changes only mark the room dirty. The first change in a quiet period
+    schedules a flush `debounce` seconds later, which compares each dirty room
+    with what subscribers last saw and sends the differences as one
+    Lobby_Update. A burst of joins and leaves therefore costs one message per
+    subscriber, and its size depends on the rooms that changed, not on how
+    many rooms exist.
+
+    Clients that never sent Lobby_Subscribe still get the old full Room_State
+    list on each flush.
+    """
+
+    def __init__(self, server, debounce=0.05):
+        self.server = server
+        self.debounce = debounce
+        self.subscribers = set()  # Usernames of subscribed clients
+        self.published = {}  # Room name -> occupancy, as last sent to subscribers
+        self.dirty = set()
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def subscribe(self, username):
+        """Subscribe a client and send it the lobby as subscribers currently see it."""
+        with self.lock:
+            self.subscribers.add(username)
+            connection = self.server.clients.get(username)
+            if connection is not None:
+                self.server.send_message(connection, {
+                    "Command": "Lobby_Snapshot",
+                    "Rooms": dict(self.published)
+                })
+
+    def unsubscribe(self, username):
+        with self.lock:
+            self.subscribers.discard(username)
+
+    def room_changed(self, room_name):
+        """Record that a room was added, removed or changed occupancy."""
+        with self.lock:
+            self.dirty.add(room_name)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.server.call_later(self.debounce, self.flush)
+
+    def flush(self):
+        """Send the changes accumulated since the last flush."""
+        # Sends only queue frames, so holding the lock while sending is cheap and
+        # keeps snapshots and updates in order for every subscriber.
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            self.flush_scheduled = False
+            events = []
+            for room_name in sorted(dirty):
+                old = self.published.get(room_name)
+                new = self.server.lobby_state(room_name)
+                if old is None and new is not None:
+                    events.append((ROOM_ADDED, room_name, new))
+                elif old is not None and new is None:
+                    events.append((ROOM_REMOVED, room_name, 0))
+                elif old != new:
+                    events.append((OCCUPANCY_CHANGED, room_name, new))
+                if new is None:
+                    self.published.pop(room_name, None)
+                else:
+                    self.published[room_name] = new
+            if not events:
+                return
+
+            started = time.perf_counter()
+            frames = Frames({"Command": "Lobby_Update", "Events": events})
+            legacy = []
+            for username, connection in list(self.server.clients.items()):
+                if username in self.subscribers:
+                    self.server.send_frames(connection, frames)
+                else:
+                    legacy.append(connection)
+            self.server.metrics.broadcast("lobby", len(self.server.clients) - len(legacy),
+                                          time.perf_counter() - started)
+            if legacy:
+                self.server.send_room_state(legacy)
@@ -0,0 +1,138 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Structured logging for the server. Code logs through loggers under
+# "connect4" and passes context with extra={"fields": {...}}, e.g.
+#
+#     log.debug("Received message", extra={"fields": {"command": "Game_Move", "room": "r1"}})
+#
+# Records are put on an in-memory queue and formatted and written by a
+# background thread, so a handler thread never waits on stdout. Per-message
+# records are logged at DEBUG, which the default INFO level skips after a
+# single level check.
+
+LOGGER_NAME = "connect4"
+OFF = logging.CRITICAL + 10  # --log-level OFF disables logging entirely
+LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "OFF": OFF,
+}
+
+_listener = None
+
+
+def get_logger(name):
+    """Return a logger under the connect4 namespace."""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+class CommandSampler(logging.Filter):
+    """Pass only one in every N records for the commands listed in rates."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counts = {}
+
+    def filter(self, record):
+        fields = getattr(record, "fields", None)
+        if not fields:
+            return True
+        command = fields.get("command")
+        rate = self.rates.get(command)
+        if not rate or rate <= 1:
+            return True
+        count = self.counts.get(command, 0)
+        self.counts[command] = count + 1  # Racy under threads, which only skews the sample slightly
+        return count % rate == 0
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as `time level logger message key=value ...` or as JSON lines."""
+
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        if self.as_json:
+            entry = {
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage(),
+            }
+            entry.update(fields)
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=repr)
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        line = f"{stamp}.{int(record.msecs):03d} {record.levelname:<7} {record.name} {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value!r}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level="INFO", sample=None, as_json=False, stream=None):
+    """Route connect4 logging through a background writer thread.
+
+    level is one of LEVELS, sample maps command names to a 1-in-N sampling
+    rate. Safe to call again, e.g. in a forked worker process.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(LEVELS[level.upper()] if isinstance(level, str) else level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(StructuredFormatter(as_json))
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    if sample:
+        handler.addFilter(CommandSampler(sample))
+    logger.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def parse_sample_rates(values):
+    """Turn ["Game_Move=100", ...] from the command line into {"Game_Move": 100}."""
+    rates = {}
+    for value in values or []:
+        command, _, rate = value.partition("=")
+        rates[command] = int(rate)
+    return rates
@@ -0,0 +1,225 @@
+import json
+import pickle
+import struct
+
+# Message codecs. Every frame carries the tag of the codec its payload was
+# encoded with, so a decoder can read any codec it accepts and codecs can be
+# mixed on one connection. Which codec the server sends a client is agreed in
+# the Check_Username handshake: the client lists the codecs it speaks in
+# order of preference and the server picks the first one it accepts.
+#
+# Codecs can also peek at the command of a payload without decoding it, which
+# lets the server drop rate-limited messages cheaply.
+#
+# pickle is only kept for compatibility. Unpickling data from the network
+# can run arbitrary code, so it must be enabled explicitly on the server.
+
+
+class CodecError(Exception):
+    """Raised when a payload cannot be decoded."""
+
+
+class PickleCodec:
+    name = "pickle"
+    tag = 1
+
+    def encode(self, message):
+        return self.tag, pickle.dumps(message)
+
+    def decode(self, payload):
+        return pickle.loads(payload)
+
+    def peek(self, payload):
+        return None
+
+
+class JsonCodec:
+    """Compact UTF-8 JSON. Tuples come back as lists."""
+
+    name = "json"
+    tag = 2
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def encode(self, message):
+        return self.tag, self.encoder.encode(message).encode("utf-8")
+
+    def decode(self, payload):
+        try:
+            return json.loads(bytes(payload))
+        except ValueError as e:
+            raise CodecError(f"Invalid JSON payload: {e}")
+
+    def peek(self, payload):
+        """Return the command of a payload we encoded, where "Command" comes first, or None."""
+        if bytes(payload[:len(COMMAND_PREFIX)]) != COMMAND_PREFIX:
+            return None
+        end = bytes(payload[len(COMMAND_PREFIX):len(COMMAND_PREFIX) + 64]).find(b'"')
+        if end < 0:
+            return None
+        command = bytes(payload[len(COMMAND_PREFIX):len(COMMAND_PREFIX) + end])
+        return command.decode("ascii") if command.isascii() and b"\\" not in command else None
+
+
+COMMAND_PREFIX = b'{"Command":"'
+
+
+class BinarySchema:
+    """Fixed layout for one command: a struct of numeric fields followed by length-prefixed strings.
+
+    fields are (path, struct format) pairs, strings are paths; a path is a key,
+    or a tuple of keys into a nested dict such as ("Move", "row").
+
+    These are the hottest messages, so like namedtuple the schema writes its
+    encode and decode functions out in full when it is created: one struct,
+    with the first string's length folded in, and the dict built as a literal.
+    """
+
+    def __init__(self, schema_id, command, fields=(), strings=()):
+        self.schema_id = schema_id
+        self.command = command
+        self.fields = fields
+        self.strings = strings
+        # The schema id, the numbers and the first string's length
+        self.head = struct.Struct("!B" + "".join(fmt for _, fmt in fields) + ("H" if strings else ""))
+        keys = {"Command": None}  # {key: None or {nested key: None}}, in the order decode builds them
+        for path in [path for path, _ in fields] + list(strings):
+            if isinstance(path, tuple):
+                keys.setdefault(path[0], {})[path[1]] = None
+            else:
+                keys[path] = None
+        self.encode, self.decode = self._compile(keys)
+
+    def _compile(self, keys):
+        """Write out encode(message), which returns None for a message of another shape, and decode(payload)."""
+        numbers = [f"v{i}" for i in range(len(self.fields))]
+        strings = [f"s{i}" for i in range(len(self.strings))]
+        values = dict(zip([path for path, _ in self.fields] + list(self.strings), numbers + strings))
+
+        namespace = {"keys": frozenset(keys), "head": self.head, "length": STRING_LENGTH, "schema_id": self.schema_id,
+                     "command": self.command, "CodecError": CodecError}
+        encode = ["def encode(message):",
+                  "    if message.keys() != keys:",
+                  "        return None"]
+        dicts = {}  # Nested key -> the local holding its dict
+        for key, nested in keys.items():
+            if nested is not None:
+                dicts[key] = name = f"nested{len(dicts)}"
+                namespace[f"{name}_keys"] = frozenset(nested)
+                encode.append(f"    {name} = message[{key!r}]")
+                encode.append(f"    if type({name}) is not dict or {name}.keys() != {name}_keys:")
+                encode.append("        return None")
+
+        def source(path):
+            return f"{dicts[path[0]]}[{path[1]!r}]" if isinstance(path, tuple) else f"message[{path!r}]"
+
+        encode += [f"    {name} = {source(path)}.encode()" for path, name in zip(self.strings, strings)]
+        packed = ["schema_id"] + [source(path) for path, _ in self.fields] + [f"len({name})" for name in strings[:1]]
+        parts = [f"head.pack({', '.join(packed)})"] + strings[:1]
+        for name in strings[1:]:
+            parts += [f"length.pack(len({name}))", name]
+        encode.append(f"    return b''.join(({', '.join(parts)}))" if len(parts) > 1 else f"    return {parts[0]}")
+
+        unpacked = ["_"] + numbers + ["n0"][:len(strings)]
+        decode = ["def decode(payload):",
+                  f"    {', '.join(unpacked)}, = head.unpack_from(payload)"]
+        for i, name in enumerate(strings):
+            if not i:
+                decode.append(f"    end = {self.head.size}")
+            else:
+                decode.append(f"    (n{i},) = length.unpack_from(payload, end)")
+                decode.append(f"    end += {STRING_LENGTH.size}")
+            decode.append(f"    {name} = str(payload[end:end + n{i}], 'utf-8')")
+            decode.append(f"    end += n{i}")
+        if strings:
+            decode.append("    if end > len(payload):")  # Slicing past the end only cuts a string short
+            decode.append("        raise CodecError('String runs past the end of the payload')")
+        items = []
+        for key, nested in keys.items():
+            if key == "Command":
+                value = "command"
+            elif nested is None:
+                value = values[key]
+            else:
+                value = "{" + ", ".join(f"{sub!r}: {values[(key, sub)]}" for sub in nested) + "}"
+            items.append(f"{key!r}: {value}")
+        decode.append(f"    return {{{', '.join(items)}}}")
+
+        exec("\n".join(encode + decode), namespace)
+        return namespace["encode"], namespace["decode"]
+
+
+STRING_LENGTH = struct.Struct("!H")
+
+
+class BinaryCodec:
+    """struct-packed payloads for the hot, fixed-shape commands, JSON for everything else."""
+
+    name = "binary"
+    tag = 3
+
+    def __init__(self, schemas, fallback):
+        self.schemas = {schema.command: schema for schema in schemas}
+        self.by_id = {schema.schema_id: schema for schema in schemas}
+        self.encoders = {schema.command: schema.encode for schema in schemas}
+        self.fallback = fallback
+
+    def encode(self, message):
+        encode = self.encoders.get(message.get("Command"))
+        if encode is not None:
+            try:
+                payload = encode(message)
+            except (struct.error, TypeError, AttributeError):
+                payload = None  # A value out of the schema's range, send it as JSON instead
+            if payload is not None:
+                return self.tag, payload
+        return self.fallback.encode(message)
+
+    def peek(self, payload):
+        schema = self.by_id.get(payload[0]) if payload else None
+        return schema.command if schema else None
+
+    def decode(self, payload):
+        if not payload:
+            raise CodecError("Empty binary payload")
+        schema = self.by_id.get(payload[0])
+        if schema is None:
+            raise CodecError(f"Unknown binary schema {payload[0]}")
+        try:
+            return schema.decode(payload)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise CodecError(f"Invalid {schema.command} payload: {e}")
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec([
+    BinarySchema(1, "Game_Move", [("Column", "b")], ["Room_Name", "User_Name"]),
+    BinarySchema(2, "Game_Update", [("Seq", "H"), ("Room_Seq", "I"), (("Move", "player_id"), "B"),
+                                    (("Move", "column"), "b"), (("Move", "row"), "b")],
+                 ["Room_Name", ("Move", "player")]),
+    BinarySchema(3, "Game_Over", [("Seq", "H"), ("Room_Seq", "I")], ["Room_Name", "Winner"]),
+    BinarySchema(4, "Ready_Status", [("Ready", "?")], ["Room_Name", "User_Name"]),
+    BinarySchema(5, "Ping"),
+    BinarySchema(6, "Pong"),
+], JSON)
+PICKLE = PickleCodec()
+
+CODECS = {codec.name: codec for codec in (BINARY, JSON, PICKLE)}
+CODECS_BY_TAG = {codec.tag: codec for codec in CODECS.values()}
+DEFAULT_CODEC = "json"  # Used before a connection has negotiated one
+SAFE_CODECS = ["binary", "json"]  # Codecs that are safe to accept from anyone
+
+
+def register_codec(codec):
+    """Add a codec, which needs a unique name and tag, to the registry."""
+    CODECS[codec.name] = codec
+    CODECS_BY_TAG[codec.tag] = codec
+
+
+def negotiate(offered, accepted):
+    """Return the first codec the client offered that the server accepts, or the default."""
+    for name in offered or ():
+        if name in accepted and name in CODECS:
+            return name
+    return DEFAULT_CODEC
@@ -0,0 +1,249 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logconfig import get_logger
+
+log = get_logger("metrics")
+
+# Server metrics in the Prometheus text format. Counters and histograms are
+# updated on the hot path, so recording one is a dict lookup and an add under
+# an uncontended lock. Gauges for things the server already keeps track of
+# (connections, rooms, queue depths) are computed only when scraped.
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000, 5000)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if labels else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, labels, value) for labels, value in values]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, set directly or computed by collect() at scrape time.
+
+    collect returns a number, or a list of (label values, number) pairs.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        value = self.collect()
+        if isinstance(value, list):
+            return [(self.name, labels, number) for labels, number in value]
+        return [(self.name, (), value)]
+
+
+class CounterFunc(Gauge):
+    """Counter whose values are read from somewhere else when scraped."""
+
+    kind = "counter"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = buckets
+        self.values = {}  # Label values -> [count per bucket (last is +Inf), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.bounds) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((f"{self.name}_bucket", labels + (le,), cumulative, self.labels + ("le",)))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    """Named metrics, rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self.add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                log.warning(f"Error collecting metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample in samples:
+                name, labels, value = sample[:3]
+                names = sample[3] if len(sample) > 3 else metric.labels
+                lines.append(f"{name}{format_labels(names, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(Registry):
+    """Everything the chat server reports about itself."""
+
+    def __init__(self, server, commands):
+        super().__init__()
+        self.server = server
+        self.commands = commands  # Commands get their own label, anything else counts as "other"
+        self.started = time.time()
+        self.handler_seconds = self.histogram(
+            "connect4_handler_seconds",
+            "Time to handle a client message by command; the count is the number of messages received",
+            ("command",))
+        self.room_call_delay = self.histogram(
+            "connect4_room_call_queue_seconds", "Time room calls waited in their room actor's mailbox")
+        self.room_call_seconds = self.histogram(
+            "connect4_room_call_seconds", "Time to run a room call (ready status, move, restart) on a room actor")
+        self.broadcast_recipients = self.histogram(
+            "connect4_broadcast_recipients", "Recipients per broadcast", ("scope",), SIZE_BUCKETS)
+        self.broadcast_seconds = self.histogram(
+            "connect4_broadcast_seconds", "Time to encode and queue a broadcast for all its recipients", ("scope",))
+        self.frames_dropped = self.counter(
+            "connect4_frames_dropped_total", "Low-priority frames dropped for clients over their high watermark")
+        self.bot_search_seconds = self.histogram(
+            "connect4_bot_search_seconds", "Time the bot searched for a move; the count is the number of bot moves",
+            buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0))
+        self.bot_nodes = self.counter(
+            "connect4_bot_nodes_total", "Positions the bot searched; divided by the search seconds, nodes per second")
+        self.connections = self.gauge("connect4_connections", "Open client connections")
+        self.gauge("connect4_users", "Logged-in users", collect=lambda: len(server.clients))
+        self.gauge("connect4_rooms", "Rooms", collect=lambda: len(server.rooms))
+        self.gauge("connect4_games", "Games in progress",
+                   collect=lambda: sum(not game.game_over for game in list(server.games.values())))
+        self.gauge("connect4_outbound_queued_bytes", "Bytes waiting to be written to clients",
+                   ("stat",), collect=self.queued_bytes)
+        self.gauge("connect4_room_actor_mailbox", "Room calls waiting in room actor mailboxes",
+                   collect=lambda: sum(stats["queued"] for stats in server.actors.queue_delays().values()))
+        self.gauge("connect4_timers", "Timers on the timing wheel", collect=lambda: len(server.wheel))
+        self.add(CounterFunc("connect4_room_actor_errors_total", "Room calls that raised",
+                             collect=lambda: server.actors.errors))
+        self.add(CounterFunc("connect4_throttled_total", "Client messages dropped by rate limits",
+                             ("command",), collect=self.throttled))
+        self.gauge("connect4_uptime_seconds", "Seconds since the server started",
+                   collect=lambda: round(time.time() - self.started, 3))
+
+    def handled(self, command, seconds):
+        self.handler_seconds.observe(seconds, (command if command in self.commands else "other",))
+
+    def room_call(self, delay, seconds):
+        self.room_call_delay.observe(delay)
+        self.room_call_seconds.observe(seconds)
+
+    def bot_search(self, result):
+        self.bot_search_seconds.observe(result.seconds)
+        self.bot_nodes.inc(amount=result.nodes)
+
+    def broadcast(self, scope, recipients, seconds):
+        labels = (scope,)
+        self.broadcast_recipients.observe(recipients, labels)
+        self.broadcast_seconds.observe(seconds, labels)
+
+    def queued_bytes(self):
+        with self.server.lock:
+            connections = list(self.server.clients.values())
+        depths = [getattr(connection, "queued_bytes", 0) for connection in connections]
+        return [(("total",), sum(depths)), (("max",), max(depths, default=0))]
+
+    def throttled(self):
+        return [((command,), count) for command, count in self.server.rate_limits.snapshot()["by_command"].items()]
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the log
+
+
+def serve_metrics(registry, host, port):
+    """Serve registry at http://host:port/metrics from a background thread; returns the HTTP server."""
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"registry": registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving metrics on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
@@ -0,0 +1,164 @@
+import collections
+import socket
+import threading
+import time
+from logconfig import get_logger
+from message_codecs import DEFAULT_CODEC
+
+log = get_logger("outbound")
+
+# Messages that may be dropped for a slow client. Chat and room lists are
+# superseded by the next one anyway; game messages are never dropped.
+LOW_PRIORITY_COMMANDS = {"Sending_Message", "Room_State"}
+
+
+class Backpressure:
+    """Watermarks that decide what happens to a message sent to a backed-up client.
+
+    Once a connection has more than high_watermark bytes waiting it only
+    accepts high-priority messages until it drains below low_watermark. A
+    connection that stays above the high watermark for evict_after seconds, or
+    that reaches hard_limit bytes, is disconnected.
+    """
+
+    SEND = "send"
+    DROP = "drop"
+    EVICT = "evict"
+
+    def __init__(self, high_watermark=256 * 1024, low_watermark=64 * 1024, evict_after=10.0, hard_limit=None):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.evict_after = evict_after
+        self.hard_limit = hard_limit if hard_limit is not None else 4 * high_watermark
+
+
+class BackpressureState:
+    """Tracks whether one connection is currently over its high watermark."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.over_since = None
+        self.dropped = 0
+
+    def admit(self, queued_bytes, size, droppable):
+        """Return Backpressure.SEND, DROP or EVICT for a message of size bytes."""
+        policy = self.policy
+        if self.over_since is not None:
+            if queued_bytes + size > policy.hard_limit or time.monotonic() - self.over_since > policy.evict_after:
+                return Backpressure.EVICT
+            if droppable:
+                self.dropped += 1
+                return Backpressure.DROP
+        elif queued_bytes + size >= policy.high_watermark:
+            self.over_since = time.monotonic()
+        return Backpressure.SEND
+
+    def drained(self, queued_bytes):
+        """Called as the queue shrinks, clears the over-limit state below the low watermark."""
+        if self.over_since is not None and queued_bytes <= self.policy.low_watermark:
+            self.over_since = None
+
+
+class QueuedConnection:
+    """Client socket with a bounded outbound queue drained by its own writer thread.
+
+    sendall() never blocks, so a slow client only ever stalls its own writer
+    thread, never the thread that is broadcasting to it.
+    """
+
+    def __init__(self, sock, backpressure=None):
+        self.sock = sock
+        self.state = BackpressureState(backpressure or Backpressure())
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stopped = False
+        self.last_seen = time.monotonic()  # Last time anything was read from the client
+        self.idle_timer = None
+        self.codec = DEFAULT_CODEC  # Codec the client negotiated for what we send it
+        self.writer = threading.Thread(target=self.drain, daemon=True)
+        self.writer.start()
+
+    @property
+    def active(self):
+        return not self.closed and not self.stopped
+
+    def sendall(self, frame, droppable=False):
+        """Queue a frame for sending, returns False if it was dropped."""
+        with self.condition:
+            if self.closed:
+                return False
+            decision = self.state.admit(self.queued_bytes, len(frame), droppable)
+            if decision == Backpressure.DROP:
+                return False
+            if decision == Backpressure.EVICT:
+                log.warning("Evicting slow client", extra={"fields": {"addr": self.peer(), "queued_bytes": self.queued_bytes}})
+                self.evict()
+                return False
+            self.frames.append(frame)
+            self.queued_bytes += len(frame)
+            self.condition.notify()
+        return True
+
+    def drain(self):
+        """Writer thread: send queued frames until the connection is closed or stopped."""
+        while True:
+            with self.condition:
+                while not self.frames and not self.closed and not self.stopped:
+                    self.condition.wait()
+                if not self.frames:
+                    return
+                frame = self.frames.popleft()
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.evict()
+                return
+            with self.condition:
+                self.queued_bytes -= len(frame)
+                self.state.drained(self.queued_bytes)
+                if not self.queued_bytes:
+                    self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued frame has been written, returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queued_bytes or self.closed, timeout)
+
+    def stop(self):
+        """Stop the writer thread after it has sent what is queued, leaving the socket open."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.writer.join()
+
+    def evict(self):
+        """Disconnect the client; its reader sees the connection close and cleans up."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.condition.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes a reader blocked on the socket
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def peer(self):
+        try:
+            return self.sock.getpeername()
+        except OSError:
+            return None
@@ -0,0 +1,346 @@
+import bisect
+import cProfile
+import collections
+import inspect
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from logconfig import get_logger
+
+log = get_logger("profiling")
+
+# On-demand profiling of a running server, started from the admin socket.
+# While a session is active the server runs every client command through
+# Profiler.run(), which labels the thread with the command so results can be
+# broken down per command; room calls queued by a command keep its label.
+# Three kinds of session:
+#
+#   cprofile     cProfile of a random sample of commands, top functions by
+#                cumulative time per command
+#   tracemalloc  allocations made during the window, top sites overall and
+#                per command
+#   stacks       wall-clock stack samples of threads running a command, as
+#                collapsed stacks for flamegraph.pl or speedscope
+#
+# Stack samples are taken by the threads running commands themselves, from a
+# sys.setprofile() hook that charges every interval of command time to the
+# stack running when it elapses. A sampler thread waking up on its own would
+# rarely see a command: most finish well within the interpreter's switch
+# interval and give up the GIL only once they block reading the next message.
+# Threads not running a command are sampled from a background thread, with
+# --all-threads.
+#
+# Nothing is recorded, and the only cost is one attribute check per command,
+# while no session is running.
+
+PLUMBING = {"handle_client", "handle_message", "run_locked", "data_received"}
+
+
+class ProfileSession:
+    """Base session: labels threads with the command they are running."""
+
+    def __init__(self, top=25):
+        self.top = top
+        self.labels = {}  # Thread id -> command it is running
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def run(self, label, function, *args):
+        thread = threading.get_ident()
+        outer = self.labels.get(thread)
+        self.labels[thread] = label
+        try:
+            return self.call(label, function, args)
+        finally:
+            if outer is None:
+                self.labels.pop(thread, None)
+            else:
+                self.labels[thread] = outer
+
+    def call(self, label, function, args):
+        return function(*args)
+
+    def report(self):
+        return {}
+
+
+class CProfileSession(ProfileSession):
+    """cProfile a random sample of commands, one profile per sampled call."""
+
+    def __init__(self, top=25, sample=0.1):
+        super().__init__(top)
+        self.sample = sample
+        self.profiles = collections.defaultdict(list)  # Command -> profiles of its sampled calls
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def call(self, label, function, args):
+        with self.lock:
+            self.calls[label] += 1
+        if random.random() >= self.sample:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return function(*args)  # Another profiler is running on this thread
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles[label].append(profile)
+
+    def report(self):
+        with self.lock:
+            profiles = {label: list(runs) for label, runs in self.profiles.items()}
+            calls = dict(self.calls)
+        sections = []
+        ranked = sorted(profiles.items(), key=lambda item: -pstats.Stats(*item[1]).total_tt)
+        for label, runs in ranked:
+            out = io.StringIO()
+            stats = pstats.Stats(*runs, stream=out)
+            stats.strip_dirs().sort_stats("cumulative").print_stats(self.top)
+            sections.append(f"=== {label}: {len(runs)} of {calls.get(label, 0)} calls profiled, "
+                            f"{stats.total_tt * 1000:.1f}ms total ===\n{out.getvalue().strip()}")
+        return {"Report": "\n\n".join(sections) or "No commands ran"}
+
+
+class TracemallocSession(ProfileSession):
+    """Trace allocations during the window and attribute them to commands."""
+
+    def __init__(self, server, top=25, frames=32):
+        super().__init__(top)
+        self.code_map = CodeMap(type(server))
+        self.frames = frames
+        self.started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        self.before = tracemalloc.take_snapshot()
+
+    def stop(self):
+        self.after = tracemalloc.take_snapshot()
+        self.current, self.peak = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+    def report(self):
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        after = self.after.filter_traces(ignore)
+        lines = [f"Traced memory: {self.current / 1024:.1f} KiB now, {self.peak / 1024:.1f} KiB peak",
+                 f"=== Top {self.top} allocation sites, growth during the window ==="]
+        for stat in after.compare_to(self.before.filter_traces(ignore), "lineno")[:self.top]:
+            lines.append(str(stat))
+
+        # Blocks still allocated at the end, grouped by the command that allocated them
+        by_label = collections.defaultdict(collections.Counter)
+        for trace in after.traces:
+            frame = trace.traceback[-1]
+            by_label[self.code_map.attribute(trace.traceback)][f"{frame.filename}:{frame.lineno}"] += trace.size
+        totals = sorted(by_label.items(), key=lambda item: -sum(item[1].values()))
+        lines.append("=== Live allocations by command ===")
+        for label, sites in totals[:self.top]:
+            lines.append(f"{label}: {sum(sites.values()) / 1024:.1f} KiB")
+            for site, size in sites.most_common(3):
+                lines.append(f"    {size / 1024:8.1f} KiB  {site}")
+        return {"Report": "\n".join(lines)}
+
+
+class StackSession(ProfileSession):
+    """Sample the stacks of threads running a command every interval of the time they spend in it."""
+
+    def __init__(self, top=25, interval=0.005, all_threads=False):
+        super().__init__(top)
+        self.interval = interval
+        self.all_threads = all_threads
+        self.stacks = collections.Counter()  # "label;frame;frame" -> samples
+        self.lock = threading.Lock()  # Guards stacks, commands may still finish while the report is made
+        self.pending = 0.0  # Command time, over all threads, not yet charged to a sample
+        self.state = threading.local()  # since: when the thread's command time was last counted
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample_loop, name="stack-sampler", daemon=True)
+
+    def start(self):
+        if self.all_threads:
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.all_threads:
+            self.thread.join()
+
+    def call(self, label, function, args):
+        state = self.state
+        if getattr(state, "since", None) is not None:
+            return function(*args)  # Already sampling this thread
+        state.since = time.perf_counter()
+        previous = sys.getprofile()
+        sys.setprofile(self.on_event)
+        try:
+            return function(*args)
+        finally:
+            sys.setprofile(previous)
+            self.on_event(sys._getframe(), "return", None)
+            state.since = None
+
+    def on_event(self, frame, event, arg):
+        """Profile hook: charge the command time since the last event, sampling every full interval."""
+        now = time.perf_counter()
+        state = self.state
+        # Shared by all threads without a lock, a lost update only loses a fraction of a sample
+        pending = self.pending + now - state.since
+        state.since = now
+        if pending < self.interval:
+            self.pending = pending
+            return
+        samples = int(pending // self.interval)
+        self.pending = pending - samples * self.interval
+        self.record(self.labels.get(threading.get_ident(), "other"), frame, samples)
+
+    def record(self, label, frame, samples=1):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename != __file__:  # Leave our own wrappers out of the stacks
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(label)
+        with self.lock:
+            self.stacks[";".join(reversed(stack))] += samples
+
+    def sample_loop(self):
+        """Sample the threads not running a command, for --all-threads."""
+        me = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == me or thread in self.labels:
+                    continue
+                if thread not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                self.record(f"[{names.get(thread, thread)}]", frame)
+
+    def report(self):
+        with self.lock:
+            stacks = collections.Counter(self.stacks)
+        total = sum(stacks.values())
+        by_label = collections.Counter()
+        for stack, count in stacks.items():
+            by_label[stack.split(";", 1)[0]] += count
+        lines = [f"{total} samples every {self.interval * 1000:g}ms"]
+        for label, count in by_label.most_common(self.top):
+            lines.append(f"{count:8d}  {count / max(total, 1):6.1%}  {label}")
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+        return {"Report": "\n".join(lines), "Stacks": collapsed}
+
+
+class CodeMap:
+    """Maps a tracemalloc traceback to the command, or server method, that made the allocation."""
+
+    def __init__(self, server_class):
+        self.methods = {}  # File name -> sorted [(first line, last line, method name)]
+        router = getattr(server_class, "router", None)
+        self.handlers = router.handler_names() if router else {}  # Handler method name -> command
+        for cls in server_class.__mro__:
+            for name, function in vars(cls).items():
+                if not inspect.isfunction(function):
+                    continue
+                try:
+                    lines, first = inspect.getsourcelines(function)
+                except (OSError, TypeError):
+                    continue
+                filename = function.__code__.co_filename
+                self.methods.setdefault(filename, []).append((first, first + len(lines) - 1, name))
+        for ranges in self.methods.values():
+            ranges.sort()
+
+    def method_at(self, filename, lineno):
+        ranges = self.methods.get(filename)
+        if not ranges:
+            return None
+        index = bisect.bisect_right(ranges, (lineno, float("inf"), "")) - 1
+        if index >= 0 and ranges[index][0] <= lineno <= ranges[index][1]:
+            return ranges[index][2]
+        return None
+
+    def attribute(self, traceback):
+        """Label for the outermost server method in a traceback that is not dispatch plumbing.
+
+        Allocations made by the plumbing itself, such as decoding messages in
+        handle_client, get the innermost plumbing method instead.
+        """
+        plumbing = "other"
+        for frame in traceback:  # Oldest frame first
+            name = self.method_at(frame.filename, frame.lineno)
+            if name in self.handlers:
+                return self.handlers[name]
+            if name in PLUMBING:
+                plumbing = name
+            elif name is not None:
+                return name
+        return plumbing
+
+
+class Profiler:
+    """Runs one profiling session at a time for the server."""
+
+    def __init__(self, server):
+        self.server = server
+        self.session = None
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.session is not None
+
+    def run(self, label, function, *args):
+        """Run function(*args) as part of the current session, labelled with a command."""
+        session = self.session
+        if session is None:
+            return function(*args)
+        return session.run(label, function, *args)
+
+    def wrap(self, function):
+        """Return function bound to the current thread's label, for work handed to another thread."""
+        session = self.session
+        label = session.labels.get(threading.get_ident()) if session else None
+        if label is None:
+            return function
+        return lambda *args: self.run(label, function, *args)
+
+    def profile(self, mode, seconds, top=25, sample=0.1, interval=0.005, frames=32, all_threads=False):
+        """Profile for `seconds` and return the report; raises RuntimeError if a session is already running."""
+        if mode == "cprofile":
+            session = CProfileSession(top, sample)
+        elif mode == "tracemalloc":
+            session = TracemallocSession(self.server, top, frames)
+        elif mode == "stacks":
+            session = StackSession(top, interval, all_threads)
+        else:
+            raise ValueError(f"Unknown profiling mode {mode}")
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError("A profiling session is already running")
+            session.start()
+            self.session = session
+        log.info("Profiling started", extra={"fields": {"mode": mode, "seconds": seconds}})
+        try:
+            time.sleep(seconds)
+        finally:
+            with self.lock:
+                self.session = None
+            session.stop()
+        log.info("Profiling finished", extra={"fields": {"mode": mode}})
+        return session.report()
@@ -0,0 +1,134 @@
+import struct
+from message_codecs import CODECS, CODECS_BY_TAG, DEFAULT_CODEC, SAFE_CODECS, JSON, CodecError
+
+# Every message on the wire is a 4-byte big-endian payload length and a 1-byte
+# codec tag, followed by the message dict encoded with that codec (see
+# message_codecs.py). TCP is a byte stream, so a single recv can hold several
+# messages or only part of one; MessageDecoder takes care of that.
+HEADER = struct.Struct("!IB")
+HEADER_SIZE = HEADER.size
+MAX_MESSAGE_SIZE = 1048576  # Same limit the old single recv() used
+RECV_BUFFER_SIZE = 65536
+
+
+class FramingError(Exception):
+    """Raised when the incoming byte stream is not a valid sequence of frames."""
+
+
+def encode_message(message, codec=DEFAULT_CODEC, max_message_size=MAX_MESSAGE_SIZE):
+    """Serialize a message dict into a single length-prefixed frame using the named codec."""
+    tag, payload = CODECS[codec].encode(message)
+    if len(payload) > max_message_size:
+        raise FramingError(f"Message too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), tag) + payload
+
+
+class Frames:
+    """One message and its frame for each codec, encoded the first time a codec asks.
+
+    Lets a broadcast encode a message once per codec in use rather than once
+    per recipient.
+    """
+
+    __slots__ = ("message", "frames")
+
+    def __init__(self, message):
+        self.message = message
+        self.frames = {}
+
+    def get(self, codec=DEFAULT_CODEC):
+        frame = self.frames.get(codec)
+        if frame is None:
+            frame = self.frames[codec] = encode_message(self.message, codec)
+        return frame
+
+
+class MessageDecoder:
+    """Incremental decoder that turns a stream of bytes back into messages.
+
+    Only frames in one of the accepted codecs (JSON is always accepted) are
+    decoded; anything else is a FramingError. If admit is given, admit(command)
+    is asked about every message and those it refuses are skipped, without
+    decoding them when the codec can peek at the command.
+    """
+
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE, codecs=SAFE_CODECS, admit=None):
+        self.max_message_size = max_message_size
+        self.admit = admit
+        self._codecs = {JSON.tag: JSON}
+        for name in codecs:
+            self._codecs[CODECS[name].tag] = CODECS[name]
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every complete message now available."""
+        self._buffer += data
+        messages = []
+        buffer = self._buffer
+        offset = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= HEADER_SIZE:
+                length, tag = HEADER.unpack_from(buffer, offset)
+                if length > self.max_message_size:
+                    raise FramingError(f"Frame too large: {length} bytes")
+                end = offset + HEADER_SIZE + length
+                if len(buffer) < end:
+                    break
+                codec = self._codecs.get(tag)
+                if codec is None:
+                    codec_name = CODECS_BY_TAG[tag].name if tag in CODECS_BY_TAG else tag
+                    raise FramingError(f"Codec {codec_name} not accepted")
+                with view[offset + HEADER_SIZE:end] as payload:
+                    offset = end
+                    message = self._decode(codec, payload)
+                if message is not None:
+                    messages.append(message)
+        if offset:
+            del buffer[:offset]
+        return messages
+
+    def _decode(self, codec, payload):
+        """Decode one payload, or return None if admit refuses its command."""
+        command = codec.peek(payload) if self.admit else None
+        if command is not None and not self.admit(command):
+            return None
+        try:
+            message = codec.decode(payload)
+        except CodecError as e:
+            raise FramingError(str(e))
+        if not isinstance(message, dict) or not isinstance(message.get("Command"), str):
+            raise FramingError("Message is not a command")
+        if self.admit:
+            if command is None:
+                if not self.admit(message["Command"]):
+                    return None
+            elif message["Command"] != command:
+                raise FramingError("Command does not match its payload")  # e.g. a duplicate JSON key
+        return message
+
+    def pending(self):
+        """Return the bytes of any partial frame still waiting for more data."""
+        return bytes(self._buffer)
+
+
+class MessageReader:
+    """Read framed messages from a blocking socket using one reusable buffer."""
+
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE, codecs=SAFE_CODECS, admit=None):
+        self.sock = sock
+        self.decoder = MessageDecoder(codecs=codecs, admit=admit)
+        self._recv_buffer = bytearray(buffer_size)
+        self._recv_view = memoryview(self._recv_buffer)
+
+    def read_messages(self):
+        """Block until data arrives and return the complete messages it finished.
+
+        Returns None once the peer has closed the connection.
+        """
+        while True:
+            count = self.sock.recv_into(self._recv_buffer)
+            if not count:
+                return None
+            messages = self.decoder.feed(self._recv_view[:count])
+            if messages:
+                return messages
@@ -0,0 +1,156 @@
+import collections
+import heapq
+import threading
+import time
+from protocol import FramingError
+from logconfig import get_logger
+
+log = get_logger("ratelimit")
+
+# Flood protection. Every connection gets a token bucket per command, so a
+# client spamming chat or ready toggles, each of which fans out to a whole
+# room, is cut off after a short burst instead of costing O(clients) work per
+# message. Over-limit frames are dropped by the decoder, before their payload
+# is decoded when the codec can tell the command from the first bytes.
+
+# Budgets as (messages per second, burst). Commands not listed share the
+# "default" bucket, so made-up command names cannot create unbounded buckets.
+DEFAULT_BUDGETS = {
+    "Check_Username": (1, 5),
+    "Lobby_Subscribe": (1, 3),
+    "Create_Room": (1, 5),
+    "Join_Room": (2, 10),
+    "Sending_Message": (5, 10),
+    "Ready_Status": (2, 5),
+    "Game_Move": (10, 20),
+    "Game_Sync": (2, 5),
+    "Restart_Game": (1, 3),
+    "default": (20, 40),
+}
+
+
+class FloodError(FramingError):
+    """Raised for a connection that keeps sending over its limits; the server disconnects it."""
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token, returns False if the bucket is empty."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimits:
+    """Server-wide budgets and the counters of what was throttled, by command and by client.
+
+    A rate of 0 leaves a command unlimited. A connection that has max_strikes
+    messages in a row throttled is disconnected. Only the max_clients clients
+    throttled most recently are counted, so the counters stay bounded however
+    many clients come and go.
+    """
+
+    def __init__(self, budgets=None, max_strikes=200, enabled=True, max_clients=1024):
+        self.budgets = dict(DEFAULT_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.max_strikes = max_strikes
+        self.enabled = enabled
+        self.by_command = collections.Counter()
+        self.max_clients = max_clients
+        self.by_client = collections.OrderedDict()  # Client -> messages throttled, least recently throttled first
+        self.disconnected = 0
+        self.lock = threading.Lock()
+
+    def limiter(self, addr):
+        """Return the limiter for a new connection."""
+        return ConnectionLimiter(self, addr)
+
+    def budget(self, command):
+        """Return the bucket key and (rate, burst) for a command."""
+        if command in self.budgets:
+            return command, self.budgets[command]
+        return "default", self.budgets["default"]
+
+    def record(self, client, bucket):
+        """Count a throttled message under its bucket: its command, or "default" for unlisted ones."""
+        with self.lock:
+            self.by_command[bucket] += 1
+            self.by_client[client] = self.by_client.pop(client, 0) + 1
+            if len(self.by_client) > self.max_clients:
+                self.by_client.popitem(last=False)
+
+    def snapshot(self, top=10):
+        """Throttle counters, with the clients throttled most."""
+        with self.lock:
+            return {
+                "throttled": sum(self.by_command.values()),
+                "by_command": dict(self.by_command),
+                "top_clients": heapq.nlargest(top, self.by_client.items(), key=lambda item: item[1]),
+                "disconnected": self.disconnected,
+            }
+
+
+class ConnectionLimiter:
+    """Token buckets of one connection, created as commands are first seen."""
+
+    def __init__(self, limits, addr):
+        self.limits = limits
+        # Counted by host until the client logs in, so reconnecting from new ports adds no counters
+        self.host = addr[0] if isinstance(addr, tuple) else addr
+        self.user = None  # Set once the client has logged in, for the counters
+        self.buckets = {}
+        self.strikes = 0  # Messages throttled in a row
+        self.throttled = 0
+
+    def allow(self, command):
+        """Return True if the connection may send this command now, False to drop it.
+
+        Raises FloodError once the connection has been over its limits for too long.
+        """
+        limits = self.limits
+        if not limits.enabled:
+            return True
+        key, (rate, burst) = limits.budget(command)
+        if not rate:
+            return True
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        if bucket.take():
+            self.strikes = 0
+            return True
+        self.strikes += 1
+        self.throttled += 1
+        client = self.user or self.host
+        limits.record(client, key)  # By bucket, so made-up commands all count as "default"
+        if self.strikes == 1:
+            log.warning("Throttling client", extra={"fields": {"client": client, "command": command,
+                                                                "throttled": self.throttled}})
+        if self.strikes >= limits.max_strikes:
+            with limits.lock:
+                limits.disconnected += 1
+            raise FloodError(f"Flooding: {self.strikes} messages in a row over the rate limit")
+        return False
+
+
+def parse_budgets(values):
+    """Turn ["Sending_Message=5/10", ...] from the command line into {"Sending_Message": (5.0, 10)}."""
+    budgets = {}
+    for value in values or []:
+        command, _, budget = value.partition("=")
+        rate, _, burst = budget.partition("/")
+        rate = float(rate)
+        budgets[command] = (rate, int(burst) if burst else max(1, int(rate)))
+    return budgets
@@ -0,0 +1,112 @@
+import time
+from logconfig import get_logger
+
+log = get_logger("router")
+
+# Command dispatch. Server methods register as the handler of a command along
+# with the fields its messages must carry, and every message is looked up in
+# one dict instead of walking an if/elif chain. Messages are validated before
+# the handler runs, so a malformed or unknown command gets an Error reply
+# instead of raising halfway through a handler and dropping the connection.
+#
+#   @router.command("Game_Move", Room_Name=str, User_Name=str, Column=int)
+#   def on_game_move(self, client_socket, message, username):
+#       ...
+#
+# A handler returns the connection's username if the command changed it
+# (logging in, resuming a session), otherwise None.
+#
+# Usernames the server keeps for itself (the bot's) are refused in any
+# User_Name a client sends, whichever command carries it.
+
+
+class Route:
+    __slots__ = ("command", "method", "fields", "optional")
+
+    def __init__(self, command, method, fields, optional):
+        self.command = command
+        self.method = method  # Looked up on the server, so subclasses can override handlers
+        self.fields = fields
+        self.optional = optional
+
+    def validate(self, message):
+        """Return what is wrong with a message, or None if it matches the schema."""
+        for name, kind in self.fields.items():
+            if name not in message:
+                return f"Missing field {name}"
+            if not matches(message[name], kind):
+                return f"Field {name} must be {type_name(kind)}"
+        for name, kind in self.optional.items():
+            value = message.get(name)
+            if value is not None and not matches(value, kind):
+                return f"Field {name} must be {type_name(kind)}"
+        return None
+
+
+def matches(value, kind):
+    if kind is int:
+        return isinstance(value, int) and not isinstance(value, bool)  # True is an int to Python
+    return isinstance(value, kind)
+
+
+def type_name(kind):
+    if isinstance(kind, tuple):
+        return " or ".join(k.__name__ for k in kind)
+    return kind.__name__
+
+
+class Router:
+    """Registry of command handlers and their message schemas."""
+
+    def __init__(self, reserved_names=None):
+        self.routes = {}
+        self.reserved_names = reserved_names or {}  # Username -> why clients may not use it
+
+    def command(self, command, optional=None, **fields):
+        """Decorator registering a server method as the handler of a command.
+
+        fields maps each required field to its type, optional the fields that
+        may be missing or None.
+        """
+        def register(method):
+            self.routes[command] = Route(command, method.__name__, fields, optional or {})
+            return method
+        return register
+
+    def commands(self):
+        return frozenset(self.routes)
+
+    def handler_names(self):
+        """Return {handler method name: command}."""
+        return {route.method: command for command, route in self.routes.items()}
+
+    def dispatch(self, server, client_socket, message, username):
+        """Validate a message, run its handler timed, and return the connection's username."""
+        command = message["Command"]
+        route = self.routes.get(command)
+        if route is None:
+            self.reject(server, client_socket, command, f"Unknown command {command}", username)
+            server.metrics.handled(command, 0.0)
+            return username
+        problem = route.validate(message)
+        name = message.get("User_Name")
+        if problem is None and isinstance(name, str) and name in self.reserved_names:
+            problem = f"{name} is {self.reserved_names[name]}"
+        if problem is not None:
+            self.reject(server, client_socket, command, problem, username)
+            server.metrics.handled(command, 0.0)
+            return username
+        started = time.perf_counter()
+        try:
+            result = getattr(server, route.method)(client_socket, message, username)
+        except Exception as e:
+            log.exception(f"Error handling {command}: {e}", extra={"fields": {"user": username}})
+            server.send_message(client_socket, {"Command": "Error", "For": command, "Error": "Internal error"})
+            result = None
+        finally:
+            server.metrics.handled(command, time.perf_counter() - started)
+        return username if result is None else result
+
+    def reject(self, server, client_socket, command, problem, username):
+        log.info("Rejected message", extra={"fields": {"command": command, "error": problem, "user": username}})
+        server.send_message(client_socket, {"Command": "Error", "For": command, "Error": problem})
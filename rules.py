@@ -0,0 +1,180 @@
+# Connect 4 rules on bitboards, shared by the server, the client and the
+# local game.
+#
+# A position is two integers: the stones of the player to move and every
+# occupied cell. Each column takes rows + 1 bits, bottom row first, and the
+# extra bit on top stays empty so a shift never carries a line from one
+# column into the next. On the standard 6x7 board:
+#
+#   6 13 20 27 34 41 48    <- always empty
+#   5 12 19 26 33 40 47
+#   4 11 18 25 32 39 46
+#   3 10 17 24 31 38 45
+#   2  9 16 23 30 37 44
+#   1  8 15 22 29 36 43
+#   0  7 14 21 28 35 42
+#
+# A position also keeps the height of every column and the number of moves,
+# so a move touches one bit, the win check after it only follows the four
+# lines through the new chip, and a full board is a comparison of the move
+# count. Every move costs the same however full the board is.
+# Geometry.alignment() checks a whole board at once with shift-and-mask
+# tests, about log2(connect) of them per direction.
+#
+# Rooms can use other board sizes and line lengths (see Geometry); the layout
+# is the same with taller columns or more of them. Python integers have no
+# fixed width, so large boards just make the integers longer.
+
+MIN_SIZE = 4
+MAX_SIZE = 16
+MIN_CONNECT = 3
+
+
+class Geometry:
+    """Board size and winning line length of a game variant, and the bit layout that follows from them."""
+
+    __slots__ = ("rows", "columns", "connect", "h1", "size", "directions")
+
+    def __init__(self, rows=6, columns=7, connect=4):
+        if not (MIN_SIZE <= rows <= MAX_SIZE and MIN_SIZE <= columns <= MAX_SIZE):
+            raise ValueError(f"Rows and columns must be between {MIN_SIZE} and {MAX_SIZE}")
+        if not MIN_CONNECT <= connect <= max(rows, columns):
+            raise ValueError(f"Connect must be between {MIN_CONNECT} and the longer side of the board")
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.h1 = rows + 1  # Bits per column, including the empty guard bit
+        self.size = rows * columns
+        self.directions = (1, self.h1, self.h1 - 1, self.h1 + 1)  # Vertical, horizontal and the two diagonals
+
+    def __eq__(self, other):
+        return isinstance(other, Geometry) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Geometry({self.rows}, {self.columns}, {self.connect})"
+
+    def key(self):
+        return (self.rows, self.columns, self.connect)
+
+    def cell(self, row, column):
+        return 1 << (column * self.h1 + row)
+
+    def alignment(self, stones):
+        """Return True if stones contain `connect` in a row in any direction."""
+        connect = self.connect
+        for shift in self.directions:
+            # Each step doubles the run length every remaining bit stands for
+            runs, length = stones, 1
+            while length * 2 <= connect:
+                runs &= runs >> (length * shift)
+                length *= 2
+            if length < connect:
+                runs &= runs >> ((connect - length) * shift)
+            if runs:
+                return True
+        return False
+
+
+STANDARD = Geometry()
+ROWS = STANDARD.rows
+COLUMNS = STANDARD.columns
+CONNECT = STANDARD.connect
+
+
+def alignment(stones, geometry=STANDARD):
+    """Return True if stones contain a winning line on a board of this geometry."""
+    return geometry.alignment(stones)
+
+
+class Position:
+    """A board, as the stones of the player to move, the occupied cells and the column heights."""
+
+    __slots__ = ("geometry", "current", "mask", "moves", "heights")
+
+    def __init__(self, geometry=STANDARD):
+        self.geometry = geometry
+        self.current = 0
+        self.mask = 0
+        self.moves = 0
+        self.heights = [0] * geometry.columns
+
+    @classmethod
+    def from_grid(cls, grid, geometry=None):
+        """Build a position from a grid of player ids, row 0 at the bottom and None for empty.
+
+        Player 0 is taken to have moved first. Without a geometry the board
+        size is taken from the grid and the line length is four.
+        """
+        if geometry is None:
+            geometry = Geometry(len(grid), len(grid[0]))
+        position = cls(geometry)
+        stones = [0, 0]
+        for row, cells in enumerate(grid):
+            for column, player_id in enumerate(cells):
+                if player_id is not None:
+                    stones[player_id] |= geometry.cell(row, column)
+                    position.heights[column] = max(position.heights[column], row + 1)
+        position.mask = stones[0] | stones[1]
+        position.moves = sum(position.heights)
+        position.current = stones[position.moves % 2]
+        return position
+
+    def copy(self):
+        position = Position.__new__(Position)
+        position.geometry = self.geometry
+        position.current = self.current
+        position.mask = self.mask
+        position.moves = self.moves
+        position.heights = self.heights[:]
+        return position
+
+    def can_play(self, column):
+        return 0 <= column < self.geometry.columns and self.heights[column] < self.geometry.rows
+
+    def row(self, column):
+        """Row the next chip dropped in column lands in."""
+        return self.heights[column]
+
+    def play(self, column):
+        """Drop a chip for the player to move and return the row it landed in; check can_play first."""
+        row = self.heights[column]
+        self.current ^= self.mask  # The other player is to move next
+        self.mask |= 1 << (column * self.geometry.h1 + row)
+        self.heights[column] = row + 1
+        self.moves += 1
+        return row
+
+    def is_winning_move(self, column):
+        """Return True if the player to move wins by playing column.
+
+        Only the cells on the four lines through the new chip are looked at.
+        """
+        geometry = self.geometry
+        stones = self.current
+        move = 1 << (column * geometry.h1 + self.heights[column])
+        for shift in geometry.directions:
+            count = 1
+            probe = move >> shift
+            while probe & stones:
+                count += 1
+                probe >>= shift
+            probe = move << shift
+            while probe & stones:
+                count += 1
+                probe <<= shift
+            if count >= geometry.connect:
+                return True
+        return False
+
+    def last_player_won(self):
+        return self.geometry.alignment(self.current ^ self.mask)
+
+    def stones(self, player):
+        """Stones of the player who moved first (0) or second (1)."""
+        return self.current if player == self.moves % 2 else self.current ^ self.mask
+
+    def is_full(self):
+        return self.moves == self.geometry.size
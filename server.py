@@ -1,89 +1,93 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import signal
 import socket
 import threading
-import pickle
+import time
 import sys
 import random
+import weakref
+import rules
+from protocol import Frames, MessageReader, encode_message
+from message_codecs import SAFE_CODECS, negotiate
+from lobby import LobbyPublisher
+from actors import RoomScheduler
+from timers import Heartbeat, TimingWheel
+from sessions import RoomLog, SessionStore
+from ratelimit import RateLimits, parse_budgets
+from metrics import ServerMetrics, serve_metrics
+from profiling import Profiler
+from admin import AdminServer
+from router import Router
+from bots import BOT_NAME, BotPlayer, BotSettings
+from logconfig import get_logger, parse_sample_rates, setup_logging, stop_logging, LEVELS
+from outbound import Backpressure, QueuedConnection, LOW_PRIORITY_COMMANDS
+
+log = get_logger("server")
+
+# Client commands, registered by the ChatServer methods that handle them
+router = Router(reserved_names={BOT_NAME: "the name of the bot"})
+
+
+def log_received(addr, message):
+    """Log an incoming message at DEBUG; skipped after one level check otherwise."""
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Received message", extra={"fields": {"command": message.get("Command"), "addr": addr, "message": message}})
+
 
 class Connect4Game:
-    def __init__(self, room_name, players):
+    def __init__(self, room_name, players, geometry=rules.STANDARD):
         self.room_name = room_name
         self.players = players  # List of usernames
-        self.ROWS = 6
-        self.COLUMNS = 7
+        self.geometry = geometry  # Board size and line length chosen for the room
+        self.ROWS = geometry.rows
+        self.COLUMNS = geometry.columns
         self.grid = [[None for i in range(self.COLUMNS)] for j in range(self.ROWS)]
+        self.position = rules.Position(geometry)  # Bitboards the moves and wins are checked on
         self.current_player = 0
         self.game_over = False
         self.winner = None
+        self.seq = 0  # Number of moves applied, clients use it to detect missed updates
         
         # Randomly assign player IDs
         random.shuffle(self.players)
-        print(f"Game started in room {room_name}: {self.players[0]} (Red) vs {self.players[1]} (Yellow)")
+        log.info("Game started", extra={"fields": {"room": room_name, "red": self.players[0], "yellow": self.players[1]}})
 
     def add_chip(self, player_username, column):
         """Add a chip to the board and return the row it landed in, or -1 if invalid"""
-        if self.game_over:
+        if self.game_over or not self.position.can_play(column):
             return -1
-            
+
         # Check if it's the correct player's turn
         if self.players[self.current_player] != player_username:
             return -1
-            
-        # Find the lowest available row in the column
-        for row in range(self.ROWS):
-            if self.grid[row][column] is None:
-                self.grid[row][column] = self.current_player
-                
-                # Check for win
-                if self.check_win(self.current_player):
-                    self.game_over = True
-                    self.winner = player_username
-                elif self.is_board_full():
-                    self.game_over = True
-                    self.winner = "No_one" # Tie condition, no winner, used to be none but none is used for other things so No_one it is
-                else:
-                    # Switch players
-                    self.current_player = (self.current_player + 1) % 2
-                    
-                return row
-        return -1  # Column is full
+
+        won = self.position.is_winning_move(column)
+        row = self.position.play(column)
+        self.grid[row][column] = self.current_player  # Kept for the game state sent to clients
+        self.seq += 1
+
+        if won:
+            self.game_over = True
+            self.winner = player_username
+        elif self.is_board_full():
+            self.game_over = True
+            self.winner = "No_one" # Tie condition, no winner, used to be none but none is used for other things so No_one it is
+        else:
+            # Switch players
+            self.current_player = (self.current_player + 1) % 2
+        return row
 
     def check_win(self, player_id):
         """Check if the given player has won"""
-        # Check horizontal
-        for c in range(self.COLUMNS - 3):
-            for r in range(self.ROWS):
-                if (self.grid[r][c] == player_id and self.grid[r][c+1] == player_id and 
-                    self.grid[r][c+2] == player_id and self.grid[r][c+3] == player_id):
-                    return True
-
-        # Check vertical
-        for c in range(self.COLUMNS):
-            for r in range(self.ROWS - 3):
-                if (self.grid[r][c] == player_id and self.grid[r+1][c] == player_id and 
-                    self.grid[r+2][c] == player_id and self.grid[r+3][c] == player_id):
-                    return True
-
-        # Check positive diagonal
-        for c in range(self.COLUMNS - 3):
-            for r in range(self.ROWS - 3):
-                if (self.grid[r][c] == player_id and self.grid[r+1][c+1] == player_id and 
-                    self.grid[r+2][c+2] == player_id and self.grid[r+3][c+3] == player_id):
-                    return True
-
-        # Check negative diagonal
-        for c in range(self.COLUMNS - 3):
-            for r in range(3, self.ROWS):
-                if (self.grid[r][c] == player_id and self.grid[r-1][c+1] == player_id and 
-                    self.grid[r-2][c+2] == player_id and self.grid[r-3][c+3] == player_id):
-                    return True
-
-        return False
+        return self.geometry.alignment(self.position.stones(player_id))  # Player 0 always moves first
+
     def is_board_full(self):
         """Check if the board is full (tie condition)"""
-        for col in range(self.COLUMNS):
-            if self.grid[self.ROWS-1][col] is None:
-                return False
-        return True
+        return self.position.is_full()
     
     def get_game_state(self):
         """Return the current game state"""
@@ -93,235 +97,474 @@ class Connect4Game:
             "current_player_id": self.current_player,
             "game_over": self.game_over,
             "winner": self.winner,
-            "players": self.players
+            "players": self.players,
+            "seq": self.seq,
+            "rows": self.ROWS,
+            "columns": self.COLUMNS,
+            "connect": self.geometry.connect
         }
 
+class RoomLock:
+    """Re-entrant lock guarding one room's users, ready flags and game."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
 class ChatServer:
-    def __init__(self, host, port):
+    router = router
+
+    def __init__(self, host, port, backpressure=None, room_workers=4, heartbeat=None, resume_grace=30.0,
+                 codecs=None, rate_limits=None, bots=None):
         self.host = host
         self.port = port
+        self.backpressure = backpressure or Backpressure()  # Outbound queue limits for every client
+        self.codecs = codecs or SAFE_CODECS  # Codecs accepted from clients, see message_codecs.py
+        self.rate_limits = rate_limits or RateLimits()  # Per-connection command budgets
         self.server_socket = None
         self.clients = {}  # Dictionary to store client sockets by username
+        self.connections = set()  # Every open client connection, logged in or not
         self.rooms = {}   # Dictionary to store room names and their users
         self.ready_users = {}  # Dictionary to store ready status by room
         self.games = {}   # Dictionary to store active games by room
+        self.room_geometry = {}  # Room name -> rules.Geometry, for rooms not using the standard board
         self.running = True  # Add this flag
+        self.draining = False  # Set by drain(), no new games start while shutting down
+        # Locking: self.lock guards adding and removing entries in clients and
+        # rooms. Everything inside one room (its user list, ready flags and game)
+        # is guarded by that room's lock, so different rooms never wait for each
+        # other. Take a room lock before self.lock or the lobby lock, never after.
+        self.lock = threading.Lock()
+        self.room_locks = weakref.WeakValueDictionary()  # Room name -> RoomLock, while in use
+        self.lobby = LobbyPublisher(self)  # Debounced room list updates for the lobby
+        self.metrics = ServerMetrics(self, self.router.commands())
+        self.metrics_server = None  # HTTP endpoint, started by serve_metrics()
+        self.profiler = Profiler(self)  # Profiling sessions started from the admin socket
+        self.admin_server = None  # Started by serve_admin()
+        self.actors = RoomScheduler(room_workers, observe=self.metrics.room_call)  # Runs ready, game and restart handling per room
+        self.heartbeat = heartbeat or Heartbeat()
+        self.wheel = TimingWheel()  # Heartbeat, idle and session expiry timers
+        self.sessions = SessionStore(self.wheel, resume_grace)
+        self.room_logs = {}  # Room name -> RoomLog of recent room events, for resumed sessions
+        self.bots = BotPlayer(self, bots)  # Searches the moves of bot seats
         self.init_server()
 
     def init_server(self):
         """Initialize the server socket and start listening for connections."""
+        self.open_server_socket()
+
+        # Start accepting client connections
+        threading.Thread(target=self.accept_connections).start()
+
+    def open_server_socket(self):
+        """Create, bind and listen on the server socket."""
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            print(f"Server started on {self.host}:{self.port}")
+            self.server_socket.listen(socket.SOMAXCONN)
+            self.port = self.server_socket.getsockname()[1]  # Resolves port 0 to the real port
+            log.info(f"Server started on {self.host}:{self.port}")
         except Exception as e:
-            print(f"Error starting server: {e}")
+            log.error(f"Error starting server: {e}")
             sys.exit(1)
 
-        # Start accepting client connections
-        threading.Thread(target=self.accept_connections).start()
-
     def accept_connections(self):
         """Accept incoming client connections in a separate thread."""
-        while self.running:  # Change from 'while True'
+        # accept() blocks until stop_accepting() shuts the listening socket down
+        while self.running:
             try:
-                self.server_socket.settimeout(1.0)  # Add timeout
                 client_socket, addr = self.server_socket.accept()
-                print(f"New connection from {addr}")
-                threading.Thread(target=self.handle_client, args=(client_socket, addr)).start()
-            except socket.timeout:
-                continue  # Expected timeout, just continue
-            except Exception as e:
-                if self.running:  # Only print error if still running
-                    print(f"Error accepting connection: {e}")
+            except OSError as e:
+                if self.running and not self.draining:
+                    log.error(f"Error accepting connection: {e}")
                 break
+            log.info("New connection", extra={"fields": {"addr": addr}})
+            threading.Thread(target=self.handle_client, args=(client_socket, addr)).start()
 
     def handle_client(self, client_socket, addr):
         """Handle communication with a connected client."""
         username = None
+        limiter = self.rate_limits.limiter(addr)
+        reader = MessageReader(client_socket, codecs=self.codecs, admit=limiter.allow)
+        connection = QueuedConnection(client_socket, self.backpressure)
+        self.watch(connection)
         while True:
             try:
-                data = client_socket.recv(1048576)
-                if not data:
-                    print(f"Client {addr} disconnected")
+                messages = reader.read_messages()
+                if messages is None:
+                    log.info("Client disconnected", extra={"fields": {"addr": addr, "user": username}})
                     break
-                message = pickle.loads(data)
-                if not message:
-                    continue
-                print(f"Received from {addr}: {message}")
-
-                # Process client commands
-                if message["Command"] == "Check_Username":
-                    username = message["User_Name"]
-                    self.clients[username] = client_socket
-                    response = {
-                        "Command": "Check_Username",
-                        "Status": "Valid",
-                        "Users_In_Room": []
-                    }
-                    self.send_message(client_socket, response)
-                    self.broadcast_room_state()
-                    
-               
-                
-                elif message["Command"] == "Create_Room":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    print(f"Creating room {room_name} for user {username}")
-                    self.create_room(room_name, username)
-                    self.broadcast_room_state()
-
-                elif message["Command"] == "Join_Room":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    print(f"User {username} joining room {room_name}")
-                    self.join_room(room_name, username)
-                    response = {
+                connection.last_seen = time.monotonic()
+                for message in messages:
+                    if not message:
+                        continue
+                    log_received(addr, message)
+                    username = limiter.user = self.handle_message(connection, message, username)
+            except Exception as e:
+                log.warning(f"Error handling client: {e}", extra={"fields": {"addr": addr, "user": username}})
+                break
+
+        self.unwatch(connection)
+        self.client_disconnected(username, connection)
+        connection.close()
+
+    def resume_session(self, client_socket, message):
+        """Reattach a reconnecting client to its session and send it the room events it missed."""
+        room_name = message.get("Room_Name")
+        # Hold the room lock from registering the connection until the replay is
+        # sent, so no live room event can overtake the replayed ones
+        with self.room_lock(room_name) if room_name else contextlib.nullcontext():
+            session = self.sessions.resume(message["Session_Token"])
+            if session is None:
+                self.send_message(client_socket, {"Command": "Resume_Session", "Resumed": False})
+                return None
+            username = session.username
+            client_socket.codec = negotiate(message.get("Codecs"), self.codecs)
+            with self.lock:
+                old_connection = self.clients.get(username)
+                self.clients[username] = client_socket
+            if old_connection is not None and old_connection is not client_socket:
+                old_connection.evict()  # Half-open connection we had not noticed yet
+            self.send_message(client_socket, {
+                "Command": "Resume_Session",
+                "Resumed": True,
+                "User_Name": username,
+                "Session_Token": session.token,
+                "Codec": client_socket.codec
+            })
+            if room_name and username in self.rooms.get(room_name, ()):
+                self.replay_room(client_socket, room_name, message.get("Last_Seq", 0))
+        return username
+
+    def replay_room(self, client_socket, room_name, last_seq):
+        """Send the room events after last_seq, or the room's full state if they are gone.
+
+        Must be called with the room's lock held.
+        """
+        room_log = self.room_logs.get(room_name)
+        events = room_log.since(last_seq) if room_log else None
+        log.info("Replaying room events", extra={"fields": {"room": room_name, "last_seq": last_seq,
+                                                             "events": None if events is None else len(events)}})
+        if events is not None:
+            for frames, droppable in events:
+                self.send_frames(client_socket, frames, droppable)
+            return
+        room_seq = room_log.seq if room_log else 0
+        self.send_message(client_socket, {
+            "Command": "Room_State",
+            "Available_Rooms": self.available_rooms(),
+            "Users_In_Room": self.rooms[room_name],
+            "Room_Seq": room_seq
+        })
+        self.send_message(client_socket, {
+            "Command": "Ready_Update",
+            "Room_Name": room_name,
+            "Ready_Users": self.ready_users.get(room_name, {}),
+            "Room_Seq": room_seq
+        })
+        if room_name in self.games:
+            self.send_message(client_socket, {
+                "Command": "Game_State",
+                "Room_Name": room_name,
+                "Game_State": self.games[room_name].get_game_state(),
+                "Room_Seq": room_seq
+            })
+
+    def watch(self, connection):
+        """Start pinging a new connection when it goes quiet and reaping it when it stays silent."""
+        self.metrics.connections.inc()
+        with self.lock:
+            self.connections.add(connection)
+        if self.heartbeat.enabled:
+            connection.idle_timer = self.wheel.schedule(self.heartbeat.ping_interval, self.check_idle, connection)
+
+    def unwatch(self, connection):
+        self.metrics.connections.dec()
+        with self.lock:
+            self.connections.discard(connection)
+        self.wheel.cancel(connection.idle_timer)
+
+    def check_idle(self, connection):
+        """Timer callback: ping a quiet connection, evict a silent one, then check again later."""
+        if not connection.active:
+            return
+        idle = time.monotonic() - connection.last_seen
+        heartbeat = self.heartbeat
+        if idle >= heartbeat.idle_timeout:
+            # Shutting the socket down wakes its reader, which cleans up as for any disconnect
+            log.info("Reaping idle connection", extra={"fields": {"idle": round(idle, 1)}})
+            connection.evict()
+            return
+        if idle >= heartbeat.ping_interval:
+            self.send_message(connection, {"Command": "Ping"})
+            delay = heartbeat.ping_interval
+        else:
+            delay = heartbeat.ping_interval - idle
+        delay = min(delay, heartbeat.idle_timeout - idle)
+        connection.idle_timer = self.wheel.schedule(delay, self.check_idle, connection)
+
+    def client_disconnected(self, username, connection):
+        """Called when a client's connection is gone: keep its session for a while, or clean up now."""
+        if not username:
+            return
+        with self.lock:
+            if self.clients.get(username, connection) is not connection:
+                return  # The user is already back on a new connection
+            self.clients.pop(username, None)
+        if self.running and not self.draining and self.sessions.suspend(username, self.cleanup_client):
+            self.lobby.unsubscribe(username)  # A resumed client subscribes again
+            return
+        self.cleanup_client(username)
+
+    def cleanup_client(self, username):
+        """Remove a disconnected user from the server and every room they were in."""
+        if not username:
+            return
+        log.info("Cleaning up disconnected user", extra={"fields": {"user": username}})
+        self.sessions.discard(username)
+        with self.lock:
+            self.clients.pop(username, None)
+            joined_rooms = [room_name for room_name, users in self.rooms.items() if username in users]
+        self.lobby.unsubscribe(username)
+        for room_name in joined_rooms:
+            with self.room_lock(room_name):
+                users = self.remove_user_from_room(room_name, username)
+                if users:
+                    self.broadcast_to_room(room_name, {
                         "Command": "Join_Room",
                         "Room_Name": room_name,
                         "User_Name": username,
-                        "Users_In_Room": self.rooms.get(room_name, [])
-                    }
-                    self.broadcast_to_room(room_name, response)
+                        "Users_In_Room": users
+                    })
                     self.broadcast_to_room(room_name, {
                         "Command": "Room_State",
-                        "Available_Rooms": list(self.rooms.keys()),
-                        "Users_In_Room": self.rooms.get(room_name, [])
+                        "Available_Rooms": self.available_rooms(),
+                        "Users_In_Room": users
+                    })
+
+    def remove_user_from_room(self, room_name, username):
+        """Remove a user from a room, deleting the room once it is empty.
+
+        Must be called with the room's lock held. Returns the users left in the
+        room, or None if the user was not in it.
+        """
+        users = self.rooms.get(room_name)
+        if users is None or username not in users:
+            return None
+        users.remove(username)
+        # Remove from ready users
+        if room_name in self.ready_users and username in self.ready_users[room_name]:
+            del self.ready_users[room_name][username]
+        log.info("Removed user from room", extra={"fields": {"room": room_name, "user": username}})
+        if users == [BOT_NAME]:
+            users.clear()  # The bot leaves with the last player
+        if not users:
+            with self.lock:
+                del self.rooms[room_name]
+                self.ready_users.pop(room_name, None)
+                self.games.pop(room_name, None)
+                self.room_logs.pop(room_name, None)
+                self.room_geometry.pop(room_name, None)
+            self.actors.forget(room_name)
+            log.info("Deleted empty room", extra={"fields": {"room": room_name}})
+        self.lobby_changed(room_name)
+        return users
+
+    def handle_message(self, client_socket, message, username):
+        """Process a single client command and return the connection's username."""
+        if self.profiler.active:
+            return self.profiler.run(message["Command"], self.router.dispatch, self, client_socket, message, username)
+        return self.router.dispatch(self, client_socket, message, username)
+
+    @router.command("Check_Username", optional={"Codecs": list}, User_Name=str)
+    def on_check_username(self, client_socket, message, username):
+        username = message["User_Name"]
+        if self.sessions.is_suspended(username):
+            self.cleanup_client(username)  # A fresh login ends the dropped session
+        with self.lock:
+            self.clients[username] = client_socket
+        client_socket.codec = negotiate(message.get("Codecs"), self.codecs)
+        response = {
+            "Command": "Check_Username",
+            "Status": "Valid",
+            "Users_In_Room": [],
+            "Session_Token": self.sessions.create(username),
+            "Codec": client_socket.codec
+        }
+        self.send_message(client_socket, response)
+        self.send_room_state([client_socket])
+        return username
+
+    @router.command("Resume_Session", optional={"Room_Name": str, "Last_Seq": int, "Codecs": list},
+                    Session_Token=str)
+    def on_resume_session(self, client_socket, message, username):
+        return self.resume_session(client_socket, message)
+
+    @router.command("Pong")
+    def on_pong(self, client_socket, message, username):
+        pass  # Reading it already reset the connection's idle time
+
+    @router.command("Lobby_Subscribe")
+    def on_lobby_subscribe(self, client_socket, message, username):
+        if username:
+            self.lobby.subscribe(username)
+
+    @router.command("Create_Room", optional={"Rows": int, "Columns": int, "Connect": int},
+                    Room_Name=str, User_Name=str)
+    def on_create_room(self, client_socket, message, username):
+        try:
+            geometry = rules.Geometry(message.get("Rows") or rules.ROWS, message.get("Columns") or rules.COLUMNS,
+                                      message.get("Connect") or rules.CONNECT)
+        except ValueError as e:
+            self.router.reject(self, client_socket, "Create_Room", str(e), username)
+            return None
+        room_name = message["Room_Name"]
+        username = message["User_Name"]
+        log.debug("Creating room", extra={"fields": {"room": room_name, "user": username}})
+        self.create_room(room_name, username, geometry)
+        return username
+
+    @router.command("Join_Room", Room_Name=str, User_Name=str)
+    def on_join_room(self, client_socket, message, username):
+        room_name = message["Room_Name"]
+        username = message["User_Name"]
+        log.debug("Joining room", extra={"fields": {"room": room_name, "user": username}})
+        with self.room_lock(room_name):
+            self.join_room(room_name, username)
+            response = {
+                "Command": "Join_Room",
+                "Room_Name": room_name,
+                "User_Name": username,
+                "Users_In_Room": self.rooms.get(room_name, [])
+            }
+            self.broadcast_to_room(room_name, response)
+            self.broadcast_to_room(room_name, {
+                "Command": "Room_State",
+                "Available_Rooms": self.available_rooms(),
+                "Users_In_Room": self.rooms.get(room_name, [])
+            })
+            self.broadcast_to_room(room_name, {
+                "Command": "Sending_Message",
+                "Room_Name": room_name,
+                "User_Name": username,
+                "Text": f"{username} has joined the room."
+            })
+        return username
+
+    @router.command("Sending_Message", Room_Name=str, User_Name=str, Text=str)
+    def on_sending_message(self, client_socket, message, username):
+        room_name = message["Room_Name"]
+        username = message["User_Name"]
+        text = message["Text"]
+        text_checker = f"{username} has left the room."
+        with self.room_lock(room_name):
+            if text == text_checker:
+                users = self.remove_user_from_room(room_name, username)
+                if users:
+                    self.broadcast_to_room(room_name, {
+                        "Command": "Room_State",
+                        "Available_Rooms": self.available_rooms(),
+                        "Users_In_Room": users
                     })
                     self.broadcast_to_room(room_name, {
                         "Command": "Sending_Message",
                         "Room_Name": room_name,
                         "User_Name": username,
-                        "Text": f"{username} has joined the room."
+                        "Text": text
                     })
+            else:
+                self.broadcast_to_room(room_name, {
+                    "Command": "Sending_Message",
+                    "Room_Name": room_name,
+                    "User_Name": username,
+                    "Text": text
+                })
+        return username
 
-                elif message["Command"] == "Sending_Message":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    text = message["Text"]
-                    text_checker = f"{username} has left the room."
-                    if text == text_checker and room_name in self.rooms:
-                        if username in self.rooms[room_name]:
-                            self.rooms[room_name].remove(username)
-                            # Remove from ready users
-                            if room_name in self.ready_users and username in self.ready_users[room_name]:
-                                del self.ready_users[room_name][username]
-                            print(f"Removed {username} from room {room_name}")
-                            if not self.rooms[room_name]:
-                                del self.rooms[room_name]
-                                if room_name in self.ready_users:
-                                    del self.ready_users[room_name]
-                                if room_name in self.games:
-                                    del self.games[room_name]
-                                print(f"Deleted empty room {room_name}")
-                                self.broadcast_room_state()
-                            else:
-                                self.broadcast_to_room(room_name, {
-                                    "Command": "Room_State",
-                                    "Available_Rooms": list(self.rooms.keys()),
-                                    "Users_In_Room": self.rooms[room_name]
-                                })
-                                self.broadcast_to_room(room_name, {
-                                    "Command": "Sending_Message",
-                                    "Room_Name": room_name,
-                                    "User_Name": username,
-                                    "Text": text
-                                })
-                    else:
-                        self.broadcast_room_state()
-                        self.broadcast_to_room(room_name, {
-                            "Command": "Sending_Message",
-                            "Room_Name": room_name,
-                            "User_Name": username,
-                            "Text": text
-                        })
-
-                elif message["Command"] == "Ready_Status":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    ready = message["Ready"]
-                    self.handle_ready_status(room_name, username, ready)
-
-                elif message["Command"] == "Game_Move":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    column = message["Column"]
-                    self.handle_game_move(room_name, username, column)
-
-                elif message["Command"] == "Restart_Game":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    self.handle_restart_game(room_name, username)
-                    
-                #Added handling for game quit command
-                elif message["Command"] == "Game_Quit":
-                    room_name = message["Room_Name"]
-                    username = message["User_Name"]
-                    self.handle_ending_game_by_exit(room_name, username)
-                    
-            except Exception as e:
-                print(f"Error handling client {addr}: {e}")
-                break
+    @router.command("Ready_Status", Room_Name=str, User_Name=str, Ready=bool)
+    def on_ready_status(self, client_socket, message, username):
+        self.run_in_room(message["Room_Name"], self.handle_ready_status, message["User_Name"], message["Ready"])
+        return message["User_Name"]
 
-        # Cleanup when client disconnects
-        if username and username in self.clients:
-            print(f"Cleaning up for disconnected user {username}")
-            del self.clients[username]
-            for room_name, users in list(self.rooms.items()):
-                if username in users:
-                    users.remove(username)
-                    # Remove from ready users
-                    if room_name in self.ready_users and username in self.ready_users[room_name]:
-                        del self.ready_users[room_name][username]
-                    if not users:
-                        del self.rooms[room_name]
-                        if room_name in self.ready_users:
-                            del self.ready_users[room_name]
-                        if room_name in self.games:
-                            del self.games[room_name]
-                        print(f"Deleted empty room {room_name}")
-                        self.broadcast_room_state()
-                    else:
-                        self.broadcast_to_room(room_name, {
-                            "Command": "Join_Room",
-                            "Room_Name": room_name,
-                            "User_Name": username,
-                            "Users_In_Room": users
-                        })
-                        self.broadcast_to_room(room_name, {
-                            "Command": "Room_State",
-                            "Available_Rooms": list(self.rooms.keys()),
-                            "Users_In_Room": users
-                        })
-            if self.rooms:
-                self.broadcast_room_state()
-        try:
-            client_socket.close()
-        except:
-            pass
+    @router.command("Add_Bot", Room_Name=str, User_Name=str)
+    def on_add_bot(self, client_socket, message, username):
+        self.run_in_room(message["Room_Name"], self.handle_add_bot, message["User_Name"], client_socket)
+        return message["User_Name"]
 
-    def create_room(self, room_name, username):
+    @router.command("Game_Move", Room_Name=str, User_Name=str, Column=int)
+    def on_game_move(self, client_socket, message, username):
+        self.run_in_room(message["Room_Name"], self.handle_game_move, message["User_Name"], message["Column"])
+        return message["User_Name"]
+
+    @router.command("Game_Sync", Room_Name=str)
+    def on_game_sync(self, client_socket, message, username):
+        # Queued behind the room's moves, so the snapshot includes them
+        self.run_in_room(message["Room_Name"], self.handle_game_sync, client_socket)
+
+    @router.command("Restart_Game", Room_Name=str, User_Name=str)
+    def on_restart_game(self, client_socket, message, username):
+        self.run_in_room(message["Room_Name"], self.handle_restart_game, message["User_Name"])
+        return message["User_Name"]
+
+    @router.command("Game_Quit", Room_Name=str, User_Name=str)
+    def on_game_quit(self, client_socket, message, username):
+        self.run_in_room(message["Room_Name"], self.handle_ending_game_by_exit, message["User_Name"])
+        return message["User_Name"]
+
+    def run_in_room(self, room_name, handler, *args):
+        """Queue handler(room_name, *args) on the room's actor, which runs it under the room lock."""
+        callback = self.run_locked
+        if self.profiler.active:
+            callback = self.profiler.wrap(callback)  # Profile it as part of the command that queued it
+        self.actors.submit(room_name, callback, room_name, handler, args)
+
+    def run_locked(self, room_name, handler, args):
+        with self.room_lock(room_name):
+            handler(room_name, *args)
+
+    def room_lock(self, room_name):
+        """Return the lock for a room, creating it if no thread holds one."""
+        with self.lock:
+            lock = self.room_locks.get(room_name)
+            if lock is None:
+                lock = self.room_locks[room_name] = RoomLock()
+            return lock
+
+    def create_room(self, room_name, username, geometry=rules.STANDARD):
         """Create a new chat room without adding the user."""
-        if room_name not in self.rooms:
+        with self.lock:
+            if room_name in self.rooms:
+                return
             self.rooms[room_name] = []
             self.ready_users[room_name] = {}
-            print(f"Created room {room_name} by user {username}")
+            if geometry != rules.STANDARD:
+                self.room_geometry[room_name] = geometry
+        log.info("Created room", extra={"fields": {"room": room_name, "user": username, "board": geometry.key()}})
+        self.lobby_changed(room_name)
 
     def join_room(self, room_name, username):
-        """Add a user to an existing chat room."""
-        if room_name not in self.rooms:
-            self.rooms[room_name] = []
-            self.ready_users[room_name] = {}
+        """Add a user to an existing chat room, called with the room's lock held."""
+        with self.lock:
+            if room_name not in self.rooms:
+                self.rooms[room_name] = []
+                self.ready_users[room_name] = {}
         if username not in self.rooms[room_name]:
             self.rooms[room_name].append(username)
             self.ready_users[room_name][username] = False
+            self.lobby_changed(room_name)
 
     def handle_ready_status(self, room_name, username, ready):
         """Handle ready status changes and start game if all users ready"""
         # Ensure the room exists and the user is in the room
-        if room_name in self.ready_users:
+        if room_name in self.ready_users and username in self.rooms.get(room_name, ()):
             #set the user's ready status
             self.ready_users[room_name][username] = ready
             
@@ -334,15 +577,16 @@ class ChatServer:
             
             # Check if we can start a game (exactly 2 players, both ready)
             room_users = self.rooms.get(room_name, [])
-            if (len(room_users) == 2 and 
+            if (len(room_users) == 2 and not self.draining and
                 all(self.ready_users[room_name].get(user, False) for user in room_users)):
                 
                 # Start the game
-                self.games[room_name] = Connect4Game(room_name, room_users.copy())
+                self.games[room_name] = Connect4Game(room_name, room_users.copy(),
+                                                     self.room_geometry.get(room_name, rules.STANDARD))
                 
-                # Reset ready status
+                # Reset ready status, the bot is always ready
                 for user in room_users:
-                    self.ready_users[room_name][user] = False
+                    self.ready_users[room_name][user] = user == BOT_NAME
                 
                 # Broadcast game start
                 self.broadcast_to_room(room_name, {
@@ -351,7 +595,48 @@ class ChatServer:
                     "Game_State": self.games[room_name].get_game_state()
                 })
                 
-                print(f"Started Connect 4 game in room {room_name}")
+                log.debug("Broadcast game start", extra={"fields": {"room": room_name}})
+                self.bot_turn(room_name)
+
+    def handle_add_bot(self, room_name, username, client_socket):
+        """Seat the bot as the second player of a room"""
+        users = self.rooms.get(room_name)
+        if users is None or username not in users:
+            return
+        if len(users) != 1 or room_name in self.games:
+            self.router.reject(self, client_socket, "Add_Bot", "The bot can only join a player who is alone in the room",
+                               username)
+            return
+        self.join_room(room_name, BOT_NAME)
+        self.ready_users[room_name][BOT_NAME] = True
+        log.info("Added bot", extra={"fields": {"room": room_name, "user": username}})
+        self.broadcast_to_room(room_name, {
+            "Command": "Join_Room",
+            "Room_Name": room_name,
+            "User_Name": BOT_NAME,
+            "Users_In_Room": users
+        })
+        self.broadcast_to_room(room_name, {
+            "Command": "Room_State",
+            "Available_Rooms": self.available_rooms(),
+            "Users_In_Room": users
+        })
+        self.broadcast_to_room(room_name, {
+            "Command": "Ready_Update",
+            "Room_Name": room_name,
+            "Ready_Users": self.ready_users[room_name]
+        })
+
+    def bot_turn(self, room_name):
+        """Start searching the bot's move if it is the bot's turn in the room's game"""
+        game = self.games.get(room_name)
+        if game is not None and not game.game_over and game.players[game.current_player] == BOT_NAME:
+            self.bots.request_move(room_name, game)
+
+    def handle_bot_move(self, room_name, game, seq, column):
+        """Play a move the bot found, unless the game moved on while it was searching"""
+        if self.games.get(room_name) is game and game.seq == seq:
+            self.handle_game_move(room_name, BOT_NAME, column)
 
     def handle_game_move(self, room_name, username, column):
         """Handle a game move from a player"""
@@ -359,19 +644,21 @@ class ChatServer:
             return
             
         game = self.games[room_name] # Get the game instance for the room
+        player_id = game.current_player
         row = game.add_chip(username, column) # Add the chip to the game board
         
         if row != -1:  # Valid move
-            # Broadcast the move to all players in the room
+            # Broadcast only the move, clients apply it to their own copy of the grid
             self.broadcast_to_room(room_name, {
                 "Command": "Game_Update",
                 "Room_Name": room_name,
+                "Seq": game.seq,
                 "Move": {
                     "player": username,
+                    "player_id": player_id,
                     "column": column,
                     "row": row
-                },
-                "Game_State": game.get_game_state()
+                }
             })
            
             # If game is over, send game over message
@@ -380,8 +667,19 @@ class ChatServer:
                     "Command": "Game_Over",
                     "Room_Name": room_name,
                     "Winner": game.winner,
-                    "Game_State": game.get_game_state()
+                    "Seq": game.seq
                 })
+            else:
+                self.bot_turn(room_name)
+
+    def handle_game_sync(self, room_name, client_socket):
+        """Send the full game state to a client that missed some updates"""
+        if room_name in self.games:
+            self.send_message(client_socket, {
+                "Command": "Game_State",
+                "Room_Name": room_name,
+                "Game_State": self.games[room_name].get_game_state()
+            })
 
     def handle_restart_game(self, room_name, username):
         """Handle game restart request"""
@@ -392,7 +690,7 @@ class ChatServer:
             # Reset ready status
             if room_name in self.ready_users:
                 for user in self.ready_users[room_name]:
-                    self.ready_users[room_name][user] = False
+                    self.ready_users[room_name][user] = user == BOT_NAME
             
             # Broadcast restart
             self.broadcast_to_room(room_name, {
@@ -411,7 +709,7 @@ class ChatServer:
                 remaining_player = remaining_users[0]
                 game.game_over = True
                 game.winner = remaining_player
-                print(f"Player {quitting_username} quit game in room {room_name}. Declaring {remaining_player} as winner.")
+                log.info("Player quit game", extra={"fields": {"room": room_name, "user": quitting_username, "winner": remaining_player}})
                 self.broadcast_to_room(room_name, {
                     "Command": "Game_Over",
                     "Room_Name": room_name,
@@ -422,7 +720,7 @@ class ChatServer:
                 # Broadcast updated room state
                 self.broadcast_to_room(room_name, {
                     "Command": "Room_State",
-                    "Available_Rooms": list(self.rooms.keys()),
+                    "Available_Rooms": self.available_rooms(),
                     "Users_In_Room": self.rooms[room_name]
                 })
                 self.broadcast_to_room(room_name, {
@@ -435,43 +733,193 @@ class ChatServer:
     
     def send_message(self, client_socket, message):
         """Send a message to a specific client."""
-        print(f"Sending message: {message}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sending message", extra={"fields": {"command": message["Command"]}})
+        droppable = message["Command"] in LOW_PRIORITY_COMMANDS
+        self.send_frame(client_socket, encode_message(message, client_socket.codec), droppable)
+
+    def send_frame(self, client_socket, frame, droppable=False):
+        """Queue an already encoded frame for a specific client, never blocks."""
         try:
-            data = pickle.dumps(message)
-            client_socket.sendall(data)
+            if not client_socket.sendall(frame, droppable) and droppable:
+                self.metrics.frames_dropped.inc()
         except Exception as e:
-            print(f"Error sending message: {e}")
+            log.warning(f"Error sending message: {e}")
+
+    def send_frames(self, client_socket, frames, droppable=False):
+        """Queue a shared Frames message in the codec the client negotiated."""
+        try:
+            if not client_socket.sendall(frames.get(client_socket.codec), droppable) and droppable:
+                self.metrics.frames_dropped.inc()
+        except Exception as e:
+            log.warning(f"Error sending message: {e}")
 
     def broadcast(self, message):
         """Broadcast a message to all connected clients."""
-        for client_socket in self.clients.values():
-            self.send_message(client_socket, message)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Broadcasting message", extra={"fields": {"command": message["Command"], "recipients": len(self.clients)}})
+        # Encode once per codec, recipients share the same immutable frames
+        started = time.perf_counter()
+        frames = Frames(message)
+        droppable = message["Command"] in LOW_PRIORITY_COMMANDS
+        with self.lock:
+            recipients = list(self.clients.values())
+        for client_socket in recipients:
+            self.send_frames(client_socket, frames, droppable)
+        self.metrics.broadcast("all", len(recipients), time.perf_counter() - started)
 
     def broadcast_to_room(self, room_name, message):
-        """Broadcast a message to all users in a specific room."""
+        """Broadcast a message to all users in a specific room, called with the room's lock held.
+
+        The message is numbered and kept in the room's event log, so a client
+        that resumes its session can be sent what it missed.
+        """
         if room_name in self.rooms:
-            for username in self.rooms[room_name]:
-                if username in self.clients:
-                    self.send_message(self.clients[username], message)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Sending message to room", extra={"fields": {"command": message["Command"], "room": room_name}})
+            started = time.perf_counter()
+            droppable = message["Command"] in LOW_PRIORITY_COMMANDS
+            room_log = self.room_logs.get(room_name)
+            if room_log is None:
+                room_log = self.room_logs[room_name] = RoomLog()
+            frames = room_log.record(message, droppable)
+            users = self.rooms[room_name]
+            for username in users:
+                connection = self.clients.get(username)
+                if connection is not None:
+                    self.send_frames(connection, frames, droppable)
+            self.metrics.broadcast("room", len(users), time.perf_counter() - started)
 
-    def broadcast_room_state(self):
-        """Send the current list of available rooms to all clients."""
-        response = {
+    def available_rooms(self):
+        """Return the names of all rooms clients can join."""
+        with self.lock:
+            return list(self.rooms.keys())
+
+    def send_room_state(self, connections):
+        """Send the full list of available rooms to clients not subscribed to lobby updates."""
+        started = time.perf_counter()
+        frames = Frames({
             "Command": "Room_State",
-            "Available_Rooms": list(self.rooms.keys()),
+            "Available_Rooms": self.available_rooms(),
             "Users_In_Room": []
-        }
-        self.broadcast(response)
+        })
+        for connection in connections:
+            self.send_frames(connection, frames, droppable=True)
+        self.metrics.broadcast("room_list", len(connections), time.perf_counter() - started)
+
+    def lobby_changed(self, room_name):
+        """Record that a room was added, removed or changed occupancy."""
+        self.lobby.room_changed(room_name)
+
+    def lobby_state(self, room_name):
+        """Return the number of users in a room, or None if it does not exist."""
+        users = self.rooms.get(room_name)
+        return None if users is None else len(users)
+
+    def call_later(self, delay, callback):
+        """Run callback after delay seconds."""
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+
+    def serve_metrics(self, host, port):
+        """Serve the metrics in Prometheus text format at http://host:port/metrics."""
+        self.metrics_server = serve_metrics(self.metrics, host, port)
+
+    def serve_admin(self, path, token):
+        """Accept admin requests (profiling, metrics) on a Unix socket, authenticated with token."""
+        self.admin_server = AdminServer(self, path, token)
+
+    def stop_accepting(self):
+        """Stop accepting new connections, waking the accept thread."""
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def drain(self, timeout=30.0, snapshot_path=None):
+        """Wind the server down gracefully before shutdown().
+
+        Stops accepting connections and starting games, gives games in progress
+        until the deadline to finish, snapshots the ones that did not, and waits
+        for every client's outbound queue to be written out.
+        """
+        deadline = time.monotonic() + timeout
+        log.info("Draining server", extra={"fields": {"timeout": timeout, "games": len(self.games)}})
+        self.draining = True
+        self.stop_accepting()
+        for room_name in list(self.rooms):
+            with self.room_lock(room_name):
+                self.broadcast_to_room(room_name, {
+                    "Command": "Sending_Message",
+                    "Room_Name": room_name,
+                    "User_Name": "Server",
+                    "Text": "The server is restarting. Games in progress can be finished, no new games can start."
+                })
+
+        while self.unfinished_games() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.actors.join(max(0.0, deadline - time.monotonic()))
+        unfinished = self.unfinished_games()
+        if unfinished:
+            self.snapshot_games(unfinished, snapshot_path)
+
+        with self.lock:
+            connections = list(self.clients.items())
+        for username, connection in connections:
+            if not connection.flush(max(0.0, deadline - time.monotonic())):
+                log.warning("Outbound queue not flushed before the drain deadline", extra={"fields": {"user": username}})
+        log.info("Drain complete", extra={"fields": {"snapshotted": len(unfinished)}})
+
+    def unfinished_games(self):
+        """Return the names of rooms with a game still in progress."""
+        with self.lock:
+            return [room_name for room_name, game in self.games.items() if not game.game_over]
+
+    def snapshot_games(self, room_names, path=None):
+        """Save the state of unfinished games as JSON lines, to path or to the log."""
+        snapshots = []
+        for room_name in room_names:
+            with self.room_lock(room_name):
+                game = self.games.get(room_name)
+                if game is not None:
+                    snapshots.append(dict(game.get_game_state(), room=room_name))
+        if path:
+            with open(path, "w") as snapshot_file:
+                for snapshot in snapshots:
+                    snapshot_file.write(json.dumps(snapshot) + "\n")
+            log.info(f"Saved {len(snapshots)} unfinished games to {path}")
+        else:
+            for snapshot in snapshots:
+                log.info("Unfinished game", extra={"fields": snapshot})
+
+    def stop_services(self):
+        """Stop everything but the client connections; shared by every engine's shutdown()."""
+        self.running = False  # Set flag to stop threads
+        self.actors.shutdown()
+        self.bots.shutdown()
+        self.wheel.stop()
+        self.stop_accepting()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        if self.admin_server:
+            self.admin_server.close()
+        throttled = self.rate_limits.snapshot()
+        if throttled["throttled"]:
+            log.info("Throttled messages", extra={"fields": throttled})
 
     def shutdown(self):
         """Shutdown the server and close all connections."""
-        print("Shutting down server...")
-        self.running = False  # Set flag to stop threads
-        
-        # Close all client connections
-        for client_socket in self.clients.values():
+        log.info("Shutting down server...")
+        self.stop_services()
+
+        # Close all client connections, including those that never logged in, so
+        # every client thread wakes from its read and exits
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
             try:
-                client_socket.close()
+                connection.close()
             except:
                 pass
         
@@ -482,11 +930,139 @@ class ChatServer:
             except:
                 pass
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Connect 4 multiplayer server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded: one thread per client, asyncio: one event loop for all clients")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="run this many worker processes sharing the port, each owning a shard of the rooms")
+    parser.add_argument("--room-workers", type=int, default=4,
+                        help="threads running room logic (ready status, moves, restarts), per worker process")
+    parser.add_argument("--ping-interval", type=float, default=15.0,
+                        help="send a Ping to a client that has been quiet for this many seconds")
+    parser.add_argument("--idle-timeout", type=float, default=45.0,
+                        help="disconnect a client that has sent nothing for this many seconds, 0 disables")
+    parser.add_argument("--resume-grace", type=float, default=30.0,
+                        help="seconds a dropped client stays in its rooms and can resume its session, 0 disables")
+    parser.add_argument("--codecs", nargs="+", choices=["binary", "json", "pickle"], default=SAFE_CODECS,
+                        help="message codecs accepted from clients; pickle is unsafe with untrusted clients")
+    parser.add_argument("--rate-limit", action="append", metavar="COMMAND=RATE/BURST",
+                        help="messages per second and burst a client may send of a command, e.g. "
+                             "Sending_Message=5/10; 'default' covers unlisted commands, a rate of 0 means "
+                             "unlimited (repeatable)")
+    parser.add_argument("--flood-strikes", type=int, default=200,
+                        help="disconnect a client after this many messages in a row over its rate limit")
+    parser.add_argument("--no-rate-limit", action="store_true", help="disable rate limiting")
+    parser.add_argument("--high-watermark", type=int, default=256 * 1024,
+                        help="bytes queued for a client before chat and room lists are dropped for it")
+    parser.add_argument("--low-watermark", type=int, default=64 * 1024,
+                        help="bytes queued for a client below which it gets everything again")
+    parser.add_argument("--evict-after", type=float, default=10.0,
+                        help="seconds a client may stay over the high watermark before it is disconnected")
+    parser.add_argument("--drain-timeout", type=float, default=30.0,
+                        help="seconds to let games finish and queues flush after SIGTERM or Ctrl+C")
+    parser.add_argument("--snapshot-file",
+                        help="write games still running at the end of the drain to this file as JSON lines "
+                             "(default: log them)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics at http://METRICS_HOST:PORT/metrics; with --workers, "
+                             "worker N uses PORT+N")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--admin-socket", metavar="PATH",
+                        help="accept admin requests (profiling, metrics) on this Unix socket; with --workers, "
+                             "worker N uses PATH.N")
+    parser.add_argument("--admin-token", default=os.environ.get("CONNECT4_ADMIN_TOKEN"),
+                        help="token admin requests must present (default: $CONNECT4_ADMIN_TOKEN)")
+    parser.add_argument("--bot-think", type=float, default=1.0, help="seconds the bot searches for each move")
+    parser.add_argument("--bot-workers", type=int, default=1,
+                        help="bot moves searched at the same time, per worker process")
+    parser.add_argument("--bot-table-bits", type=int, default=20,
+                        help="size of each bot search's transposition table, as a power of two")
+    parser.add_argument("--bot-book", metavar="PATH", help="opening book built by book.py for the bot's early moves")
+    parser.add_argument("--broker", metavar="PATH",
+                        help="run as one node of a multi-node deployment, sharing the lobby through the broker.py "
+                             "listening on this Unix socket")
+    parser.add_argument("--nodes", nargs="+", metavar="HOST:PORT",
+                        help="with --broker, the client address of every node, in the same order on each node")
+    parser.add_argument("--node", metavar="HOST:PORT",
+                        help="with --broker, this node's entry in --nodes (default: 127.0.0.1:PORT, or HOST:PORT "
+                             "if --host is set)")
+    parser.add_argument("--log-level", choices=list(LEVELS), default="INFO",
+                        help="DEBUG logs every message, OFF disables logging")
+    parser.add_argument("--log-sample", action="append", metavar="COMMAND=N",
+                        help="log only one in N records for a command, e.g. Game_Move=100 (repeatable)")
+    parser.add_argument("--log-json", action="store_true", help="write logs as JSON lines")
+    return parser.parse_args()
+
+def wait_for_shutdown_signal():
+    """Block the main thread until SIGINT or SIGTERM arrives, without using any CPU."""
+    received = threading.Event()
+
+    def handle_signal(signum, frame):
+        log.info(f"Received {signal.Signals(signum).name}")
+        signal.signal(signal.SIGINT, signal.SIG_DFL)  # A second Ctrl+C stops immediately
+        received.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    received.wait()
+
+
+def serve_until_signal(server, drain_timeout, snapshot_path=None):
+    """Run a started server until SIGINT or SIGTERM, then drain and shut it down."""
+    wait_for_shutdown_signal()
+    server.drain(drain_timeout, snapshot_path)
+    server.shutdown()
+
+
 if __name__ == "__main__":
-    server = ChatServer("0.0.0.0", 12345)
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        server.shutdown()  # Call shutdown method
-        sys.exit(0)
\ No newline at end of file
+    args = parse_args()
+    log_options = {
+        "level": args.log_level,
+        "sample": parse_sample_rates(args.log_sample),
+        "as_json": args.log_json
+    }
+    setup_logging(**log_options)
+    backpressure = Backpressure(args.high_watermark, args.low_watermark, args.evict_after)
+    heartbeat = Heartbeat(args.ping_interval, args.idle_timeout)
+    rate_limits = RateLimits(parse_budgets(args.rate_limit), args.flood_strikes, not args.no_rate_limit)
+    bots = BotSettings(args.bot_think, args.bot_workers, args.bot_table_bits, args.bot_book)
+    metrics_address = (args.metrics_host, args.metrics_port) if args.metrics_port is not None else None
+    admin = None
+    if args.admin_socket:
+        if not args.admin_token:
+            log.error("--admin-socket needs an admin token, pass --admin-token or set CONNECT4_ADMIN_TOKEN")
+            sys.exit(1)
+        admin = (args.admin_socket, args.admin_token)
+    if args.workers > 1 and not args.broker:
+        from sharded_server import run_sharded
+        run_sharded(args.host, args.port, args.workers, backpressure, log_options, args.room_workers,
+                    args.drain_timeout, args.snapshot_file, heartbeat, args.resume_grace, args.codecs,
+                    rate_limits, metrics_address, admin, bots)
+        stop_logging()
+        sys.exit(0)
+    if args.broker:
+        from broker import LocalBroker
+        from cluster import ClusterNode
+        node = args.node or f"{'127.0.0.1' if args.host == '0.0.0.0' else args.host}:{args.port}"
+        if args.engine != "threaded" or args.workers > 1 or not args.nodes or node not in args.nodes:
+            log.error("--broker needs the threaded engine, one worker and a --nodes list that includes this node "
+                      f"({node}, see --node)")
+            sys.exit(1)
+        server = ClusterNode(args.host, args.port, args.nodes, node, LocalBroker(args.broker, node), backpressure,
+                             args.room_workers, heartbeat, args.resume_grace, args.codecs, rate_limits, bots)
+    elif args.engine == "asyncio":
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(args.host, args.port, backpressure, args.room_workers, heartbeat, args.resume_grace,
+                                 args.codecs, rate_limits, bots)
+    else:
+        server = ChatServer(args.host, args.port, backpressure, args.room_workers, heartbeat, args.resume_grace,
+                            args.codecs, rate_limits, bots)
+    if metrics_address:
+        server.serve_metrics(*metrics_address)
+    if admin:
+        server.serve_admin(*admin)
+    serve_until_signal(server, args.drain_timeout, args.snapshot_file)
+    stop_logging()
@@ -0,0 +1,128 @@
+import collections
+import secrets
+import threading
+from protocol import Frames
+from logconfig import get_logger
+
+log = get_logger("sessions")
+
+# Resumable sessions. Check_Username hands the client a session token. When
+# the connection drops, the user stays in their rooms for a grace period; a
+# client that reconnects in time sends Resume_Session with its token and the
+# last Room_Seq it saw, and gets the room events it missed replayed from the
+# room's event log instead of logging in and joining again.
+
+
+class RoomLog:
+    """Bounded ring buffer of the last events broadcast to one room.
+
+    Every event gets the next room sequence number as its Room_Seq and is kept
+    as the Frames that were broadcast, so replaying it usually costs no encoding.
+    """
+
+    def __init__(self, capacity=256):
+        self.events = collections.deque(maxlen=capacity)  # (seq, frames, droppable)
+        self.seq = 0
+
+    def record(self, message, droppable=False):
+        """Number a room event, keep it and return its Frames to broadcast."""
+        self.seq += 1
+        message["Room_Seq"] = self.seq
+        frames = Frames(message)
+        self.events.append((self.seq, frames, droppable))
+        return frames
+
+    def since(self, last_seq):
+        """Return the (frames, droppable) pairs after last_seq, or None if some were already dropped."""
+        if last_seq > self.seq:
+            return None  # The room was deleted and created again since
+        if last_seq == self.seq:
+            return []
+        if not self.events or self.events[0][0] > last_seq + 1:
+            return None
+        return [(frames, droppable) for seq, frames, droppable in self.events if seq > last_seq]
+
+
+class Session:
+    def __init__(self, token, username):
+        self.token = token
+        self.username = username
+        self.expiry = None  # Timer that ends the session while it is suspended
+
+
+class SessionStore:
+    """Session tokens of logged-in users and the grace period of dropped ones."""
+
+    def __init__(self, wheel, grace=30.0):
+        self.wheel = wheel
+        self.grace = grace
+        self.by_token = {}
+        self.by_user = {}
+        self.lock = threading.Lock()
+
+    def create(self, username, token=None):
+        """Start a session for a user, replacing any previous one, and return its token."""
+        session = Session(token or secrets.token_urlsafe(16), username)
+        with self.lock:
+            self._remove(self.by_user.get(username))
+            self.by_token[session.token] = session
+            self.by_user[username] = session
+        return session.token
+
+    def token_for(self, username):
+        with self.lock:
+            session = self.by_user.get(username)
+            return session.token if session else None
+
+    def is_suspended(self, username):
+        with self.lock:
+            session = self.by_user.get(username)
+            return session is not None and session.expiry is not None
+
+    def suspend(self, username, on_expire):
+        """Keep a disconnected user's session for the grace period, then call on_expire(username).
+
+        Returns False if the user has no session, or sessions are disabled.
+        """
+        if self.grace <= 0:
+            return False
+        with self.lock:
+            session = self.by_user.get(username)
+            if session is None:
+                return False
+            self.wheel.cancel(session.expiry)
+            session.expiry = self.wheel.schedule(self.grace, self.expire, session, on_expire)
+        log.info("Session suspended", extra={"fields": {"user": username, "grace": self.grace}})
+        return True
+
+    def resume(self, token):
+        """Return the session for a token and stop its expiry, or None if it is unknown or expired."""
+        with self.lock:
+            session = self.by_token.get(token)
+            if session is None:
+                return None
+            self.wheel.cancel(session.expiry)
+            session.expiry = None
+        log.info("Session resumed", extra={"fields": {"user": session.username}})
+        return session
+
+    def expire(self, session, on_expire):
+        """Timer callback: end a session whose user did not come back in time."""
+        with self.lock:
+            if self.by_token.get(session.token) is not session or session.expiry is None:
+                return  # Resumed or replaced in the meantime
+            self._remove(session)
+        log.info("Session expired", extra={"fields": {"user": session.username}})
+        on_expire(session.username)
+
+    def discard(self, username):
+        with self.lock:
+            self._remove(self.by_user.get(username))
+
+    def _remove(self, session):
+        if session is None:
+            return
+        self.wheel.cancel(session.expiry)
+        self.by_token.pop(session.token, None)
+        if self.by_user.get(session.username) is session:
+            del self.by_user[session.username]
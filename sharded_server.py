@@ -0,0 +1,354 @@
+import collections
+import multiprocessing
+import pickle
+import signal
+import socket
+import threading
+import time
+import zlib
+import rules
+from protocol import HEADER, HEADER_SIZE, RECV_BUFFER_SIZE, MessageReader, encode_message
+from outbound import QueuedConnection
+from logconfig import get_logger, setup_logging
+from server import ChatServer, log_received, serve_until_signal
+
+log = get_logger("sharded_server")
+
+# Multi-process server. Every worker process listens on the same port with
+# SO_REUSEPORT, so the kernel spreads new connections across workers. Each room
+# is owned by exactly one worker, picked by hashing its name. When a client
+# joins a room owned by another worker, its socket (plus any messages already
+# read from it) is handed to the owner over a Unix socket, so moves and chat
+# for a room are always handled in a single process.
+#
+# The parent process runs the Lobby, which only tracks which rooms exist and
+# how many users they have. Each worker reports the rooms it owns and the lobby
+# pushes the merged view back to every worker, whose LobbyPublisher then sends
+# the changes to its own clients.
+#
+# The processes talk over ControlLinks: one-way Unix stream sockets, one for
+# every sender and receiver, carrying pickled messages in the frames of
+# protocol.py, each after a byte counting the file descriptors sent with it.
+# A stream has no size limit for a message, unlike a datagram, so a handoff
+# with a long backlog or the lobby of a busy server goes through whole. A
+# message that cannot be read is logged and skipped.
+
+CONTROL_MESSAGE_SIZE = 64 * 1024 * 1024  # Largest control message accepted
+
+
+class ControlLink:
+    """One-way stream between two of the server's processes, for pickled messages.
+
+    A message may carry a file descriptor, which the receiver gets with it.
+    """
+
+    def __init__(self):
+        self.receive_side, self.send_side = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.lock = threading.Lock()  # The sender's threads write one frame at a time
+
+    def send(self, message, fd=None):
+        frame = bytes([fd is not None]) + encode_message(message, "pickle", CONTROL_MESSAGE_SIZE)
+        with self.lock:
+            if fd is None:
+                self.send_side.sendall(frame)
+            else:
+                # The descriptor arrives with the frame's first bytes
+                sent = socket.send_fds(self.send_side, [frame[:RECV_BUFFER_SIZE]], [fd])
+                self.send_side.sendall(frame[sent:])
+
+    def receive(self):
+        """Yield (message, file descriptors received with it) until the sender closes the link.
+
+        A message that fails to unpickle is yielded as None, with its file
+        descriptors for the caller to close.
+        """
+        buffer = bytearray()
+        fds = collections.deque()  # Received ahead of the end of their message
+        while True:
+            data, received, _flags, _addr = socket.recv_fds(self.receive_side, RECV_BUFFER_SIZE, 16)
+            if not data:
+                return
+            buffer += data
+            fds.extend(received)
+            offset = 0
+            while len(buffer) - offset > HEADER_SIZE:
+                fd_count = buffer[offset]
+                length, _tag = HEADER.unpack_from(buffer, offset + 1)
+                if length > CONTROL_MESSAGE_SIZE:
+                    log.error("Control link out of step, closing it", extra={"fields": {"bytes": length}})
+                    return
+                start = offset + 1 + HEADER_SIZE
+                end = start + length
+                if len(buffer) < end:
+                    break
+                try:
+                    message = pickle.loads(buffer[start:end])
+                except Exception:
+                    log.exception("Unreadable control message", extra={"fields": {"bytes": length}})
+                    message = None
+                offset = end
+                yield message, [fds.popleft() for _ in range(min(fd_count, len(fds)))]
+            del buffer[:offset]
+
+
+def room_owner(room_name, workers):
+    """Return the index of the worker that owns a room."""
+    return zlib.crc32(room_name.encode("utf-8")) % workers
+
+
+class ShardWorker(ChatServer):
+    """ChatServer running in one worker process and owning a shard of the rooms."""
+
+    def __init__(self, host, port, index, worker_links, control_links, lobby_link, backpressure=None,
+                 room_workers=4, heartbeat=None, resume_grace=30.0, codecs=None, rate_limits=None, bots=None):
+        self.index = index
+        self.worker_links = worker_links  # ControlLink to every worker, this one's unused
+        self.control_links = control_links  # ControlLink from every other worker and the lobby
+        self.lobby_link = lobby_link
+        self.lobby_occupancy = {}  # Every worker's rooms, as last reported by the lobby
+        self.published_rooms = None
+        super().__init__(host, port, backpressure, room_workers, heartbeat, resume_grace, codecs, rate_limits, bots)
+        for sender, link in enumerate(control_links):
+            if sender != index:
+                threading.Thread(target=self.receive_control_messages, args=(link,), daemon=True).start()
+
+    def open_server_socket(self):
+        """Listen on the shared port alongside the other workers."""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(socket.SOMAXCONN)
+        log.info(f"Worker {self.index} listening on {self.host}:{self.port}")
+
+    def owns(self, room_name):
+        return room_owner(room_name, len(self.worker_links)) == self.index
+
+    def handle_client(self, client_socket, addr, username=None, backlog=(), pending=b"", subscribed=False,
+                      session_token=None, codec=None):
+        """Handle a client, handing it to another worker when it joins or resumes in a room owned there."""
+        limiter = self.rate_limits.limiter(addr)
+        limiter.user = username
+        reader = MessageReader(client_socket, codecs=self.codecs, admit=limiter.allow)
+        connection = QueuedConnection(client_socket, self.backpressure)
+        if codec:
+            connection.codec = codec
+        self.watch(connection)
+        if username:
+            with self.lock:
+                self.clients[username] = connection
+            if session_token:
+                self.sessions.create(username, session_token)
+            if subscribed:
+                self.lobby.subscribe(username)
+        messages = list(backlog) + reader.decoder.feed(pending)
+        while True:
+            try:
+                for index, message in enumerate(messages):
+                    if not message:
+                        continue
+                    if (message["Command"] in ("Join_Room", "Resume_Session") and message.get("Room_Name")
+                            and not self.owns(message["Room_Name"])):
+                        self.hand_off(connection, username, messages[index:], reader.decoder.pending())
+                        return
+                    log_received(addr, message)
+                    username = limiter.user = self.handle_message(connection, message, username)
+                messages = reader.read_messages()
+                if messages is None:
+                    log.info("Client disconnected", extra={"fields": {"addr": addr, "user": username}})
+                    break
+                connection.last_seen = time.monotonic()
+            except Exception as e:
+                log.warning(f"Error handling client: {e}", extra={"fields": {"addr": addr, "user": username}})
+                break
+
+        self.unwatch(connection)
+        self.client_disconnected(username, connection)
+        connection.close()
+
+    def hand_off(self, connection, username, backlog, pending):
+        """Pass a client connection and its unprocessed messages to the room's owner."""
+        owner = room_owner(backlog[0]["Room_Name"], len(self.worker_links))
+        log.debug("Handing client to room owner", extra={"fields": {"user": username, "worker": owner, "room": backlog[0]["Room_Name"]}})
+        subscribed = username in self.lobby.subscribers
+        session_token = self.sessions.token_for(username)
+        self.cleanup_client(username)
+        connection.stop()  # Send whatever is already queued before the owner takes over
+        self.unwatch(connection)  # The owner watches the connection from now on
+        client_socket = connection.sock
+        try:
+            self.worker_links[owner].send({
+                "Command": "Handoff",
+                "User_Name": username,
+                "Backlog": backlog,
+                "Pending": pending,
+                "Subscribed": subscribed,
+                "Session_Token": session_token,
+                "Codec": connection.codec
+            }, client_socket.fileno())
+        except Exception:
+            log.exception("Handoff failed", extra={"fields": {"user": username, "worker": owner}})
+        client_socket.close()  # The owner holds its own descriptor for the connection
+
+    def receive_control_messages(self, link):
+        """Receive handed-off clients, forwarded commands and lobby updates from one link."""
+        for message, fds in link.receive():
+            try:
+                if message is not None:
+                    self.handle_control_message(message, fds)
+                    fds = []
+            except Exception:
+                log.exception("Error handling control message", extra={"fields": {"command": message["Command"]}})
+            finally:
+                for fd in fds:  # Not taken over by a client thread
+                    socket.close(fd)
+
+    def handle_control_message(self, message, fds):
+        if message["Command"] == "Handoff":
+            client_socket = socket.socket(fileno=fds[0])
+            try:
+                addr = client_socket.getpeername()
+            except OSError:  # The client left before the handoff arrived
+                client_socket.close()
+                return
+            threading.Thread(
+                target=self.handle_client,
+                args=(client_socket, addr, message["User_Name"], message["Backlog"], message["Pending"],
+                      message["Subscribed"], message["Session_Token"], message["Codec"]),
+                daemon=True
+            ).start()
+        elif message["Command"] == "Create_Room":
+            self.create_room(message["Room_Name"], message["User_Name"], message["Board"])
+        elif message["Command"] == "Lobby_Rooms":
+            old, self.lobby_occupancy = self.lobby_occupancy, message["Rooms"]
+            for room_name in set(old) | set(self.lobby_occupancy):
+                if old.get(room_name) != self.lobby_occupancy.get(room_name):
+                    self.lobby.room_changed(room_name)
+
+    def create_room(self, room_name, username, geometry=rules.STANDARD):
+        """Create the room on its owning worker."""
+        if not self.owns(room_name):
+            owner = room_owner(room_name, len(self.worker_links))
+            self.worker_links[owner].send({
+                "Command": "Create_Room",
+                "Room_Name": room_name,
+                "User_Name": username,
+                "Board": geometry
+            })
+            return
+        super().create_room(room_name, username, geometry)
+
+    def lobby_changed(self, room_name):
+        """Report the change to the lobby, local clients hear about it when the lobby answers."""
+        self.publish_rooms()
+
+    def publish_rooms(self):
+        """Report the rooms owned by this worker to the lobby if they changed."""
+        # Under the server lock so two rooms changing at once cannot report out of order
+        with self.lock:
+            rooms = {room_name: len(users) for room_name, users in self.rooms.items()}
+            if rooms != self.published_rooms:
+                self.published_rooms = rooms
+                self.lobby_link.send({"Command": "Rooms", "Worker": self.index, "Rooms": rooms})
+
+    def available_rooms(self):
+        """Return the rooms of every worker, as last reported by the lobby."""
+        return list(self.lobby_occupancy)
+
+    def lobby_state(self, room_name):
+        return self.lobby_occupancy.get(room_name)
+
+
+class Lobby:
+    """Merges the room lists reported by every worker and pushes changes back out."""
+
+    def __init__(self, report_links, worker_links):
+        self.report_links = report_links  # ControlLink from each worker
+        self.worker_links = worker_links  # ControlLink to each worker
+        self.worker_rooms = [{} for _ in worker_links]
+        self.rooms = {}
+        self.lock = threading.Lock()  # Merges one report at a time, so updates go out in order
+
+    def start(self):
+        for link in self.report_links:
+            threading.Thread(target=self.receive, args=(link,), daemon=True).start()
+
+    def receive(self, link):
+        for message, _fds in link.receive():
+            try:
+                if message is not None and message["Command"] == "Rooms":
+                    self.merge(message["Worker"], message["Rooms"])
+            except Exception:
+                log.exception("Error merging worker rooms")
+
+    def merge(self, index, rooms):
+        with self.lock:
+            self.worker_rooms[index] = rooms
+            merged = {}
+            for owned in self.worker_rooms:
+                merged.update(owned)
+            if merged == self.rooms:
+                return
+            self.rooms = merged
+            for index, link in enumerate(self.worker_links):
+                try:
+                    link.send({"Command": "Lobby_Rooms", "Rooms": merged})
+                except OSError:
+                    log.exception("Lobby update failed", extra={"fields": {"worker": index}})
+
+
+def run_worker(host, port, index, worker_links, control_links, lobby_link, backpressure, log_options,
+               room_workers, drain_timeout, snapshot_path, heartbeat, resume_grace, codecs, rate_limits,
+               metrics_address, admin, bots):
+    setup_logging(**log_options)  # The parent's writer thread does not survive fork
+    worker = ShardWorker(host, port, index, worker_links, control_links, lobby_link, backpressure, room_workers,
+                         heartbeat, resume_grace, codecs, rate_limits, bots)
+    if metrics_address:
+        metrics_host, metrics_port = metrics_address
+        worker.serve_metrics(metrics_host, metrics_port + index)  # One endpoint per worker
+    if admin:
+        admin_path, admin_token = admin
+        worker.serve_admin(f"{admin_path}.{index}", admin_token)
+    if snapshot_path:
+        snapshot_path = f"{snapshot_path}.{index}"  # One file per worker
+    serve_until_signal(worker, drain_timeout, snapshot_path)
+
+
+def run_sharded(host, port, workers, backpressure=None, log_options=None, room_workers=4, drain_timeout=30.0,
+                snapshot_path=None, heartbeat=None, resume_grace=30.0, codecs=None, rate_limits=None,
+                metrics_address=None, admin=None, bots=None):
+    """Start the worker processes and run the lobby in this process."""
+    # links[receiver][sender], with the lobby as the last sender, so every
+    # link has a single writing process
+    links = [[ControlLink() for _ in range(workers + 1)] for _ in range(workers)]
+    report_links = [ControlLink() for _ in range(workers)]  # Worker -> lobby
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for index in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(host, port, index, [links[receiver][index] for receiver in range(workers)], links[index],
+                  report_links[index], backpressure,
+                  log_options or {}, room_workers, drain_timeout, snapshot_path, heartbeat, resume_grace, codecs,
+                  rate_limits, metrics_address, admin, bots),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+    log.info(f"Started {workers} workers on {host}:{port}")
+
+    Lobby(report_links, [links[receiver][workers] for receiver in range(workers)]).start()
+
+    # On SIGTERM pass the signal on to the workers, which drain and exit on
+    # their own. Ctrl+C already reaches every process in the foreground group.
+    def forward_signal(signum, frame):
+        log.info(f"Received {signal.Signals(signum).name}, draining workers")
+        for process in processes:
+            if signum == signal.SIGTERM and process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+    for process in processes:
+        process.join()
@@ -0,0 +1,351 @@
+import argparse
+import time
+import rules
+
+# Connect 4 solver, used by the server's bot seats and the local game.
+#
+# Negamax with alpha-beta pruning on the bitboards of rules.py. A node never
+# looks at a move that hands the opponent an immediate win, and the moves it
+# does look at are tried in order: the transposition table's best move first,
+# then the moves that create the most threats, then the centre columns before
+# the edges. The root's score is found by a series of null-window searches
+# that bisect the range of possible scores.
+#
+# Scores follow the usual convention for solved games: a positive score means
+# the player to move wins, and it is larger the sooner they win (the number
+# of their stones still in hand after the winning one, plus one). A negative
+# score is a loss, 0 a draw. search() deepens one ply at a time until it runs
+# out of time; below the depth reached, an unexplored line counts as a draw.
+# So a non-zero score is always a proven win or loss. It is the exact score
+# once the game ends within the depth searched: the table can carry results
+# of earlier, deeper searches, which may show a slow win while a faster one
+# is still beyond the horizon. A 0 is proven once the search reaches the end
+# of the game.
+#
+# The transposition table has a fixed number of slots. A new entry replaces
+# the one in its slot if that entry came from an earlier search or was
+# searched to no greater depth, so the deep results of the current search
+# survive the many shallow ones near the leaves.
+#
+# Given an opening book (book.py), search() answers the positions it covers
+# from the book. Entries the builder did not prove are only used when the
+# search has a time budget, since a search without one must return the exact
+# score.
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+try:
+    popcount = int.bit_count
+except AttributeError:  # Before Python 3.10
+    def popcount(value):
+        return bin(value).count("1")
+
+
+class TimeUp(Exception):
+    pass
+
+
+class TranspositionTable:
+    """Fixed-size table of search results keyed by position."""
+
+    def __init__(self, bits=20):
+        self.size = (1 << bits) - 1  # Odd, so keys that differ by a power of two spread over the slots
+        self.keys = [0] * self.size
+        self.entries = [None] * self.size  # (generation, depth, flag, score, move)
+        self.generation = 0
+        self.stored = 0
+        self.replaced = 0
+
+    def clear(self):
+        self.keys = [0] * self.size
+        self.entries = [None] * self.size
+        self.stored = 0
+
+    def new_search(self):
+        """Age every entry, so they make way for the next search's results."""
+        self.generation += 1
+
+    def get(self, key):
+        index = key % self.size
+        if self.keys[index] == key:
+            return self.entries[index]
+        return None
+
+    def put(self, key, depth, flag, score, move):
+        index = key % self.size
+        entry = self.entries[index]
+        if entry is None:
+            self.stored += 1
+        else:
+            if entry[0] == self.generation and entry[1] > depth:
+                return  # Keep the deeper result of this search
+            if self.keys[index] != key:
+                self.replaced += 1
+        self.keys[index] = key
+        self.entries[index] = (self.generation, depth, flag, score, move)
+
+
+class SearchResult:
+    """Best move found by a search, with its score and the effort it took."""
+
+    def __init__(self, column, score, depth, exact, nodes, seconds):
+        self.column = column
+        self.score = score
+        self.depth = depth  # Plies searched
+        self.exact = exact  # The score is the game-theoretic value
+        self.nodes = nodes
+        self.seconds = seconds
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (f"SearchResult(column={self.column}, score={self.score}, depth={self.depth}, exact={self.exact}, "
+                f"nodes={self.nodes}, nodes_per_second={self.nodes_per_second:.0f})")
+
+
+class Solver:
+    """Searches positions of one board geometry; not safe to share between threads."""
+
+    def __init__(self, geometry=rules.STANDARD, table_bits=20, book=None):
+        self.table = TranspositionTable(table_bits)
+        self.book = book
+        self.geometry = None
+        self.set_geometry(geometry)
+        self.nodes = 0
+        self.deadline = None
+
+    def set_geometry(self, geometry):
+        """Switch to another board, forgetting results for the old one."""
+        if geometry == self.geometry:
+            return
+        if self.geometry is not None:
+            self.table.clear()
+        self.geometry = geometry
+        h1 = geometry.h1
+        self.bottom = sum(1 << (column * h1) for column in range(geometry.columns))
+        self.board = self.bottom * ((1 << geometry.rows) - 1)
+        self.column_masks = [((1 << geometry.rows) - 1) << (column * h1) for column in range(geometry.columns)]
+        # Centre columns first, then outwards alternating sides
+        middle = (geometry.columns - 1) / 2
+        self.order = sorted(range(geometry.columns), key=lambda column: (abs(column - middle), column))
+        # Called several times per node, so four in a row gets its own unrolled version
+        self.winning_cells = self.winning_cells_4 if geometry.connect == 4 else self.winning_cells_n
+
+    def winning_cells_n(self, stones):
+        """Cells, empty or not, that would complete a line of stones."""
+        connect = self.geometry.connect
+        board = self.board
+        cells = stones << 1
+        for k in range(2, connect):
+            cells &= stones << k  # Only the cell on top of a column of stones
+        for shift in self.geometry.directions[1:]:
+            # before[k]: cells with k stones in a row just before them
+            before = [board]
+            for k in range(1, connect):
+                before.append(before[-1] & (stones << (k * shift)))
+            cells |= before[connect - 1]
+            after = board
+            for k in range(1, connect):
+                after &= stones >> (k * shift)
+                cells |= after & before[connect - 1 - k]
+        return cells & board
+
+    def winning_cells_4(self, stones):
+        """winning_cells_n() for lines of four."""
+        cells = (stones << 1) & (stones << 2) & (stones << 3)
+        for shift in self.geometry.directions[1:]:
+            pair = (stones << shift) & (stones << 2 * shift)
+            cells |= pair & (stones << 3 * shift)
+            cells |= pair & (stones >> shift)
+            pair = (stones >> shift) & (stones >> 2 * shift)
+            cells |= pair & (stones << shift)
+            cells |= pair & (stones >> 3 * shift)
+        return cells & self.board
+
+    def search(self, position, budget=None, max_depth=None):
+        """Find the best move for the player to move, deepening until budget seconds have passed.
+
+        Without a budget or max_depth the position is solved.
+        """
+        self.set_geometry(position.geometry)
+        self.table.new_search()
+        started = time.perf_counter()
+        if self.book is not None:
+            entry = self.book.lookup(position)
+            if entry is not None and (entry.exact or budget or max_depth is not None):
+                return SearchResult(entry.column, entry.score, 0, entry.exact, 0, time.perf_counter() - started)
+        self.nodes = 0
+        self.deadline = started + budget if budget else None
+        current, mask, moves = position.current, position.mask, position.moves
+        size = self.geometry.size
+        possible = (mask + self.bottom) & self.board
+        wins = self.winning_cells(current) & possible
+        if wins:
+            column = next(c for c in self.order if wins & self.column_masks[c])
+            return SearchResult(column, (size + 1 - moves) // 2, 1, True, 1, time.perf_counter() - started)
+
+        remaining = size - moves
+        limit = remaining if max_depth is None else min(max_depth, remaining)
+        column = next(c for c in self.order if possible & self.column_masks[c])
+        result = SearchResult(column, 0, 0, False, 0, 0.0)
+        # Deepening only pays for itself when the search may be cut short
+        depths = range(1, limit + 1) if budget else [limit]
+        for depth in depths:
+            try:
+                column, score = self.root(current, mask, moves, depth)
+            except TimeUp:
+                break
+            exact = depth == remaining or (score != 0 and self.plies_to_end(moves, score) <= depth)
+            result = SearchResult(column, score, depth, exact, self.nodes, time.perf_counter() - started)
+            if exact:
+                break
+        result.nodes = self.nodes
+        result.seconds = time.perf_counter() - started
+        return result
+
+    def plies_to_end(self, moves, score):
+        """Plies from a position after moves until the game ends with a non-zero score."""
+        plies = self.geometry.size + 2 - 2 * abs(score) - moves
+        # A win is on one of the player's own moves, a loss on one of the opponent's
+        if plies % 2 != (score > 0):
+            plies -= 1
+        return plies
+
+    def solve(self, position):
+        """Return the exact score of a position."""
+        return self.search(position).score
+
+    def root(self, current, mask, moves, depth):
+        """Return the best column and its score, searching depth plies."""
+        size = self.geometry.size
+        # Narrow the score down with null-window searches, which prune far more
+        # than one search with a wide window. Probing halfway towards 0 first
+        # settles the common small scores sooner.
+        low, high = -((size - moves) // 2), (size + 1 - moves) // 2
+        while low < high:
+            middle = low + (high - low) // 2
+            if middle <= 0 and int(low / 2) < middle:
+                middle = int(low / 2)
+            elif middle >= 0 and high // 2 > middle:
+                middle = high // 2
+            score = self.negamax(current, mask, moves, middle, middle + 1, depth)
+            if score <= middle:
+                high = score
+            else:
+                low = score
+        # Then find a move that reaches the score, again with null windows
+        candidates = self.non_losing_moves(current, mask)
+        ordered = self.ordered_moves(current, mask, candidates, None)
+        for move, column in ordered:
+            if -self.negamax(current ^ mask, mask | move, moves + 1, -low, 1 - low, depth - 1) >= low:
+                return column, low
+        if ordered:
+            return ordered[0][1], low
+        # Every move loses at once, play the first legal one
+        possible = (mask + self.bottom) & self.board
+        return next(c for c in self.order if possible & self.column_masks[c]), low
+
+    def non_losing_moves(self, current, mask):
+        """Moves that do not let the opponent win next turn, as a bitmap."""
+        possible = (mask + self.bottom) & self.board
+        threats = self.winning_cells(current ^ mask) & ~mask
+        forced = possible & threats
+        if forced:
+            if forced & (forced - 1):
+                return 0  # Two threats to block, the game is lost
+            possible = forced
+        return possible & ~(threats >> 1)  # Never play just below an opponent's threat
+
+    def ordered_moves(self, current, mask, moves, best_column):
+        """(move bit, column) of each candidate move, most promising first."""
+        candidates = []
+        for rank, column in enumerate(self.order):
+            move = moves & self.column_masks[column]
+            if move:
+                threats = popcount(self.winning_cells(current | move) & ~(mask | move))
+                candidates.append((column != best_column, -threats, rank, move, column))
+        candidates.sort()
+        return [(move, column) for _, _, _, move, column in candidates]
+
+    def negamax(self, current, mask, moves, alpha, beta, depth):
+        """Score of a position whose player to move cannot win at once, within alpha and beta."""
+        self.nodes += 1
+        if self.deadline and not self.nodes & 1023 and time.perf_counter() > self.deadline:
+            raise TimeUp()
+        size = self.geometry.size
+        candidates = self.non_losing_moves(current, mask)
+        if not candidates:
+            return -((size - moves) // 2)
+        if moves >= size - 2:
+            return 0  # Neither player can win with the last stones
+        if depth == 0:
+            return 0  # Beyond the horizon, unknown counts as a draw
+
+        # The opponent cannot win on their next move, nor we on ours
+        alpha = max(alpha, -((size - 2 - moves) // 2))
+        beta = min(beta, (size - 1 - moves) // 2)
+        if alpha >= beta:
+            return alpha
+
+        key = current + mask
+        entry = self.table.get(key)
+        best_column = None
+        if entry is not None:
+            _generation, entry_depth, flag, score, best_column = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return score
+                if flag == LOWER:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+
+        original_alpha = alpha
+        best, best_column_now = -size - 1, None
+        for move, column in self.ordered_moves(current, mask, candidates, best_column):
+            score = -self.negamax(current ^ mask, mask | move, moves + 1, -beta, -alpha, depth - 1)
+            if score > best:
+                best, best_column_now = score, column
+            if score >= beta:
+                self.table.put(key, depth, LOWER, score, column)
+                return score
+            if score > alpha:
+                alpha = score
+        self.table.put(key, depth, EXACT if best > original_alpha else UPPER, best, best_column_now)
+        return best
+
+
+def parse_moves(text, geometry=rules.STANDARD):
+    """Build a position from a sequence of 1-based column numbers, e.g. "4453"."""
+    position = rules.Position(geometry)
+    for char in text:
+        column = int(char, 36) - 1
+        if not position.can_play(column) or position.is_winning_move(column):
+            raise ValueError(f"Invalid move {char} in {text}")
+        position.play(column)
+    return position
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve a Connect 4 position")
+    parser.add_argument("moves", nargs="?", default="", help="Moves played so far as 1-based columns, e.g. 4453")
+    parser.add_argument("--think", type=float, help="Seconds to search; solve the position if not given")
+    parser.add_argument("--table-bits", type=int, default=20, help="Transposition table size as a power of two")
+    parser.add_argument("--book", help="Opening book built by book.py")
+    args = parser.parse_args()
+    book = None
+    if args.book:
+        from book import OpeningBook
+        book = OpeningBook(args.book)
+    result = Solver(table_bits=args.table_bits, book=book).search(parse_moves(args.moves), budget=args.think)
+    outcome = "unknown" if not result.exact else "win" if result.score > 0 else "loss" if result.score < 0 else "draw"
+    print(f"best column {result.column + 1}, score {result.score} ({outcome}), depth {result.depth}, "
+          f"{result.nodes} nodes in {result.seconds:.2f}s, {result.nodes_per_second:.0f} nodes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import threading
+import time
+from logconfig import get_logger
+
+log = get_logger("timers")
+
+
+class Heartbeat:
+    """How often idle clients are pinged and when they are considered dead.
+
+    A client that has sent nothing for ping_interval seconds is sent a Ping,
+    which it answers with a Pong. One that has sent nothing at all for
+    idle_timeout seconds is disconnected. An idle_timeout of 0 disables both.
+    """
+
+    def __init__(self, ping_interval=15.0, idle_timeout=45.0):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+
+    @property
+    def enabled(self):
+        return self.idle_timeout > 0
+
+
+class WheelTimer:
+    """Handle for a callback scheduled on a TimingWheel."""
+
+    __slots__ = ("callback", "args", "slot", "rounds")
+
+    def __init__(self, callback, args, slot, rounds):
+        self.callback = callback
+        self.args = args
+        self.slot = slot
+        self.rounds = rounds  # Full turns of the wheel left before it fires
+
+
+class TimingWheel:
+    """Hashed timing wheel: O(1) schedule and cancel for many coarse timers.
+
+    The wheel has `slots` buckets and a single thread moves to the next bucket
+    every `tick` seconds, firing the timers in it that have no full turns left.
+    Delays are rounded up to whole ticks, which is plenty for heartbeats and
+    idle timeouts, and the cost of a tick depends on the timers in one bucket,
+    not on all of them.
+    """
+
+    def __init__(self, tick=0.5, slots=512):
+        self.tick = tick
+        self.buckets = [set() for _ in range(slots)]
+        self.current = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="timing-wheel", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) on the wheel thread after about delay seconds, returns a WheelTimer."""
+        ticks = max(1, int(-(-delay // self.tick)))  # Round up
+        slots = len(self.buckets)
+        with self.lock:
+            slot = (self.current + ticks) % slots
+            timer = WheelTimer(callback, args, slot, (ticks - 1) // slots)
+            self.buckets[slot].add(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer; does nothing if it already fired or was cancelled."""
+        if timer is None:
+            return
+        with self.lock:
+            bucket = self.buckets[timer.slot]
+            if timer in bucket:
+                bucket.remove(timer)
+                self.count -= 1
+
+    def advance(self):
+        """Move to the next bucket and fire the timers that are due."""
+        with self.lock:
+            self.current = (self.current + 1) % len(self.buckets)
+            bucket = self.buckets[self.current]
+            due = []
+            for timer in bucket:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    due.append(timer)
+            bucket.difference_update(due)
+            self.count -= len(due)
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.exception(f"Error in timer callback: {e}")
+
+    def run(self):
+        """Wheel thread: advance once per tick, catching up if a tick ran late."""
+        next_tick = time.monotonic() + self.tick
+        while not self.stopped.wait(max(0.0, next_tick - time.monotonic())):
+            while next_tick <= time.monotonic():
+                self.advance()
+                next_tick += self.tick
+
+    def stop(self):
+        self.stopped.set()